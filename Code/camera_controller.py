@@ -2,11 +2,19 @@ import time
 import datetime
 import json
 import argparse
+import math
+import signal
+import sys
 from pathlib import Path
 
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
 from libcamera import controls
 
+from deadline_scheduler import SlotScheduler
+from frame_ring import BurstDumper, FrameRing, trigger_socket
+from snapshot_metadata import MetadataStore
+from snapshot_writer import SnapshotWriter
+
 def check_request_timestamp(request, check_time):
     md = request.get_metadata()
     # 'SensorTimestamp' is when the first pixel was read out, so it started being
@@ -14,29 +22,113 @@ def check_request_timestamp(request, check_time):
     exposure_start_time = md['SensorTimestamp'] - 1000 * md['ExposureTime']
     if exposure_start_time < check_time:
         print("ERROR: request captured too early by", check_time - exposure_start_time, "nanoseconds")
+    return exposure_start_time - check_time
 
-def snapshot(camera:Picamera2, data_path:str):
+def snapshot(camera:Picamera2, data_path:str, slots:SlotScheduler, writer:SnapshotWriter=None, store:MetadataStore=None):
 
-    timestr = time.strftime("%Y%m%d-%H%M%S")
-    ct = datetime.datetime.now()
-    check_time = time.monotonic_ns() + 5e8
+    # the first frame exposed after the slot's start is captured, slots are aligned to the wall clock
+    slot_ns, check_time = slots.next_slot()
+    ct = datetime.datetime.fromtimestamp(slot_ns / 1e9)
+    timestr = ct.strftime("%Y%m%d-%H%M%S")
+    if slot_ns % 1000000000 != 0:
+        # sub-second timers would otherwise reuse file names
+        timestr += f"-{slot_ns // 1000000 % 1000:03d}"
     job = camera.capture_request(flush=check_time, wait=False)
 
     request = camera.wait(job)
-    check_request_timestamp(request, check_time)
+    captured_ns = time.monotonic_ns()
+    offset = check_request_timestamp(request, check_time)
+    print(f"slot {ct} exposure start offset {offset / 1e6:+.1f} ms, missed slots {slots.skipped} (total {slots.missed})", flush=True)
     imgMetadata = request.get_metadata()
     imgMetadata2 = {
         "filename":f"cam_{camera.camera_idx}_image_{timestr}.png",
         "timestamp":str(ct),
-        "timestamp(ns)":check_time
+        "timestamp(ns)":check_time,
+        "exposure_start_offset(ns)":offset,
+        "missed_slots":slots.skipped,
     }
-    
-    with open(f'{data_path}/cam_{camera.camera_idx}_metadata_{timestr}.json', 'w') as f:
-        f.write(json.dumps([imgMetadata2, imgMetadata]))
+    json_path = f'{data_path}/cam_{camera.camera_idx}_metadata_{timestr}.json'
+    if store is not None:
+        # one line of the camera's daily store instead of a JSON file per snapshot (see snapshot_metadata.py)
+        store.append(slot_ns, Path(json_path).name, [imgMetadata2, imgMetadata])
+        json_path = None
+
+    if writer is not None:
+        # copy the frame out and release the request, encoding and writing happen on the writer's workers
+        buffer = request.make_buffer('main')
+        request.release()
+        writer.submit(
+            buffer,
+            imgMetadata,
+            [imgMetadata2, imgMetadata],
+            f'{data_path}/cam_{camera.camera_idx}_image_{timestr}.png',
+            json_path,
+            captured_ns,
+        )
+        return
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            f.write(json.dumps([imgMetadata2, imgMetadata]))
     request.save('main', f'{data_path}/cam_{camera.camera_idx}_image_{timestr}.png')
     print(f'snapshot saved to {data_path}/cam_{camera.camera_idx}_image_{timestr}.png', flush=True)
     request.release()
 
+def ring_capture(camera:Picamera2, data_path:str, ring:FrameRing, pre:float, post:float, trigger=None):
+
+    # every frame goes into the ring, a trigger dumps pre seconds before it and post seconds after it
+    dumper = BurstDumper(ring)
+    sources = []
+    signal.signal(signal.SIGUSR1, lambda signum, frame: sources.append("SIGUSR1"))
+    burst = None
+    stream = camera.camera_configuration()['main']
+    try:
+        while True:
+            request = camera.capture_request()
+            time_ns = time.time_ns()
+            try:
+                sensor_timestamp = request.get_metadata()['SensorTimestamp']
+                with MappedArray(request, 'main') as m:
+                    ring.put(m.array, sensor_timestamp, time_ns)
+            finally:
+                request.release()
+
+            if trigger is not None:
+                while True:
+                    try:
+                        sources.append(trigger.recv(1024).decode(errors='replace'))
+                    except BlockingIOError:
+                        break
+            while len(sources) > 0:
+                source = sources.pop(0)
+                if dumper.busy:
+                    print(f"trigger {source} ignored, a burst is being saved", flush=True)
+                elif burst is None:
+                    print(f"trigger {source}", flush=True)
+                    burst = {
+                        "trigger_sources": [source],
+                        "trigger_time": str(datetime.datetime.now()),
+                        "trigger(ns)": time.monotonic_ns(),
+                    }
+                else:
+                    burst["trigger_sources"].append(source)
+
+            if burst is not None and sensor_timestamp >= burst["trigger(ns)"] + post * 1e9:
+                slots = ring.window(burst["trigger(ns)"] - pre * 1e9, sensor_timestamp)
+                timestr = time.strftime("%Y%m%d-%H%M%S")
+                burst.update({
+                    "camera": camera.camera_idx,
+                    "pre": pre,
+                    "post": post,
+                    "format": stream['format'],
+                    "size": list(stream['size']),
+                })
+                dumper.dump(slots, f'{data_path}/cam_{camera.camera_idx}_burst_{timestr}', burst)
+                burst = None
+    finally:
+        # a burst being saved is finished when supervisord stops the controller
+        dumper.join()
+
 def cameraControls(camera:Picamera2, jsonConfig:str):
     if jsonConfig is not None:
         camera.set_controls({"AfMode" : controls.AfModeEnum.Manual}) # Autofocus mode set last word to either Manual, Auto or Continuous
@@ -74,8 +166,60 @@ parser.add_argument(
 parser.add_argument(
     "--timer",
     default=10,
+    type=float,
+    help="Time in seconds between snapshots, snapshots are taken on multiples of this period since the Unix epoch (which are also multiples since midnight UTC when the period divides 86400)"
+)
+parser.add_argument(
+    "--metadata",
+    default="store",
+    choices=["store", "files"],
+    help="Write snapshot metadata to one JSON lines file per day (export with snapshot_metadata.py) or one JSON file per snapshot",
+)
+parser.add_argument(
+    "--encoders",
+    default=0,
+    type=int,
+    help="Number of background threads encoding and writing snapshots (0 saves each snapshot before the next capture)",
+)
+parser.add_argument(
+    "--queue_length",
+    default=4,
+    type=int,
+    help="Maximum number of snapshots waiting to be written (--encoders only), captures wait when the queue is full",
+)
+parser.add_argument(
+    "--ring",
+    default=0,
+    type=float,
+    help="Run the sensor continuously and keep this many seconds of frames before a trigger (0 takes snapshots instead)",
+)
+parser.add_argument(
+    "--post",
+    default=2,
+    type=float,
+    help="Seconds of frames saved after a trigger (--ring only)",
+)
+parser.add_argument(
+    "--ring_size",
+    default="640x480",
+    help="Frame size of the continuous stream (--ring only)",
+)
+parser.add_argument(
+    "--ring_fps",
+    default=10,
+    type=float,
+    help="Frame rate of the continuous stream (--ring only)",
+)
+parser.add_argument(
+    "--ring_memory",
+    default=256,
     type=int,
-    help="Time in seconds between snapshots"
+    help="Maximum memory of the frame ring in MB, the pre-trigger window is shortened to fit (--ring only)",
+)
+parser.add_argument(
+    "--trigger_socket",
+    type=str,
+    help="Path of a Unix datagram socket whose messages trigger a burst (--ring only, see frame_ring.py), SIGUSR1 is always a trigger",
 )
 parser.add_argument(
     "--config",
@@ -87,7 +231,14 @@ args = parser.parse_args()
 if __name__ == "__main__":
     Path(args.data_path).mkdir(parents=True, exist_ok=True)
     picam = Picamera2(int(args.camera))
-    config = picam.create_still_configuration()
+    if args.ring > 0:
+        width, height = (int(value) for value in args.ring_size.split('x'))
+        config = picam.create_video_configuration(
+            main={'size': (width, height), 'format': 'RGB888'},
+            controls={'FrameRate': args.ring_fps},
+        )
+    else:
+        config = picam.create_still_configuration()
     picam.configure(config)
     picam.start()
     time.sleep(1)
@@ -96,7 +247,26 @@ if __name__ == "__main__":
     time.sleep(2)
     # snapshot(picam0, args.data_path)
 
+    # queued snapshots and bursts are written when supervisord stops the controller
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.ring > 0:
+        ring = FrameRing(math.ceil((args.ring + args.post) * args.ring_fps) + 1, args.ring_memory * 1000000)
+        trigger = None if args.trigger_socket is None else trigger_socket(args.trigger_socket)
+        ring_capture(picam, args.data_path, ring, args.ring, args.post, trigger)
+
     # TODO UNCOMMENT THIS WHEN FINISHED TESTING
-    while True:
-        snapshot(picam, args.data_path)
-        time.sleep(args.timer)
+    writer = None
+    if args.encoders > 0:
+        writer = SnapshotWriter(picam, workers=args.encoders, queue_length=args.queue_length)
+    store = None
+    if args.metadata == "store":
+        store = MetadataStore(args.data_path, picam.camera_idx)
+    try:
+        slots = SlotScheduler(args.timer)
+        while True:
+            snapshot(picam, args.data_path, slots, writer, store)
+    finally:
+        if writer is not None:
+            writer.close()
+        if store is not None:
+            store.close()
@@ -0,0 +1,154 @@
+"""Fixed-rate loop timing with absolute deadlines.
+
+DeadlineScheduler paces a sampling loop at a target rate. Deadlines are
+start + n * period, so the time spent in the loop body does not add up into
+drift. A wake-up that is a whole period or more behind counts the deadlines
+it missed and resumes on the next deadline in the future instead of running
+a catch-up burst.
+
+Every report interval the achieved rate, the missed deadlines and a histogram
+of the wake-up lateness (jitter) are printed and appended as one JSON line to
+each sidecar file.
+
+    scheduler = DeadlineScheduler(rate=200.0, sidecars=["imu-timing.jsonl"])
+    while True:
+        scheduler.wait()
+        read_sensor()
+
+SlotScheduler hands out wall-clock aligned slots (every period seconds,
+counted from the epoch so that all the processes of a system share the same
+boundaries) for loops whose waiting is done elsewhere, for instance by a
+camera that delivers the first frame exposed after a deadline.
+
+    slots = SlotScheduler(period=10.0)
+    while True:
+        slot_ns, deadline = slots.next_slot()
+        capture_first_frame_after(deadline)
+"""
+
+import bisect
+import json
+import pathlib
+import time
+
+# upper bounds of the jitter histogram bins in microseconds, the last bin is unbounded
+JITTER_BINS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class DeadlineScheduler:
+    def __init__(
+        self,
+        rate: float,
+        report_interval: float = 60.0,
+        sidecars: list[pathlib.Path] = (),
+        name: str = "",
+    ):
+        """
+        rate is in Hz, report_interval in seconds (0 disables the reports).
+        """
+        self.period = int(round(1e9 / rate))
+        self.rate = rate
+        self.report_interval = int(report_interval * 1e9)
+        self.sidecars = [pathlib.Path(sidecar) for sidecar in sidecars]
+        self.name = name
+        self.deadline = None
+        self._reset_statistics(time.monotonic_ns())
+
+    def _reset_statistics(self, now: int):
+        self.report_start = now
+        self.samples = 0
+        self.missed = 0
+        self.histogram = [0] * (len(JITTER_BINS) + 1)
+        self.total_jitter = 0
+        self.longest_jitter = 0
+
+    def wait(self) -> int:
+        """
+        Sleeps until the next deadline and returns it (time.monotonic_ns()
+        clock).
+        """
+        now = time.monotonic_ns()
+        if self.deadline is None:
+            self.deadline = now
+            self._reset_statistics(now)
+        else:
+            self.deadline += self.period
+            if now - self.deadline >= self.period:
+                # skip the deadlines that already passed
+                skipped = (now - self.deadline) // self.period
+                self.missed += skipped
+                self.deadline += skipped * self.period
+            if self.deadline > now:
+                time.sleep((self.deadline - now) / 1e9)
+                now = time.monotonic_ns()
+        jitter = max(0, now - self.deadline)
+        self.histogram[bisect.bisect_left(JITTER_BINS, jitter / 1e3)] += 1
+        self.total_jitter += jitter
+        if jitter > self.longest_jitter:
+            self.longest_jitter = jitter
+        self.samples += 1
+        if self.report_interval > 0 and now - self.report_start >= self.report_interval:
+            self.report(now)
+        return self.deadline
+
+    def statistics(self, now: int) -> dict:
+        elapsed = (now - self.report_start) / 1e9
+        return {
+            "system_time": time.time(),
+            "target_rate": self.rate,
+            "achieved_rate": self.samples / elapsed if elapsed > 0 else 0.0,
+            "samples": self.samples,
+            "missed": self.missed,
+            "mean_jitter_us": self.total_jitter / self.samples / 1e3 if self.samples > 0 else 0.0,
+            "longest_jitter_us": self.longest_jitter / 1e3,
+            "jitter_bins_us": list(JITTER_BINS),
+            "jitter_histogram": self.histogram,
+        }
+
+    def report(self, now: int):
+        statistics = self.statistics(now)
+        print(
+            f"Timing {self.name}: rate={statistics['achieved_rate']:.2f}/{self.rate:g}Hz "
+            f"missed={self.missed} mean_jitter={statistics['mean_jitter_us']:.0f}us "
+            f"longest_jitter={statistics['longest_jitter_us']:.0f}us histogram={self.histogram}",
+            flush=True,
+        )
+        line = json.dumps(statistics) + "\n"
+        for path in self.sidecars:
+            with open(path, "a") as sidecar:
+                sidecar.write(line)
+        self._reset_statistics(now)
+
+
+class SlotScheduler:
+    def __init__(self, period: float, offset: float = 0.0):
+        """
+        Slots start at offset + n * period seconds since the epoch.
+        """
+        self.period = int(round(period * 1e9))
+        self.offset = int(round(offset * 1e9)) % self.period
+        self.index = None
+        self.missed = 0
+        self.skipped = 0
+
+    def next_slot(self) -> tuple[int, int]:
+        """
+        Returns the start of the next slot as wall-clock time (time.time_ns()
+        clock) and as the matching time.monotonic_ns() deadline, without
+        sleeping. Slots that went by since the previous call are counted in
+        skipped (this call) and missed (total).
+        """
+        now = time.time_ns()
+        monotonic_now = time.monotonic_ns()
+        index = (now - self.offset) // self.period + 1
+        self.skipped = 0
+        if self.index is not None:
+            if index <= self.index:
+                # the wall clock was set back, slots are never repeated
+                index = self.index + 1
+            else:
+                self.skipped = index - self.index - 1
+                self.missed += self.skipped
+        self.index = index
+        slot_ns = index * self.period + self.offset
+        return slot_ns, monotonic_now + max(0, slot_ns - now)
@@ -0,0 +1,101 @@
+"""Frame rendering for the event viewer.
+
+AccumulationRenderer folds every packet of events into per-pixel buffers that
+hold the timestamp and polarity of the latest event, then renders the pixels
+whose latest event falls in a time window ending at the newest event. With a
+decay time constant, pixels fade exponentially with the age of their latest
+event instead of switching off at the end of the window.
+
+Folding a packet is a single vectorized scatter and rendering a frame always
+touches the same width x height buffers, so the memory and the per-frame cost
+do not grow with the event rate.
+"""
+
+import numpy as np
+
+# BGR colours, as used by OpenCV
+BACKGROUND_COLOUR = (30, 37, 52)
+ON_COLOUR = (236, 223, 216)
+OFF_COLOUR = (201, 126, 64)
+
+NEVER = np.iinfo(np.int64).min // 2
+
+
+class AccumulationRenderer:
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        window: float = 0.05,
+        decay: float = 0.0,
+        polarity_colours: bool = False,
+    ):
+        """
+        window and decay are in seconds, decay is the time constant of the
+        exponential fade (0 disables the fade). Without polarity colours,
+        frames are grayscale with every event drawn white.
+        """
+        self.width = width
+        self.height = height
+        self.window = int(round(window * 1e6))
+        self.decay = decay * 1e6
+        self.polarity_colours = polarity_colours
+        self.last_t = np.full(width * height, NEVER, dtype=np.int64)
+        # 256 for ON and 0 for OFF, offsets in the colour lookup table
+        self.last_polarity = np.zeros(width * height, dtype=np.intp)
+        self.now = 0
+        # render buffers
+        self.age = np.empty(width * height, dtype=np.int64)
+        self.visible = np.empty(width * height, dtype=bool)
+        self.weights = np.empty(width * height, dtype=np.float32)
+        self.levels = np.empty(width * height, dtype=np.intp)
+        self.frame = np.empty(
+            (height, width, 3) if polarity_colours else (height, width),
+            dtype=np.uint8,
+        )
+        # colour of every (polarity, level) pair
+        level = np.arange(256, dtype=np.float64)[:, np.newaxis] / 255.0
+        background = np.array(BACKGROUND_COLOUR, dtype=np.float64)
+        self.lookup = np.concatenate(
+            [
+                np.round(background + (np.array(colour) - background) * level)
+                for colour in (OFF_COLOUR, ON_COLOUR)
+            ]
+        ).astype(np.uint8)
+
+    def add(self, events: np.ndarray):
+        """
+        events is a structured array with t, x, y and on fields, sorted by t.
+        """
+        if len(events) == 0:
+            return
+        indices = events["y"].astype(np.intp) * self.width + events["x"]
+        self.last_t[indices] = events["t"]
+        if self.polarity_colours:
+            self.last_polarity[indices] = events["on"].astype(np.intp) << 8
+        self.now = max(self.now, int(events["t"][-1]))
+
+    def clear(self):
+        self.last_t.fill(NEVER)
+        self.now = 0
+
+    def render(self) -> np.ndarray:
+        """
+        Returns the frame (the same buffer is reused by the next call).
+        """
+        np.subtract(self.now, self.last_t, out=self.age)
+        np.less_equal(self.age, self.window, out=self.visible)
+        if self.decay > 0:
+            np.multiply(self.age, -1.0 / self.decay, out=self.weights, casting="unsafe")
+            np.exp(self.weights, out=self.weights)
+            np.multiply(self.weights, self.visible, out=self.weights)
+        else:
+            np.copyto(self.weights, self.visible)
+        np.multiply(self.weights, 255.0, out=self.weights)
+        if not self.polarity_colours:
+            np.copyto(self.frame.reshape(-1), self.weights, casting="unsafe")
+            return self.frame
+        np.copyto(self.levels, self.weights, casting="unsafe")
+        np.add(self.levels, self.last_polarity, out=self.levels)
+        np.take(self.lookup, self.levels, axis=0, out=self.frame.reshape(-1, 3))
+        return self.frame
@@ -0,0 +1,261 @@
+"""Live preview tap of the EVK4 recorders through shared memory.
+
+The recorder publishes the newest raw EVT3 packets into a fixed-size ring of
+slots in a /dev/shm file, so that the event viewer can show a camera while it
+is recording. The recorder never waits for readers: publishing a packet is a
+copy into the next slot, and readers that fall behind lose the slots that were
+overwritten.
+
+File layout (little-endian):
+
+- header (HEADER_SIZE bytes): magic, width, height, number of slots, slot
+  size, sequence number of the last published slot
+- slots (SLOT_HEADER_SIZE + slot size bytes each): sequence number, system
+  time, length, data
+
+Slot n (starting at 1) is stored at index n % slots. The publisher zeroes the
+slot's sequence number before overwriting its data and writes the new one
+after. Readers copy the data, then drop the slot unless its sequence number
+is unchanged and the head has not moved far enough for the slot to be
+reused. Packets larger than a slot are split over several slots.
+
+These checks are a seqlock without memory barriers (Python has none), so on
+weakly ordered CPUs such as the Pi's ARM cores a reader can still see a slot
+that was partly overwritten while it was copied. Torn reads are rare, since
+a reader only races the publisher on a slot that is about to be dropped
+anyway, and they only affect the preview: TapDevice drops events outside the
+sensor, but a torn TIME_HIGH word can shift the preview's timestamps. The
+recording itself never reads the tap.
+
+A recorder that restarts replaces the file (the old one is unlinked while
+readers may still have it mapped), TapDevice re-attaches to the new file.
+
+    python3 eventviewer_server.py --tap 00050420
+"""
+
+import mmap
+import os
+import pathlib
+import struct
+import time
+
+import numpy as np
+
+import evt3
+import fake_evk4
+
+DEFAULT_PATH = "/dev/shm/daedalus_tap_{serial}"
+MAGIC = b"DAEDTAP1"
+HEADER = struct.Struct("<8sIIIIQ")
+HEADER_SIZE = 64
+HEAD_OFFSET = HEADER.size - 8
+SLOT_HEADER = struct.Struct("<QdI")
+SLOT_HEADER_SIZE = 32
+SEQUENCE = struct.Struct("<Q")
+
+
+class TapPublisher:
+    """
+    Writes packets into the ring, its start, publish and stop methods have
+    the signatures of the recorder's "start", "packet" and "stop" hooks (see
+    evk4_recorder.py).
+    """
+
+    def __init__(self, path: pathlib.Path, slots: int = 32, slot_size: int = 1 << 18):
+        self.path = pathlib.Path(path)
+        self.slots = slots
+        self.slot_size = slot_size - slot_size % 2
+        self.buffer = None
+        self.head = 0
+
+    def start(self, device, metadata: dict = None):
+        properties = device.properties()
+        size = HEADER_SIZE + self.slots * (SLOT_HEADER_SIZE + self.slot_size)
+        # readers of a previous file keep their mapping, the new file replaces it atomically
+        temporary_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(temporary_path, "wb") as file:
+            file.truncate(size)
+        file_descriptor = os.open(temporary_path, os.O_RDWR)
+        try:
+            self.buffer = mmap.mmap(file_descriptor, size)
+        finally:
+            os.close(file_descriptor)
+        HEADER.pack_into(
+            self.buffer, 0, MAGIC, properties.width, properties.height, self.slots, self.slot_size, 0
+        )
+        self.head = 0
+        os.replace(temporary_path, self.path)
+
+    def publish(self, status, packet):
+        if self.buffer is None:
+            return
+        data = memoryview(packet).cast("B")
+        system_time = status.system_time
+        buffer = self.buffer
+        while len(data) > 0:
+            chunk = data[: self.slot_size]
+            data = data[self.slot_size :]
+            self.head += 1
+            offset = HEADER_SIZE + (self.head % self.slots) * (SLOT_HEADER_SIZE + self.slot_size)
+            SEQUENCE.pack_into(buffer, offset, 0)
+            start = offset + SLOT_HEADER_SIZE
+            buffer[start : start + len(chunk)] = chunk
+            SLOT_HEADER.pack_into(buffer, offset, self.head, system_time, len(chunk))
+            SEQUENCE.pack_into(buffer, HEAD_OFFSET, self.head)
+
+    def stop(self, recorder=None):
+        if self.buffer is None:
+            return
+        self.buffer.close()
+        self.buffer = None
+
+
+class TapReader:
+    """
+    Read-only view of a ring file. read yields the chunks published since
+    the previous call, oldest first, and counts the slots that were
+    overwritten before they could be read in dropped.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        file_descriptor = os.open(self.path, os.O_RDONLY)
+        try:
+            self.inode = os.fstat(file_descriptor).st_ino
+            self.buffer = mmap.mmap(file_descriptor, 0, prot=mmap.PROT_READ)
+        finally:
+            os.close(file_descriptor)
+        magic, self.width, self.height, self.slots, self.slot_size, _ = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            self.buffer.close()
+            raise ValueError(f"{self.path} is not an event tap")
+        # start from the newest slot
+        self.next = max(1, self.head())
+        self.dropped = 0
+
+    def head(self) -> int:
+        return SEQUENCE.unpack_from(self.buffer, HEAD_OFFSET)[0]
+
+    def replaced(self) -> bool:
+        """
+        True if the file was replaced by a new recorder or removed.
+        """
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def read(self):
+        head = self.head()
+        if head - self.next >= self.slots:
+            self.dropped += head - self.slots + 1 - self.next
+            self.next = head - self.slots + 1
+        while self.next <= head:
+            expected = self.next
+            self.next += 1
+            offset = HEADER_SIZE + (expected % self.slots) * (SLOT_HEADER_SIZE + self.slot_size)
+            sequence, system_time, length = SLOT_HEADER.unpack_from(self.buffer, offset)
+            if sequence != expected or length > self.slot_size:
+                # overwritten before or while the header was read
+                self.dropped += 1
+                continue
+            start = offset + SLOT_HEADER_SIZE
+            data = self.buffer[start : start + length]
+            if (
+                SEQUENCE.unpack_from(self.buffer, offset)[0] != sequence
+                or self.head() - expected >= self.slots - 1
+            ):
+                # overwritten (or about to be) while copying
+                self.dropped += 1
+            else:
+                yield system_time, data
+
+    def close(self):
+        self.buffer.close()
+
+
+class TapDevice:
+    """
+    Event viewer stand-in for the EVK4 that decodes the packets of a tap.
+    Iterating yields (status, packet) pairs like a non-raw
+    neuromorphic_drivers device, and waits for a recorder when there is none.
+    """
+
+    def __init__(self, path: pathlib.Path, poll_interval: float = 0.005):
+        self.path = pathlib.Path(path)
+        self.poll_interval = poll_interval
+        self.reader = None
+        self.decoder = evt3.Decoder()
+        self.offset = 0
+        self.last_t = 0
+        self.packets = 0
+        self._attach()
+
+    def _attach(self):
+        waiting = False
+        while True:
+            try:
+                self.reader = TapReader(self.path)
+                break
+            except (FileNotFoundError, ValueError):
+                if not waiting:
+                    print(f"Waiting for a recorder to publish {self.path}", flush=True)
+                    waiting = True
+                time.sleep(0.5)
+        # timestamps restart with the new recorder, keep them increasing
+        self.decoder.reset()
+        self.offset = self.last_t
+        self.properties_ = fake_evk4.Properties(width=self.reader.width, height=self.reader.height)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def properties(self) -> fake_evk4.Properties:
+        return self.properties_
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        idle_since = time.monotonic()
+        while True:
+            for system_time, data in self.reader.read():
+                events = self.decoder.decode(data)
+                # a torn read can produce addresses outside the sensor
+                events = events[(events["x"] < self.reader.width) & (events["y"] < self.reader.height)]
+                if len(events) == 0:
+                    continue
+                if self.offset > 0:
+                    events["t"] += self.offset
+                self.last_t = int(events["t"][-1])
+                self.packets += 1
+                return (
+                    fake_evk4.Status(
+                        system_time=system_time,
+                        ring=fake_evk4.RingStatus(
+                            system_time=time.time(),
+                            backlog=0,
+                            raw_packets=self.packets,
+                            clutch_engaged=False,
+                            current_t=self.last_t,
+                        ),
+                    ),
+                    {
+                        "dvs_events": events,
+                        "trigger_events": np.zeros(0, dtype=fake_evk4.TRIGGER_DTYPE),
+                    },
+                )
+            if time.monotonic() - idle_since > 1.0 and self.reader.replaced():
+                self.reader.close()
+                self._attach()
+                idle_since = time.monotonic()
+            time.sleep(self.poll_interval)
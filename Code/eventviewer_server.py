@@ -1,15 +1,22 @@
 import argparse
+import collections
+import concurrent.futures
 import cv2
 import asyncio
 import numpy as np
 import threading
-import queue
 import logging
 import os
+import pathlib
+import struct
 # import signal
 
 from aiohttp import web, MultipartWriter
-import neuromorphic_drivers as nd
+
+import event_tap
+import fake_evk4
+from event_renderer import AccumulationRenderer
+from pixel_rates import PixelRateMap
 
 #TODO fix colour map of event viewer
 #TODO increase integration time for frames (not really necessary anymore)
@@ -22,6 +29,11 @@ logger = logging.getLogger("server")
 log_level = getattr(logging, log_level)
 logger.setLevel(log_level)
 
+dirname = pathlib.Path(__file__).resolve().parent
+
+# base timestamp in microseconds, number of events, time shift, coordinate scale
+STREAM_HEADER = struct.Struct("<QIHH")
+
 
 
 # class GracefulKiller:
@@ -33,10 +45,134 @@ logger.setLevel(log_level)
 #     def exit_gracefully(self, signum, frame):
 #         self.kill_now = True
 
-class StreamHandler:
+class FrameSlot:
+    '''
+    Latest frame for one client, a slow client skips the frames published
+    while it was sending the previous one
+    '''
+
+    def __init__(self):
+        self.frame = None
+        self.ready = asyncio.Event()
+        self.skipped = 0
+        self.published = 0
+        self.delivered = 0
+
+    def publish(self, frame):
+        if self.ready.is_set():
+            self.skipped += 1
+        self.frame = frame
+        self.published += 1
+        self.ready.set()
+
+    async def next(self):
+        await self.ready.wait()
+        self.ready.clear()
+        self.delivered += 1
+        return self.frame
+
+class RateController:
+    '''
+    Adapts the JPEG quality and the frame rate to the slowest client, measured
+    as the fraction of published frames that it actually received
+    '''
+
+    def __init__(self, fps:float = 25, quality:int = 80, minimum_quality:int = 30, minimum_fps:float = 2, period:float = 1.0):
+        self.maximum_fps = fps
+        self.fps = fps
+        self.maximum_quality = quality
+        self.quality = quality
+        self.minimum_quality = minimum_quality
+        self.minimum_fps = minimum_fps
+        self.period = period
+        self._counts = {}
+        self._next_update = 0.0
+
+    def update(self, slots, now:float):
+        if now < self._next_update:
+            return
+        self._next_update = now + self.period
+        ratios = []
+        counts = {}
+        for slot in slots:
+            published, delivered = self._counts.get(slot, (0, 0))
+            if slot.published > published:
+                ratios.append((slot.delivered - delivered) / (slot.published - published))
+            counts[slot] = (slot.published, slot.delivered)
+        self._counts = counts
+        if len(ratios) == 0:
+            return
+        ratio = min(ratios)
+        previous = (self.quality, self.fps)
+        if ratio < 0.8:
+            # lower the quality first, then the frame rate
+            if self.quality > self.minimum_quality:
+                self.quality = max(self.minimum_quality, self.quality - 10)
+            else:
+                self.fps = max(self.minimum_fps, self.fps * max(ratio, 0.5))
+        elif ratio > 0.95:
+            if self.fps < self.maximum_fps:
+                self.fps = min(self.maximum_fps, self.fps * 1.25)
+            else:
+                self.quality = min(self.maximum_quality, self.quality + 5)
+        if (self.quality, self.fps) != previous:
+            logger.info(f"Slowest client received {ratio:.0%} of the frames, quality {self.quality} at {self.fps:.1f} fps")
+
+class FrameBroadcaster:
+    '''
+    Renders and encodes each frame once and publishes it to every client,
+    frames are only rendered while at least one client is connected
+    '''
 
-    def __init__(self, cam):
+    def __init__(self, cam, fps:float = 25, quality:int = 80):
         self._cam = cam
+        self._rate = RateController(fps=fps, quality=quality)
+        self._slots = set()
+        self._clients_changed = asyncio.Event()
+        self._task = None
+
+    def subscribe(self):
+        slot = FrameSlot()
+        self._slots.add(slot)
+        self._clients_changed.set()
+        logger.info(f"Client connected ({len(self._slots)} clients)")
+        return slot
+
+    def unsubscribe(self, slot):
+        self._slots.discard(slot)
+        logger.info(f"Client disconnected ({len(self._slots)} clients, skipped {slot.skipped} frames)")
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if len(self._slots) == 0:
+                # idle, drop the packets that nobody will see
+                self._clients_changed.clear()
+                try:
+                    await asyncio.wait_for(self._clients_changed.wait(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+                self._cam.discard()
+                continue
+            start = loop.time()
+            frame = await self._cam.get_frame(self._rate.quality)
+            for slot in self._slots:
+                slot.publish(frame)
+            self._rate.update(self._slots, loop.time())
+            await asyncio.sleep(max(0, 1 / self._rate.fps - (loop.time() - start)))
+
+    async def start(self, app):
+        self._cam.attach(asyncio.get_running_loop())
+        self._task = asyncio.create_task(self._produce())
+
+    async def stop(self, app):
+        if self._task is not None:
+            self._task.cancel()
+
+class StreamHandler:
+
+    def __init__(self, broadcaster:FrameBroadcaster):
+        self._broadcaster = broadcaster
 
     async def __call__(self, request):
         my_boundary = 'image-boundary'
@@ -48,45 +184,113 @@ class StreamHandler:
             }
         )
         await response.prepare(request)
+        slot = self._broadcaster.subscribe()
+        try:
+            while True:
+                frame = await slot.next()
+                with MultipartWriter('image/jpeg', boundary=my_boundary) as mpwriter:
+                    mpwriter.append(frame, {
+                        'Content-Type': 'image/jpeg'
+                    })
+                    try:
+                        await mpwriter.write(response, close_boundary=False)
+                    except ConnectionResetError :
+                        logger.warning("Client connection closed")
+                        break
+                await response.write(b"\r\n")
+        finally:
+            self._broadcaster.unsubscribe(slot)
+        return response
+
+class PacketFeed:
+    '''
+    Hands packets from the driver thread to the event loop, the loop is woken
+    once per batch of packets. Packets are dropped from the front when
+    nobody reads them.
+    '''
+
+    def __init__(self, maximum_packets:int = 4096):
+        self._packets = collections.deque(maxlen=maximum_packets)
+        self._loop = None
+        self._ready = None
+        self._wake_pending = False
+
+    def attach(self, loop):
+        self._loop = loop
+        self._ready = asyncio.Event()
+        self._wake_pending = True
+        loop.call_soon(self._ready.set)
+
+    def put(self, packet):
+        # driver thread
+        self._packets.append(packet)
+        if self._loop is not None and not self._wake_pending:
+            self._wake_pending = True
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def get_all(self):
         while True:
-            frame = await self._cam.get_frame()
-            with MultipartWriter('image/jpeg', boundary=my_boundary) as mpwriter:
-                mpwriter.append(frame, {
-                    'Content-Type': 'image/jpeg'
-                })
+            await self._ready.wait()
+            self._ready.clear()
+            self._wake_pending = False
+            packets = []
+            while True:
                 try:
-                    await mpwriter.write(response, close_boundary=False)
-                except ConnectionResetError :
-                    logger.warning("Client connection closed")
+                    packets.append(self._packets.popleft())
+                except IndexError:
                     break
-            await response.write(b"\r\n")
+            if len(packets) > 0:
+                return packets
+
+    def clear(self):
+        self._packets.clear()
 
 class Camera:
-    def __init__(self, idx, cam_dim:tuple, eventQueue:queue.Queue, camScale:int = 1):
+    def __init__(self, idx, cam_dim:tuple, eventFeed:PacketFeed, camScale:int = 1, renderer:AccumulationRenderer = None):
         self._idx = idx
         self.width = cam_dim[0]
         self.height = cam_dim[1]
         self.scale = camScale
-        self.clear_frame()
-        self.events = eventQueue
+        self.events = eventFeed
+        if renderer is None:
+            renderer = AccumulationRenderer(self.width, self.height)
+        self.renderer = renderer
+        # the renderer state is only touched by this single worker
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+        self._small = np.empty(
+            (self.height // camScale, self.width // camScale) + renderer.frame.shape[2:],
+            dtype=np.uint8,
+        )
 
     @property
     def identifier(self):
         return self._idx
 
-    async def get_frame(self):
-        packet = self.events.get()
-        self.events.queue.clear()
-        self.frame[
-            packet["dvs_events"]["y"],
-            packet["dvs_events"]["x"],
-            ] = 255
-        if self.scale != 1:
-            self.frame = cv2.resize(self.frame, dsize=(self.width//self.scale, self.height//self.scale), interpolation=cv2.INTER_CUBIC)
-        frameout = cv2.imencode('.jpg', np.flip(self.frame, 0))[1]
-        self.clear_frame()
-        await asyncio.sleep(1 / 25)
-        return frameout.tobytes()
+    def attach(self, loop):
+        self.events.attach(loop)
+
+    async def get_frame(self, quality:int = 80):
+        # fold every packet received since the last frame
+        packets = await self.events.get_all()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._render, packets, quality)
+
+    def _render(self, packets, quality:int):
+        for packet in packets:
+            self.renderer.add(packet["dvs_events"])
+        frame = self.renderer.render()
+        # flip and downscale by taking the maximum of each scale x scale bin
+        height, width = self._small.shape[:2]
+        frame = frame[: height * self.scale, : width * self.scale][::-1]
+        if self.scale == 1:
+            np.copyto(self._small, frame)
+        else:
+            bins = frame.reshape((height, self.scale, width, self.scale) + frame.shape[2:])
+            np.max(bins, axis=(1, 3), out=self._small)
+        return cv2.imencode('.jpg', self._small, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+    def discard(self):
+        self.events.clear()
     
     def stop(self):
         '''
@@ -94,23 +298,176 @@ class Camera:
         '''
         pass
 
-    def clear_frame(self):
-        self.frame = np.zeros(
-        (self.height, self.width),
-        dtype=np.float32,
-        )
+
+def packEvents(packets, scale:int = 1, max_events:int = 1 << 16):
+    '''
+    Packs the events of packets into one WebSocket message: STREAM_HEADER
+    then one little-endian uint32 per event, x | y << 11 | on << 21 | dt << 22
+    with x and y divided by scale and dt = (t - base) >> shift (10 bits).
+    Batches larger than max_events are decimated by keeping every nth event.
+    '''
+    events = np.concatenate([packet["dvs_events"] for packet in packets])
+    if len(events) == 0:
+        return None
+    if len(events) > max_events:
+        events = events[::-(-len(events) // max_events)]
+    base = int(events["t"][0])
+    shift = max(0, (int(events["t"][-1]) - base).bit_length() - 10)
+    words = ((events["t"] - base) >> shift).astype("<u4") << 22
+    words |= events["x"] // scale
+    words |= (events["y"] // scale).astype("<u4") << 11
+    words |= events["on"].astype("<u4") << 21
+    return STREAM_HEADER.pack(base, len(words), shift, scale) + words.tobytes()
+
+class EventStreamer:
+    '''
+    Packs the events received since the previous message fps times per
+    second and publishes each message to every WebSocket client, the
+    browser accumulates and draws them (see eventviewer.html). Packets are
+    discarded while no client is connected
+    '''
+
+    def __init__(self, feed:PacketFeed, cam_dim:tuple, fps:float = 25, scale:int = 1, max_rate:float = 2e6):
+        self._feed = feed
+        self.width = cam_dim[0] // scale
+        self.height = cam_dim[1] // scale
+        self._interval = 1 / fps
+        self._scale = scale
+        self._max_events = max(1, int(max_rate / fps))
+        self._slots = set()
+        self._clients_changed = asyncio.Event()
+        self._task = None
+
+    def subscribe(self):
+        slot = FrameSlot()
+        self._slots.add(slot)
+        self._clients_changed.set()
+        logger.info(f"Event stream client connected ({len(self._slots)} clients)")
+        return slot
+
+    def unsubscribe(self, slot):
+        self._slots.discard(slot)
+        logger.info(f"Event stream client disconnected ({len(self._slots)} clients, skipped {slot.skipped} messages)")
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if len(self._slots) == 0:
+                self._clients_changed.clear()
+                try:
+                    await asyncio.wait_for(self._clients_changed.wait(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+                self._feed.clear()
+                continue
+            start = loop.time()
+            packets = await self._feed.get_all()
+            message = await loop.run_in_executor(None, packEvents, packets, self._scale, self._max_events)
+            if message is not None:
+                for slot in self._slots:
+                    slot.publish(message)
+            await asyncio.sleep(max(0, self._interval - (loop.time() - start)))
+
+    async def start(self, app):
+        self._feed.attach(asyncio.get_running_loop())
+        self._task = asyncio.create_task(self._produce())
+
+    async def stop(self, app):
+        if self._task is not None:
+            self._task.cancel()
+
+async def eventPage(request):
+    return web.FileResponse(dirname / "eventviewer.html")
+
+class EventSocketHandler:
+    '''
+    Sends the size of the stream as JSON, then every message published by
+    the streamer as a binary message. The streamer discards the packets
+    received while no client is connected, a client only gets the events
+    that arrive after it connects
+    '''
+
+    def __init__(self, streamer:EventStreamer):
+        self._streamer = streamer
+
+    async def __call__(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"width": self._streamer.width, "height": self._streamer.height})
+        slot = self._streamer.subscribe()
+
+        async def send():
+            while True:
+                await ws.send_bytes(await slot.next())
+
+        # the receive loop handles the close handshake and ends with the connection
+        sender = asyncio.create_task(send())
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            sender.cancel()
+            self._streamer.unsubscribe(slot)
+        return ws
+
+class RateHandlers:
+    '''
+    JSON and PNG views of the per-pixel event rates, for tuning biases
+    '''
+
+    def __init__(self, rates:PixelRateMap):
+        self._rates = rates
+
+    async def summary(self, request):
+        # total rate and the ?top=N (default 10) hottest pixels
+        top = int(request.query.get("top", 10))
+        loop = asyncio.get_running_loop()
+        return web.json_response(await loop.run_in_executor(None, self._rates.summary, top))
+
+    async def histograms(self, request):
+        rows, columns = self._rates.histograms()
+        return web.json_response({"rows": rows.tolist(), "columns": columns.tolist()})
+
+    def _png(self):
+        # flipped like the frames of the MJPEG stream
+        image = cv2.applyColorMap(np.flip(self._rates.image(), 0), cv2.COLORMAP_INFERNO)
+        return cv2.imencode('.png', image)[1].tobytes()
+
+    async def image(self, request):
+        loop = asyncio.get_running_loop()
+        return web.Response(body=await loop.run_in_executor(None, self._png), content_type="image/png")
+
 
 class MjpegServer:
 
-    def __init__(self, cam:Camera, host='0.0.0.0', port=8080):
+    def __init__(self, cam:Camera, host='0.0.0.0', port=8080, fps:float = 25, quality:int = 80, streamer:EventStreamer = None, rates:PixelRateMap = None):
         self._port = port
         self._host = host
         self._app = web.Application()
         self._cam_routes = []
         self._cam = cam
+        self._fps = fps
+        self._quality = quality
+        self._streamer = streamer
+        self._rates = rates
 
     def start(self):
-        self._app.router.add_route("GET", "/", StreamHandler(self._cam))
+        # created here so that it belongs to the event loop started by run_app
+        broadcaster = FrameBroadcaster(self._cam, fps=self._fps, quality=self._quality)
+        self._app.on_startup.append(broadcaster.start)
+        self._app.on_cleanup.append(broadcaster.stop)
+        self._app.router.add_route("GET", "/", StreamHandler(broadcaster))
+        if self._streamer is not None:
+            # events drawn by the browser, the MJPEG stream above is the fallback
+            self._app.on_startup.append(self._streamer.start)
+            self._app.on_cleanup.append(self._streamer.stop)
+            self._app.router.add_route("GET", "/ws", EventSocketHandler(self._streamer))
+            self._app.router.add_route("GET", "/events", eventPage)
+        if self._rates is not None:
+            handlers = RateHandlers(self._rates)
+            self._app.router.add_route("GET", "/rates", handlers.summary)
+            self._app.router.add_route("GET", "/rates/histograms", handlers.histograms)
+            self._app.router.add_route("GET", "/rates.png", handlers.image)
         web.run_app(self._app, host=self._host, port=self._port)
 
     def stop(self):
@@ -121,13 +478,6 @@ class MjpegServer:
         pass
 
 if __name__ == "__main__":
-    configuration = nd.prophesee_evk4.Configuration(
-        biases=nd.prophesee_evk4.Biases(
-            diff_off=102,  # default: 102
-            diff_on=73,  # default: 73
-        )
-    )
-
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("serial", help="Camera serial number (for example 00050423)")
     parser.add_argument(
@@ -136,29 +486,104 @@ if __name__ == "__main__":
         type=int,
         help="Port at which server is available on"
     )
+    parser.add_argument(
+        "--fps",
+        default=25,
+        type=float,
+        help="Maximum number of frames per second sent to viewers, lowered for slow clients"
+    )
+    parser.add_argument(
+        "--quality",
+        default=80,
+        type=int,
+        help="Maximum JPEG quality, lowered for slow clients"
+    )
+    parser.add_argument(
+        "--window",
+        default=0.05,
+        type=float,
+        help="Duration of the time window drawn in each frame in seconds"
+    )
+    parser.add_argument(
+        "--decay",
+        default=0.0,
+        type=float,
+        help="Time constant of the exponential fade of old events in seconds (0 disables the fade)"
+    )
+    parser.add_argument(
+        "--polarity-colours",
+        action="store_true",
+        help="Draw ON and OFF events in different colours"
+    )
+    parser.add_argument(
+        "--tap",
+        action="store_true",
+        help="Show the events published by the recorder of this camera instead of opening the camera, the recording is not affected"
+    )
+    parser.add_argument(
+        "--tap-path",
+        default=event_tap.DEFAULT_PATH,
+        help="Shared-memory file published by the recorder ({serial} is replaced with the camera serial)"
+    )
+    parser.add_argument(
+        "--stream-scale",
+        default=2,
+        type=int,
+        help="Coordinate division of the events streamed to /events"
+    )
+    parser.add_argument(
+        "--stream-rate",
+        default=2e6,
+        type=float,
+        help="Maximum number of events per second streamed to /events, larger batches are decimated"
+    )
+    parser.add_argument(
+        "--rate-tau",
+        default=1.0,
+        type=float,
+        help="Time constant of the per-pixel event rates served on /rates in seconds"
+    )
+    fake_evk4.add_arguments(parser)
     args = parser.parse_args()
 
-    with nd.open(serial=args.serial) as device:
+    def openDevice():
+        if args.tap:
+            return event_tap.TapDevice(args.tap_path.format(serial=args.serial))
+        return fake_evk4.open_device(args, serial=args.serial)
+
+    with openDevice() as device:
         cam_width = device.properties().width
         cam_height = device.properties().height
 
-    def getEvents(out_q):
+    def getEvents(feeds, rates):
         # killer = GracefulKiller()
-        with nd.open(serial=args.serial) as device:#configuration=configuration
+        with openDevice() as device:
             print(f"Successfully started EVK4 {args.serial}")
 
             for status, packet in device:
 
-                out_q.put(packet)
+                rates.add(packet["dvs_events"])
+                for feed in feeds:
+                    feed.put(packet)
                 # if killer.kill_now:
                 #     break
                 
-    eventQueue = queue.LifoQueue()
-    eventProcess = threading.Thread(target=getEvents, args=(eventQueue, ))   
+    eventFeed = PacketFeed()
+    streamFeed = PacketFeed()
+    rates = PixelRateMap(cam_width, cam_height, tau=args.rate_tau)
+    eventProcess = threading.Thread(target=getEvents, args=([eventFeed, streamFeed], rates))   
     eventProcess.daemon=True  
 
-    cam = Camera(0, (cam_width, cam_height), eventQueue, camScale=2)
-    server = MjpegServer(cam=cam, port=args.port)
+    renderer = AccumulationRenderer(
+        cam_width,
+        cam_height,
+        window=args.window,
+        decay=args.decay,
+        polarity_colours=args.polarity_colours,
+    )
+    cam = Camera(0, (cam_width, cam_height), eventFeed, camScale=2, renderer=renderer)
+    streamer = EventStreamer(streamFeed, (cam_width, cam_height), fps=args.fps, scale=args.stream_scale, max_rate=args.stream_rate)
+    server = MjpegServer(cam=cam, port=args.port, fps=args.fps, quality=args.quality, streamer=streamer, rates=rates)
 
     try:
         eventProcess.start()
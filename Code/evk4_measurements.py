@@ -0,0 +1,146 @@
+"""Temperature and illuminance sampling for the EVK4 recorders.
+
+MeasurementSampler reads the sensors on its own thread at a fixed interval so
+that the control transfers never delay the packet loop. Measurements go into a
+bounded queue that the writer drains; when the queue is full the measurement is
+dropped and counted.
+
+Each measurement records the system time just before each register read and
+the latency of the read. A failed read is stored as None with its error
+message, and counted in the sampler statistics.
+"""
+
+import dataclasses
+import queue
+import threading
+import time
+
+READINGS = (
+    ("temperature", "temperature_celsius"),
+    ("illuminance", "illuminance"),
+)
+
+
+@dataclasses.dataclass
+class ReadingStats:
+    reads: int = 0
+    failures: int = 0
+    total_latency: float = 0.0
+    longest_latency: float = 0.0
+    last_error: str = None
+
+    def summary(self) -> str:
+        mean = self.total_latency / self.reads if self.reads > 0 else 0.0
+        return (
+            f"reads={self.reads} failures={self.failures} "
+            f"mean_latency={mean * 1e3:.2f}ms longest_latency={self.longest_latency * 1e3:.2f}ms"
+        )
+
+
+@dataclasses.dataclass
+class MeasurementStats:
+    measurements: int = 0
+    dropped: int = 0
+    late: int = 0
+    readings: dict = dataclasses.field(
+        default_factory=lambda: {name: ReadingStats() for name, _ in READINGS}
+    )
+
+    def summary(self) -> str:
+        return " ".join(
+            [f"measurements={self.measurements} dropped={self.dropped} late={self.late}"]
+            + [f"{name}({stats.summary()})" for name, stats in self.readings.items()]
+        )
+
+
+class MeasurementSampler(threading.Thread):
+    """
+    Samples the device's temperature and illuminance every interval seconds.
+
+    A measurement that starts more than one interval late is counted in
+    stats.late and the schedule skips ahead instead of sampling in a burst.
+    """
+
+    def __init__(
+        self,
+        device,
+        interval: float = 0.1,
+        queue_length: int = 1024,
+        report_interval: float = 60.0,
+        name: str = "",
+        hooks: list = None,
+    ):
+        """
+        Each hook is called with every measurement dict, on the sampler
+        thread.
+        """
+        super().__init__(daemon=True)
+        self.device = device
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=queue_length)
+        self.report_interval = report_interval
+        self.label = name
+        self.hooks = [] if hooks is None else hooks
+        self.stats = MeasurementStats()
+        self.stopped = threading.Event()
+
+    def _read(self, measurement_dict: dict, name: str, method: str):
+        stats = self.stats.readings[name]
+        measurement_dict[f"{name}_system_time"] = time.time()
+        start = time.monotonic()
+        try:
+            measurement_dict[name] = getattr(self.device, method)()
+        except Exception as error:
+            measurement_dict[name] = None
+            measurement_dict[f"{name}_error"] = repr(error)
+            stats.failures += 1
+            if stats.last_error != repr(error):
+                print(f"Measurements {self.label}: {name} failed ({error!r})", flush=True)
+            stats.last_error = repr(error)
+        latency = time.monotonic() - start
+        measurement_dict[f"{name}_latency"] = latency
+        stats.reads += 1
+        stats.total_latency += latency
+        if latency > stats.longest_latency:
+            stats.longest_latency = latency
+
+    def sample(self) -> dict:
+        measurement_dict = {"system_time": time.time()}
+        for name, method in READINGS:
+            self._read(measurement_dict, name, method)
+        self.stats.measurements += 1
+        for hook in self.hooks:
+            hook(measurement_dict)
+        try:
+            self.queue.put_nowait(measurement_dict)
+        except queue.Full:
+            self.stats.dropped += 1
+        return measurement_dict
+
+    def drain(self):
+        """
+        Yields the queued measurements, without blocking.
+        """
+        while True:
+            try:
+                yield self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def run(self):
+        next_measurement = time.monotonic()
+        next_report = next_measurement + self.report_interval
+        while not self.stopped.wait(max(0.0, next_measurement - time.monotonic())):
+            self.sample()
+            next_measurement += self.interval
+            now = time.monotonic()
+            if now - next_measurement > self.interval:
+                self.stats.late += 1
+                next_measurement = now + self.interval
+            if now >= next_report:
+                print(f"Measurements {self.label}: {self.stats.summary()}", flush=True)
+                next_report = now + self.report_interval
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
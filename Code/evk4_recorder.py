@@ -0,0 +1,458 @@
+"""EVK4 recording engine.
+
+Recorder records one camera: it opens the device, applies the biases given in
+the options, and writes events, samples, measurements and the seek index
+through a SegmentRotator (see evk4_segments.py), either from the packet loop
+or from a RingWriter thread (see evk4_writer.py). The rotation policy is
+"never" (one recording for the life of the process), "time" or "size".
+
+Hooks are called at each stage of the pipeline:
+
+- "start": hook(device, metadata), after the device is opened
+- "packet": hook(status, packet), on the device thread for every packet
+- "write": hook(data, statuses), after every batch written to the files
+  (on the writer thread with --writer-thread)
+- "measurement": hook(measurement_dict), on the sampler thread
+- "stop": hook(recorder), after the files are closed, also if recording
+  failed (possibly before the "start" hooks were called)
+
+With --tap, every packet is also published to a shared-memory ring (see
+event_tap.py) that eventviewer_server.py --tap reads to preview the camera
+while it records.
+
+record runs one Recorder thread per serial in the same process. If a recorder
+fails, the others are stopped so that supervisord restarts the process.
+
+    python3 evk4_recorder.py --rotation time --writer-thread 00050420 00050427
+
+record_raw_evk4_w_temp_and_illum.py and
+record_raw_evk4_w_temp_and_illum_intervals.py run this engine with the "never"
+and "time" rotation policies.
+"""
+
+import argparse
+import dataclasses
+import functools
+import pathlib
+import signal
+import threading
+import time
+import typing
+
+import event_tap
+import fake_evk4
+import storage_writer
+from evk4_measurements import MeasurementSampler
+from evk4_segments import SegmentRotator
+from evk4_writer import BackpressureFlag, PacketRing, RingWriter
+
+dirname = pathlib.Path(__file__).resolve().parent
+
+ROTATIONS = ("never", "time", "size")
+STAGES = ("start", "packet", "write", "measurement", "stop")
+
+
+@dataclasses.dataclass
+class RecorderOptions:
+    recordings: pathlib.Path = dirname / "recordings"
+    rotation: str = "never"
+    segment_duration: float = 300.0
+    segment_size: int = 1 << 30
+    # bias name to value, an empty dict keeps the camera's defaults
+    biases: dict[str, int] = dataclasses.field(default_factory=dict)
+    flush_interval: float = 0.5
+    measurement_interval: float = 0.1
+    samples_format: str = "binary"
+    index_interval: float = 0.1
+    writer_thread: bool = False
+    ring_slots: int = 16
+    ring_slot_size: int = 1 << 22
+    # {serial} is replaced with the camera serial, empty disables the flag
+    backpressure_flag: str = "/dev/shm/daedalus_backpressure_{serial}"
+    tap: bool = False
+    # {serial} is replaced with the camera serial
+    tap_path: str = event_tap.DEFAULT_PATH
+    tap_slots: int = 32
+    tap_slot_size: int = 1 << 18
+    storage: storage_writer.StorageOptions = dataclasses.field(
+        default_factory=storage_writer.StorageOptions
+    )
+
+
+def open_device(**kwargs):
+    import neuromorphic_drivers as nd
+
+    return nd.open(**kwargs)
+
+
+def configuration(biases: dict[str, int]):
+    import neuromorphic_drivers as nd
+
+    return nd.prophesee_evk4.Configuration(biases=nd.prophesee_evk4.Biases(**biases))
+
+
+def configuration_to_dict(configuration) -> dict:
+    configuration_dict = dataclasses.asdict(configuration)
+    configuration_dict["clock"] = configuration_dict["clock"].name
+    return configuration_dict
+
+
+class HookedFiles:
+    """
+    Forwards to files and calls the write hooks after every batch.
+    """
+
+    def __init__(self, files, hooks: list):
+        self.files = files
+        self.hooks = hooks
+
+    def write_packets(self, data, statuses):
+        self.files.write_packets(data, statuses)
+        for hook in self.hooks:
+            hook(data, statuses)
+
+    def __getattr__(self, name: str):
+        return getattr(self.files, name)
+
+
+class Recorder:
+    def __init__(
+        self,
+        serial: str,
+        options: RecorderOptions,
+        open_device: typing.Callable = open_device,
+        stopped: threading.Event = None,
+    ):
+        """
+        open_device is called with the keyword arguments of
+        neuromorphic_drivers.open. Setting stopped ends the recording after
+        the next packet.
+        """
+        if options.rotation not in ROTATIONS:
+            raise ValueError(f'unknown rotation "{options.rotation}" (expected one of {ROTATIONS})')
+        self.serial = serial
+        self.options = options
+        self.open_device = open_device
+        self.stopped = threading.Event() if stopped is None else stopped
+        self.hooks = {stage: [] for stage in STAGES}
+        self.error = None
+        self.tap = None
+        if options.tap:
+            self.tap = event_tap.TapPublisher(
+                options.tap_path.format(serial=serial),
+                slots=options.tap_slots,
+                slot_size=options.tap_slot_size,
+            )
+            self.add_hook("start", self.tap.start)
+            self.add_hook("packet", self.tap.publish)
+            self.add_hook("stop", self.tap.stop)
+
+    def add_hook(self, stage: str, hook: typing.Callable):
+        if stage not in self.hooks:
+            raise ValueError(f'unknown stage "{stage}" (expected one of {STAGES})')
+        self.hooks[stage].append(hook)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _rotator(self, output_directory: pathlib.Path, metadata: dict) -> SegmentRotator:
+        options = self.options
+        return SegmentRotator(
+            output_directory,
+            metadata,
+            duration=options.segment_duration if options.rotation == "time" else 0.0,
+            size=options.segment_size if options.rotation == "size" else 0,
+            samples_format=options.samples_format,
+            index_interval=options.index_interval,
+            storage=options.storage,
+        )
+
+    def run(self):
+        options = self.options
+        kwargs = {"raw": True, "serial": self.serial}
+        if len(options.biases) > 0:
+            kwargs["configuration"] = configuration(options.biases)
+        output_directory = pathlib.Path(options.recordings).resolve() / f"evk4_{self.serial}"
+        output_directory.mkdir(parents=True, exist_ok=True)
+        try:
+            with self.open_device(**kwargs) as device:
+                print(f"Successfully started EVK4 {self.serial}", flush=True)
+                metadata = {
+                    "properties": dataclasses.asdict(device.properties()),
+                    "configuration": (
+                        configuration_to_dict(kwargs["configuration"])
+                        if "configuration" in kwargs
+                        else "NONE"
+                    ),
+                }
+                for hook in self.hooks["start"]:
+                    hook(device, metadata)
+
+                # save the events, samples (timings), and measurements (illuminance and temperature)
+                with self._rotator(output_directory, metadata) as files:
+                    self._record(device, files)
+        finally:
+            for hook in self.hooks["stop"]:
+                hook(self)
+
+    def _record(self, device, files: SegmentRotator):
+        options = self.options
+        sampler = MeasurementSampler(
+            device,
+            interval=options.measurement_interval,
+            name=self.serial,
+            hooks=self.hooks["measurement"],
+        )
+        hooked_files = files if len(self.hooks["write"]) == 0 else HookedFiles(files, self.hooks["write"])
+        if options.writer_thread:
+            ring = PacketRing(
+                slots=options.ring_slots,
+                slot_size=options.ring_slot_size,
+                publish_interval=options.flush_interval,
+            )
+            writer = RingWriter(
+                ring,
+                hooked_files,
+                flush_interval=options.flush_interval,
+                measurements=sampler,
+                backpressure=(
+                    BackpressureFlag(options.backpressure_flag.format(serial=self.serial))
+                    if options.backpressure_flag
+                    else None
+                ),
+            )
+            writer.start()
+        packet_hooks = self.hooks["packet"]
+        flush_interval = int(round(options.flush_interval * 1e9))
+        next_flush = time.monotonic_ns() + flush_interval
+        sampler.start()
+        try:
+            for status, packet in device:
+                for hook in packet_hooks:
+                    hook(status, packet)
+                if options.writer_thread:
+                    if writer.error is not None:
+                        raise RuntimeError("the writer thread stopped") from writer.error
+                    ring.put(status, packet)
+                else:
+                    hooked_files.write_packets(packet, [(status, len(packet))])
+                    if time.monotonic_ns() >= next_flush:
+                        for measurement_dict in sampler.drain():
+                            files.write_measurement(measurement_dict)
+                        files.flush()
+                        next_flush = time.monotonic_ns() + flush_interval
+                if self.stopped.is_set():
+                    break
+        finally:
+            sampler.stop()
+            print(f"Measurements {self.serial}: {sampler.stats.summary()}", flush=True)
+            if options.writer_thread:
+                ring.close()
+                writer.join()
+                print(f"Writer {files.name}: {ring.stats.summary()}", flush=True)
+            else:
+                for measurement_dict in sampler.drain():
+                    files.write_measurement(measurement_dict)
+
+    def run_until_error(self):
+        """
+        Thread target, stores the error and stops the other recorders
+        sharing the same stopped event.
+        """
+        try:
+            self.run()
+        except Exception as error:
+            self.error = error
+            print(f"Recording EVK4 {self.serial} failed: {error!r}", flush=True)
+        finally:
+            self.stopped.set()
+
+
+def record(
+    serials: list[str],
+    options: RecorderOptions,
+    open_device: typing.Callable = open_device,
+    setup: typing.Callable = None,
+) -> list[Recorder]:
+    """
+    Records every camera on its own thread until one of them fails or the
+    process receives SIGINT or SIGTERM. setup(recorder) is called before the
+    threads start, for instance to add hooks.
+    """
+    stopped = threading.Event()
+    recorders = [Recorder(serial, options, open_device, stopped) for serial in serials]
+    if setup is not None:
+        for recorder in recorders:
+            setup(recorder)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    threads = [
+        threading.Thread(target=recorder.run_until_error, name=f"evk4_{recorder.serial}")
+        for recorder in recorders
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        # joins with a timeout keep the main thread responsive to Ctrl-C
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+    return recorders
+
+
+def parse_bias(value: str) -> tuple[str, int]:
+    name, separator, bias = value.partition("=")
+    if separator == "":
+        raise argparse.ArgumentTypeError(f'expected NAME=VALUE, got "{value}"')
+    return name.strip(), int(bias, 0)
+
+
+def add_arguments(parser: argparse.ArgumentParser, rotation: str = "never"):
+    parser.add_argument("serials", nargs="+", help="Camera serial numbers (for example 00050423)")
+    parser.add_argument(
+        "--recordings",
+        default=str(dirname / "recordings"),
+        help="Path of the directory where recordings are stored",
+    )
+    parser.add_argument(
+        "--rotation",
+        default=rotation,
+        choices=ROTATIONS,
+        help="Start a new recording never, every --segment-duration, or every --segment-size",
+    )
+    parser.add_argument(
+        "--segment-duration",
+        default=300.0,
+        type=float,
+        help="Duration of each recording segment in seconds (--rotation time)",
+    )
+    parser.add_argument(
+        "--segment-size",
+        default=1 << 30,
+        type=int,
+        help="Maximum size of each segment's events file in bytes (--rotation size)",
+    )
+    parser.add_argument(
+        "--bias",
+        action="append",
+        default=[],
+        type=parse_bias,
+        metavar="NAME=VALUE",
+        help="Set a camera bias (for example --bias diff_on=73), may be repeated, camera defaults are used if omitted",
+    )
+    parser.add_argument(
+        "--measurement-interval",
+        default=0.1,
+        type=float,
+        help="Interval between temperature and illuminance measurements in seconds",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        default=0.5,
+        type=float,
+        help="Maximum interval between file flushes in seconds",
+    )
+    parser.add_argument(
+        "--writer-thread",
+        action="store_true",
+        help="Write files on a dedicated thread fed by a bounded ring of buffers",
+    )
+    parser.add_argument(
+        "--ring-slots",
+        default=16,
+        type=int,
+        help="Number of buffers in the writer ring (--writer-thread only)",
+    )
+    parser.add_argument(
+        "--ring-slot-size",
+        default=1 << 22,
+        type=int,
+        help="Size of each writer ring buffer in bytes (--writer-thread only)",
+    )
+    parser.add_argument(
+        "--samples-format",
+        default="binary",
+        choices=["binary", "jsonl"],
+        help="Format of the per-packet samples file (binary is _samples.bin, see evk4_samples.py)",
+    )
+    parser.add_argument(
+        "--index-interval",
+        default=0.1,
+        type=float,
+        help="Interval between seek index entries in seconds (0 disables the index, see evk4_seek.py)",
+    )
+    parser.add_argument(
+        "--backpressure-flag",
+        default="/dev/shm/daedalus_backpressure_{serial}",
+        help="Flag file that exists while the writer ring is filling up, background jobs such as segment_compressor.py pause while it exists (--writer-thread only, empty disables the flag)",
+    )
+    parser.add_argument(
+        "--tap",
+        action="store_true",
+        help="Publish the newest packets to shared memory for eventviewer_server.py --tap",
+    )
+    parser.add_argument(
+        "--tap-path",
+        default=event_tap.DEFAULT_PATH,
+        help="Shared-memory file of the preview tap ({serial} is replaced with the camera serial)",
+    )
+    parser.add_argument(
+        "--tap-slots",
+        default=32,
+        type=int,
+        help="Number of packet slots in the preview tap",
+    )
+    parser.add_argument(
+        "--tap-slot-size",
+        default=1 << 18,
+        type=int,
+        help="Size of each preview tap slot in bytes, larger packets are split",
+    )
+    storage_writer.add_arguments(parser)
+    fake_evk4.add_arguments(parser)
+
+
+def options_from_arguments(args: argparse.Namespace) -> RecorderOptions:
+    return RecorderOptions(
+        recordings=pathlib.Path(args.recordings),
+        rotation=args.rotation,
+        segment_duration=args.segment_duration,
+        segment_size=args.segment_size,
+        biases=dict(args.bias),
+        flush_interval=args.flush_interval,
+        measurement_interval=args.measurement_interval,
+        samples_format=args.samples_format,
+        index_interval=args.index_interval,
+        writer_thread=args.writer_thread,
+        ring_slots=args.ring_slots,
+        ring_slot_size=args.ring_slot_size,
+        backpressure_flag=args.backpressure_flag,
+        tap=args.tap,
+        tap_path=args.tap_path,
+        tap_slots=args.tap_slots,
+        tap_slot_size=args.tap_slot_size,
+        storage=storage_writer.options_from_arguments(args),
+    )
+
+
+def main(rotation: str = "never"):
+    parser = argparse.ArgumentParser(
+        description="Record EVK4 cameras",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_arguments(parser, rotation=rotation)
+    args = parser.parse_args()
+    recorders = record(
+        args.serials,
+        options_from_arguments(args),
+        open_device=functools.partial(fake_evk4.open_device, args),
+    )
+    if any(recorder.error is not None for recorder in recorders):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Binary samples index for EVK4 raw recordings.
+
+Each packet read from the camera produces one fixed-width record holding the
+driver status and the events_cursor (the offset in the _events.raw file at
+which the packet ends). The records are stored in a record file (see
+record_file.py) named <name>_samples.bin next to the events.
+
+The driver's overflow_indices list has no fixed length. A record keeps its
+length in overflow_count and its first OVERFLOW_SLOTS entries in
+overflow_indices (the unused entries are zero), so statuses with more
+overflows than that lose the remaining indices. The jsonl converter keeps
+the same subset. Files written before overflow_indices was added only hold
+overflow_count (record files describe their own dtype).
+
+Converting older recordings:
+
+    python3 evk4_samples.py recordings/evk4_00050420/*_samples.jsonl
+"""
+
+import argparse
+import json
+import math
+import pathlib
+
+import numpy as np
+
+from record_file import RecordWriter, decode_records, read_records
+
+SAMPLES_SUFFIX = "_samples.bin"
+OVERFLOW_SLOTS = 8
+
+SAMPLE_DTYPE = np.dtype(
+    [
+        ("system_time", "<f8"),
+        # nan when the driver returned no ring status
+        ("ring_system_time", "<f8"),
+        ("backlog", "<u8"),
+        ("raw_packets", "<u8"),
+        ("events_cursor", "<u8"),
+        ("overflow_count", "<u4"),
+        # the first overflow_count (at most OVERFLOW_SLOTS) entries are valid
+        ("overflow_indices", "<u8", (OVERFLOW_SLOTS,)),
+        ("clutch_engaged", "u1"),
+    ]
+)
+NO_OVERFLOWS = (0,) * OVERFLOW_SLOTS
+
+
+def overflow_fields(overflow_indices) -> tuple:
+    """
+    Returns the overflow_count and overflow_indices fields of a record.
+    """
+    if overflow_indices is None:
+        return 0, NO_OVERFLOWS
+    kept = list(overflow_indices[:OVERFLOW_SLOTS])
+    return len(overflow_indices), tuple(kept + [0] * (OVERFLOW_SLOTS - len(kept)))
+
+
+def status_record(status, events_cursor: int) -> tuple:
+    ring = status.ring
+    if ring is None:
+        return (status.system_time, math.nan, 0, 0, events_cursor, 0, NO_OVERFLOWS, 0)
+    return (
+        status.system_time,
+        ring.system_time,
+        ring.backlog,
+        ring.raw_packets,
+        events_cursor,
+        *overflow_fields(ring.overflow_indices),
+        ring.clutch_engaged,
+    )
+
+
+def status_dict_record(status_dict: dict) -> tuple:
+    ring = status_dict["ring"]
+    if ring is None:
+        return (
+            status_dict["system_time"],
+            math.nan,
+            0,
+            0,
+            status_dict["events_cursor"],
+            0,
+            NO_OVERFLOWS,
+            0,
+        )
+    return (
+        status_dict["system_time"],
+        ring["system_time"],
+        ring["backlog"],
+        ring["raw_packets"],
+        status_dict["events_cursor"],
+        *overflow_fields(ring.get("overflow_indices")),
+        ring["clutch_engaged"],
+    )
+
+
+class SamplesWriter(RecordWriter):
+    def __init__(self, path: pathlib.Path, block_length: int = 4096):
+        super().__init__(
+            path,
+            SAMPLE_DTYPE,
+            block_length=block_length,
+            metadata={"kind": "evk4_samples"},
+        )
+
+    def append_status(self, status, events_cursor: int):
+        self.append(status_record(status, events_cursor))
+
+
+def read_samples(path) -> np.ndarray:
+    """
+    Reads a samples file, or its compressed version if the file itself was
+    deleted by segment_compressor.py.
+    """
+    import segment_compressor
+
+    path = segment_compressor.compressed_path(path)
+    if path.suffix in segment_compressor.EXTENSIONS.values():
+        with segment_compressor.SeekableReader(path) as reader:
+            return decode_records(reader.read())
+    return read_records(path)
+
+
+def convert_jsonl(source: pathlib.Path, target: pathlib.Path = None) -> pathlib.Path:
+    """
+    Converts a _samples.jsonl file written by older recorders, lines that
+    cannot be parsed (for instance the last line of an interrupted
+    recording) are skipped. Only the first OVERFLOW_SLOTS overflow indices
+    of each status are kept, overflow_count keeps the full count.
+    """
+    source = pathlib.Path(source)
+    if target is None:
+        target = source.with_name(source.name.replace("_samples.jsonl", SAMPLES_SUFFIX))
+        if target == source:
+            target = source.with_suffix(".bin")
+    skipped = 0
+    truncated = 0
+    with open(source, "rb") as lines, SamplesWriter(target) as samples:
+        for line in lines:
+            try:
+                record = status_dict_record(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                skipped += 1
+                continue
+            samples.append(record)
+            if record[5] > OVERFLOW_SLOTS:
+                truncated += 1
+    if skipped > 0:
+        print(f"Skipped {skipped} invalid lines in {source}")
+    if truncated > 0:
+        print(f"Kept the first {OVERFLOW_SLOTS} overflow indices of {truncated} statuses in {source}")
+    return target
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert _samples.jsonl files to the binary samples format",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("files", nargs="+", help="_samples.jsonl files to convert")
+    args = parser.parse_args()
+    for file in args.files:
+        target = convert_jsonl(pathlib.Path(file))
+        print(f"{file} -> {target} ({len(read_samples(target))} samples)")
@@ -0,0 +1,259 @@
+"""Time to byte offset seek index for EVK4 raw recordings.
+
+While recording, an entry is added to <name>_index.bin for the first packet
+received after every --index-interval seconds. Each entry maps three clocks to
+byte offsets in <name>_events.raw:
+
+- offset: start of the packet in the events file
+- system_time: time at which the packet was received (seconds since the epoch)
+- monotonic_ns: the same instant on the monotonic clock (-1 if unknown)
+- device_t: camera timestamp in microseconds of the first TIME_HIGH word of
+  the packet, unwrapped from the start of the file (-1 if there was none)
+- device_offset: byte offset of that TIME_HIGH word, decoding from there
+  yields correctly timestamped events
+
+Cutting a clip from a recording (times in seconds, --relative measures them
+from the start of the file):
+
+    python3 evk4_seek.py <name>_events.raw --start 60 --end 70 --relative --output clip.raw
+
+Recordings compressed by segment_compressor.py (<name>_events.raw.zst or .lz4)
+are read through their seek table, only the compressed chunks that overlap the
+window are decompressed.
+"""
+
+import argparse
+import mmap
+import pathlib
+import time
+
+import numpy as np
+
+import evt3
+import segment_compressor
+from record_file import RecordWriter, read_records
+
+INDEX_SUFFIX = "_index.bin"
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("offset", "<u8"),
+        ("system_time", "<f8"),
+        ("monotonic_ns", "<i8"),
+        ("device_t", "<i8"),
+        ("device_offset", "<u8"),
+    ]
+)
+
+CLOCKS = ("system", "monotonic", "device")
+
+
+class SeekIndexWriter(RecordWriter):
+    def __init__(self, path: pathlib.Path, interval: float = 0.1, block_length: int = 1024):
+        super().__init__(
+            path,
+            INDEX_DTYPE,
+            block_length=block_length,
+            metadata={"kind": "evk4_index", "interval": interval},
+        )
+        self.interval = interval
+        self.next_time = float("-inf")
+        self.previous = None
+        self.overflows = 0
+
+    def add_packets(self, data, statuses, events_cursor: int):
+        """
+        Called with the same arguments as RecordingFiles.write_packets,
+        events_cursor is the file offset of data.
+        """
+        start = 0
+        for status, end in statuses:
+            system_time = status.system_time if status.ring is None else status.ring.system_time
+            if system_time >= self.next_time:
+                monotonic_ns = time.monotonic_ns() - round((time.time() - system_time) * 1e9)
+                self.add(
+                    memoryview(data)[start:end],
+                    events_cursor + start,
+                    system_time,
+                    monotonic_ns,
+                )
+            start = end
+
+    def add(self, packet, offset: int, system_time: float, monotonic_ns: int):
+        device_t = -1
+        device_offset = offset
+        time_high = evt3.first_time_high(packet)
+        if time_high is not None:
+            index, value = time_high
+            # overflows are counted from the system clock if the monotonic
+            # time is unknown
+            clock_ns = monotonic_ns if monotonic_ns >= 0 else round(system_time * 1e9)
+            if self.previous is not None:
+                self.overflows += evt3.unwrap_time_high(
+                    value,
+                    self.previous[0],
+                    (clock_ns - self.previous[1]) / 1e9,
+                )
+            self.previous = (value, clock_ns)
+            device_t = self.overflows * evt3.TIME_HIGH_PERIOD + value
+            device_offset = offset + index * 2
+        self.append((offset, system_time, monotonic_ns, device_t, device_offset))
+        self.next_time = system_time + self.interval
+
+
+def index_path(raw_path: pathlib.Path) -> pathlib.Path:
+    raw_path = pathlib.Path(raw_path)
+    name = raw_path.name
+    for extension in segment_compressor.EXTENSIONS.values():
+        name = name.removesuffix(extension)
+    return raw_path.with_name(name.replace("_events.raw", INDEX_SUFFIX))
+
+
+def read_index(path) -> np.ndarray:
+    return read_records(path)
+
+
+def index_from_samples(
+    raw_path: pathlib.Path,
+    samples: np.ndarray,
+    interval: float = 0.1,
+) -> pathlib.Path:
+    """
+    Builds the seek index of a recording made before the recorders wrote one,
+    from its samples (see evk4_samples.read_samples). Monotonic times are not
+    known for these recordings and are set to -1.
+    """
+    raw_path = pathlib.Path(raw_path)
+    target = index_path(raw_path)
+    with SeekIndexWriter(target, interval=interval) as index:
+        if len(samples) == 0 or raw_path.stat().st_size == 0:
+            return target
+        system_time = np.where(
+            np.isnan(samples["ring_system_time"]),
+            samples["system_time"],
+            samples["ring_system_time"],
+        )
+        ends = samples["events_cursor"].astype(np.int64)
+        starts = np.concatenate(([0], ends[:-1]))
+        # first packet of every interval
+        bucket = np.floor((system_time - system_time[0]) / interval)
+        positions = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+        with open(raw_path, "rb") as raw, mmap.mmap(
+            raw.fileno(), 0, access=mmap.ACCESS_READ
+        ) as events:
+            for position in positions:
+                start, end = int(starts[position]), int(ends[position])
+                if end > start:
+                    index.add(
+                        memoryview(events)[start:end],
+                        start,
+                        float(system_time[position]),
+                        -1,
+                    )
+    return target
+
+
+def byte_range(index: np.ndarray, start, end, clock: str = "system") -> tuple[int, int]:
+    """
+    Returns (first, last) byte offsets of a range of the events file that
+    contains every packet between start and end. Times are in the clock's
+    unit: seconds for "system", nanoseconds for "monotonic" and microseconds
+    for "device". last is None if the range extends to the end of the file.
+    """
+    if clock == "system":
+        times, offsets = index["system_time"], index["offset"]
+    elif clock == "monotonic":
+        valid = index[index["monotonic_ns"] >= 0]
+        times, offsets = valid["monotonic_ns"], valid["offset"]
+    elif clock == "device":
+        valid = index[index["device_t"] >= 0]
+        times, offsets = valid["device_t"], valid["device_offset"]
+    else:
+        raise ValueError(f'unknown clock "{clock}" (expected one of {CLOCKS})')
+    first_entry = np.searchsorted(times, start, side="right") - 1
+    last_entry = np.searchsorted(times, end, side="right")
+    first = 0 if first_entry < 0 else int(offsets[first_entry])
+    last = None if last_entry >= len(offsets) else int(offsets[last_entry])
+    return first, last
+
+
+def read_window(raw_path: pathlib.Path, start, end, clock: str = "system", index=None):
+    """
+    Memory-maps the events file and returns a memoryview of the bytes between
+    start and end (see byte_range). Compressed events files are read with
+    segment_compressor.SeekableReader.
+    """
+    if index is None:
+        index = read_index(index_path(raw_path))
+    first, last = byte_range(index, start, end, clock)
+    raw_path = segment_compressor.compressed_path(raw_path)
+    if raw_path.suffix in segment_compressor.EXTENSIONS.values():
+        with segment_compressor.SeekableReader(raw_path) as reader:
+            return memoryview(reader.read(first, None if last is None else last - first))
+    with open(raw_path, "rb") as raw:
+        if pathlib.Path(raw_path).stat().st_size == 0:
+            return memoryview(b"")
+        events = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+    # the view keeps the mapping alive
+    return memoryview(events)[first:last]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract a time window from an EVK4 _events.raw file using its seek index",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("raw", help="Path of the _events.raw file")
+    parser.add_argument("--start", type=float, default=float("-inf"), help="Start of the window in seconds")
+    parser.add_argument("--end", type=float, default=float("inf"), help="End of the window in seconds")
+    parser.add_argument("--clock", default="system", choices=CLOCKS, help="Clock of --start and --end")
+    parser.add_argument(
+        "--relative",
+        action="store_true",
+        help="Measure --start and --end from the first entry of the index",
+    )
+    parser.add_argument("--output", help="Path of the extracted clip (prints the byte range if omitted)")
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help="Build the index from the samples file of a recording made without one",
+    )
+    parser.add_argument("--interval", type=float, default=0.1, help="Index interval in seconds (--build only)")
+    args = parser.parse_args()
+
+    raw_path = pathlib.Path(args.raw)
+    if args.build:
+        import evk4_samples
+
+        samples_path = raw_path.with_name(
+            raw_path.name.replace("_events.raw", evk4_samples.SAMPLES_SUFFIX)
+        )
+        if not samples_path.exists():
+            samples_path = evk4_samples.convert_jsonl(
+                raw_path.with_name(raw_path.name.replace("_events.raw", "_samples.jsonl"))
+            )
+        index_from_samples(raw_path, evk4_samples.read_samples(samples_path), args.interval)
+    index = read_index(index_path(raw_path))
+    scale = {"system": 1.0, "monotonic": 1e9, "device": 1e6}[args.clock]
+    start, end = args.start * scale, args.end * scale
+    if args.relative:
+        column = {"system": "system_time", "monotonic": "monotonic_ns", "device": "device_t"}[args.clock]
+        valid = index[column][index[column] >= 0]
+        if len(valid) > 0:
+            start += valid[0]
+            end += valid[0]
+    first, last = byte_range(index, start, end, args.clock)
+    if args.output is None:
+        if last is None:
+            source = segment_compressor.compressed_path(raw_path)
+            if source.suffix in segment_compressor.EXTENSIONS.values():
+                with segment_compressor.SeekableReader(source) as reader:
+                    last = reader.size
+            else:
+                last = source.stat().st_size
+        print(f"{first} {last}")
+    else:
+        window = read_window(raw_path, start, end, args.clock, index=index)
+        with open(args.output, "wb") as output:
+            output.write(window)
+        print(f"Wrote {len(window)} bytes to {args.output}")
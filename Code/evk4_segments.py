@@ -0,0 +1,178 @@
+"""Gapless segment rotation for EVK4 recordings.
+
+SegmentRotator has the same interface as evk4_writer.RecordingFiles but splits
+the stream into segments while the device stays open. The files of the next
+segment are opened ahead of time on a helper thread, so a rotation only swaps
+file objects between two packets. Closing the previous segment, renaming the
+new one and preparing the one after that also happen on the helper thread.
+
+Each segment's metadata records where it sits in the continuous stream:
+"stream_start_byte" is the number of bytes recorded before the segment's first
+byte and "previous_events_cursor" is the final events_cursor of the previous
+segment (events_cursor restarts at zero in every segment).
+"""
+
+import concurrent.futures
+import datetime
+import json
+import pathlib
+import time
+
+from evk4_writer import RecordingFiles
+from storage_writer import StorageOptions
+
+
+def timestamp_name() -> str:
+    return (
+        datetime.datetime.now(tz=datetime.timezone.utc)
+        .isoformat()
+        .replace("+00:00", "Z")
+        .replace(":", "-")
+    )
+
+
+class SegmentRotator:
+    def __init__(
+        self,
+        output_directory: pathlib.Path,
+        metadata: dict,
+        duration: float = 300.0,
+        size: int = 0,
+        samples_format: str = "binary",
+        index_interval: float = 0.1,
+        storage: StorageOptions = None,
+    ):
+        """
+        duration (seconds) and size (bytes of events) are the rotation
+        thresholds, 0 disables a threshold. storage is passed to every
+        segment's RecordingFiles.
+        """
+        self.output_directory = output_directory
+        self.samples_format = samples_format
+        self.index_interval = index_interval
+        self.storage = storage
+        self.metadata = metadata
+        self.duration = int(round(duration * 1e9))
+        self.size = size
+        self.stream_cursor = 0
+        self.index = 0
+        self.previous = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="segments"
+        )
+        self.current = self._open_pending(self.index)
+        self._start_segment(self.current, synchronous=True)
+        self.pending = self.executor.submit(self._open_pending, self.index + 1)
+
+    @property
+    def name(self) -> str:
+        return self.current.name
+
+    @property
+    def events_cursor(self) -> int:
+        return self.current.events_cursor
+
+    def _open_pending(self, index: int) -> RecordingFiles:
+        return RecordingFiles(
+            self.output_directory,
+            f".pending_{index}",
+            samples_format=self.samples_format,
+            index_interval=self.index_interval,
+            storage=self.storage,
+        )
+
+    def _start_segment(self, files: RecordingFiles, synchronous: bool = False):
+        name = timestamp_name()
+        if self.previous is not None and name <= self.previous["name"]:
+            name = f"{self.previous['name']}_{self.index}"
+        self.segment = {
+            "name": name,
+            "index": self.index,
+            "stream_start_byte": self.stream_cursor,
+            "start_system_time": time.time(),
+            "start_monotonic_ns": time.monotonic_ns(),
+            "previous": None if self.previous is None else self.previous["name"],
+            "previous_events_cursor": (
+                None if self.previous is None else self.previous["end_events_cursor"]
+            ),
+        }
+        self.segment_end = self.segment["start_monotonic_ns"] + self.duration
+        if synchronous:
+            self._finish_start(files, dict(self.segment))
+        else:
+            self.executor.submit(self._finish_start, files, dict(self.segment))
+
+    def _finish_start(self, files: RecordingFiles, segment: dict):
+        files.rename(segment["name"])
+        self._write_metadata(segment, closed=False)
+        print(f"Started Recording {files.path('_events.raw')}", flush=True)
+
+    def _finish_segment(self, files: RecordingFiles, segment: dict):
+        files.close()
+        self._write_metadata(segment, closed=True)
+        print(f"Finished Recording {files.path('_events.raw')}", flush=True)
+
+    def _write_metadata(self, segment: dict, closed: bool):
+        with open(
+            self.output_directory / f"{segment['name']}_metadata.json", "w"
+        ) as json_file:
+            json.dump(
+                {
+                    "system_time": segment["start_system_time"],
+                    **self.metadata,
+                    "segment": segment,
+                    "closed": closed,
+                },
+                json_file,
+                indent=4,
+            )
+
+    def due(self) -> bool:
+        if self.duration > 0 and time.monotonic_ns() >= self.segment_end:
+            return True
+        return self.size > 0 and self.current.events_cursor >= self.size
+
+    def rotate(self):
+        previous_files = self.current
+        self.previous = dict(
+            self.segment,
+            end_events_cursor=previous_files.events_cursor,
+            end_system_time=time.time(),
+        )
+        self.current = self.pending.result()
+        self.index += 1
+        self._start_segment(self.current)
+        self.executor.submit(self._finish_segment, previous_files, self.previous)
+        self.pending = self.executor.submit(self._open_pending, self.index + 1)
+
+    def write_packets(self, data, statuses):
+        if self.due():
+            self.rotate()
+        self.current.write_packets(data, statuses)
+        self.stream_cursor += len(data)
+
+    def write_measurement(self, measurement_dict: dict):
+        self.current.write_measurement(measurement_dict)
+
+    def flush(self):
+        self.current.flush()
+
+    def close(self):
+        self.previous = dict(
+            self.segment,
+            end_events_cursor=self.current.events_cursor,
+            end_system_time=time.time(),
+        )
+        self.executor.submit(self._finish_segment, self.current, self.previous)
+        pending = self.pending.result()
+        pending.close()
+        for suffix in pending.suffixes:
+            pending.path(suffix).unlink()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,376 @@
+"""Output files and threaded writer for EVK4 raw recordings.
+
+RecordingFiles owns the files written for each recording (events, samples,
+measurements and the seek index). The events file is written by a
+storage_writer.StorageWriter. PacketRing and RingWriter decouple the USB reader from disk
+writes: the reader copies each packet into a bounded ring of preallocated
+buffers and returns to the device immediately, while the writer thread drains
+full buffers with one large write each.
+
+BackpressureFlag lets background jobs (see segment_compressor.py) back off
+while the ring is filling up.
+"""
+
+import contextlib
+import dataclasses
+import json
+import os
+import pathlib
+import queue
+import threading
+import time
+
+from evk4_samples import SAMPLES_SUFFIX, SamplesWriter
+from evk4_seek import INDEX_SUFFIX, SeekIndexWriter
+from storage_writer import StorageOptions
+
+
+class RecordingFiles:
+    def __init__(
+        self,
+        output_directory: pathlib.Path,
+        name: str,
+        samples_format: str = "binary",
+        index_interval: float = 0.1,
+        storage: StorageOptions = None,
+    ):
+        """
+        samples_format is either "binary" (fixed-width records, see
+        evk4_samples.py) or "jsonl" (one JSON status per line).
+        index_interval is the interval in seconds between seek index
+        entries (see evk4_seek.py), 0 disables the index.
+        storage configures the events file writer (see storage_writer.py),
+        the other files are synced along with it.
+        """
+        if samples_format not in ("binary", "jsonl"):
+            raise ValueError(f'unknown samples format "{samples_format}"')
+        self.output_directory = output_directory
+        self.name = name
+        self.binary_samples = samples_format == "binary"
+        self.suffixes = (
+            "_events.raw",
+            SAMPLES_SUFFIX if self.binary_samples else "_samples.jsonl",
+            "_measurements.jsonl",
+        ) + ((INDEX_SUFFIX,) if index_interval > 0 else ())
+        self.storage = StorageOptions() if storage is None else storage
+        self.events = self.storage.open(self.path(self.suffixes[0]))
+        if self.binary_samples:
+            self.samples = SamplesWriter(self.path(self.suffixes[1]))
+        else:
+            self.samples = open(self.path(self.suffixes[1]), "wb")
+        self.measurements = open(self.path(self.suffixes[2]), "wb")
+        self.index = None
+        if index_interval > 0:
+            self.index = SeekIndexWriter(self.path(INDEX_SUFFIX), interval=index_interval)
+        self.events_cursor = 0
+
+    def path(self, suffix: str) -> pathlib.Path:
+        return self.output_directory / f"{self.name}{suffix}"
+
+    def rename(self, name: str):
+        """
+        Renames the files without closing them, writes keep going to the
+        same file descriptors.
+        """
+        for suffix in self.suffixes:
+            os.rename(self.path(suffix), self.output_directory / f"{name}{suffix}")
+        self.name = name
+
+    def write_packets(self, data, statuses):
+        """
+        Writes a batch of consecutive packets. statuses is a list of
+        (status, end) pairs where end is the offset in data at which the
+        packet reported by status ends.
+        """
+        self.events.write(data)
+        if self.index is not None:
+            self.index.add_packets(data, statuses, self.events_cursor)
+        if self.binary_samples:
+            for status, end in statuses:
+                self.samples.append_status(status, self.events_cursor + end)
+            self.events_cursor += len(data)
+            return
+        for status, end in statuses:
+            status_dict = dataclasses.asdict(status)
+            status_dict["events_cursor"] = self.events_cursor + end
+            self.samples.write(f"{json.dumps(status_dict)}\n".encode())
+        self.events_cursor += len(data)
+
+    def write_measurement(self, measurement_dict: dict):
+        self.measurements.write(f"{json.dumps(measurement_dict)}\n".encode())
+
+    def _sidecars(self):
+        files = [
+            self.samples.file if self.binary_samples else self.samples,
+            self.measurements,
+        ]
+        if self.index is not None:
+            files.append(self.index.file)
+        return files
+
+    def flush(self):
+        synced = self.events.flush()
+        self.samples.flush()
+        self.measurements.flush()
+        if self.index is not None:
+            self.index.flush()
+        if synced:
+            for file in self._sidecars():
+                os.fdatasync(file.fileno())
+
+    def close(self):
+        """
+        Flushes (and unless durability is "none", syncs) the sidecars, then
+        closes the events file last. Every file is closed even if flushing
+        or closing another one fails.
+        """
+        with contextlib.ExitStack() as stack:
+            # callbacks run in reverse order, the events file is closed last
+            stack.callback(self.events.close)
+            stack.callback(self.samples.close)
+            stack.callback(self.measurements.close)
+            if self.index is not None:
+                stack.callback(self.index.close)
+            self.flush()
+            if self.storage.durability != "none":
+                for file in self._sidecars():
+                    os.fdatasync(file.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
+
+
+@dataclasses.dataclass
+class WriterStats:
+    slots: int
+    slot_size: int
+    packets: int = 0
+    dropped_packets: int = 0
+    dropped_bytes: int = 0
+    high_water: int = 0
+    writes: int = 0
+    bytes_written: int = 0
+    stalls: int = 0
+    longest_write: float = 0.0
+
+    def summary(self) -> str:
+        return (
+            f"packets={self.packets} written={self.bytes_written}B "
+            f"dropped={self.dropped_packets} packets/{self.dropped_bytes}B "
+            f"high_water={self.high_water}/{self.slots} slots "
+            f"stalls={self.stalls} longest_write={self.longest_write:.3f}s"
+        )
+
+
+class Slot:
+    __slots__ = ("data", "used", "statuses", "external")
+
+    def __init__(self, size: int):
+        self.data = bytearray(size)
+        self.used = 0
+        self.statuses = []
+        # packets larger than a slot are passed through without copying
+        self.external = None
+
+    def view(self):
+        if self.external is not None:
+            return self.external
+        return memoryview(self.data)[: self.used]
+
+    def reset(self):
+        self.used = 0
+        self.statuses = []
+        self.external = None
+
+
+class PacketRing:
+    """
+    Bounded ring of preallocated packet buffers.
+
+    put is called from the device thread and never blocks: when every slot is
+    waiting for the writer the packet is dropped and counted in stats.
+    """
+
+    def __init__(self, slots: int = 16, slot_size: int = 1 << 22, publish_interval: float = 0.5):
+        if slots < 2:
+            raise ValueError("the ring needs at least two slots")
+        self.slot_size = slot_size
+        self.publish_interval = int(round(publish_interval * 1e9))
+        self.stats = WriterStats(slots=slots, slot_size=slot_size)
+        self.free = queue.SimpleQueue()
+        self.ready = queue.SimpleQueue()
+        for _ in range(slots):
+            self.free.put(Slot(slot_size))
+        self.current = None
+        self.next_publish = time.monotonic_ns() + self.publish_interval
+
+    def occupancy(self) -> int:
+        return self.stats.slots - self.free.qsize()
+
+    def _acquire(self):
+        try:
+            self.current = self.free.get_nowait()
+        except queue.Empty:
+            self.current = None
+        return self.current
+
+    def publish(self):
+        if self.current is not None and self.current.used > 0:
+            self.ready.put(self.current)
+            self.current = None
+        self.next_publish = time.monotonic_ns() + self.publish_interval
+
+    def put(self, status, packet) -> bool:
+        size = len(packet)
+        self.stats.packets += 1
+        slot = self.current
+        if slot is not None and slot.used + size > self.slot_size:
+            self.publish()
+            slot = None
+        if slot is None:
+            slot = self._acquire()
+            if slot is None:
+                self.stats.dropped_packets += 1
+                self.stats.dropped_bytes += size
+                return False
+            occupancy = self.occupancy()
+            if occupancy > self.stats.high_water:
+                self.stats.high_water = occupancy
+        if size > self.slot_size:
+            slot.external = packet
+            slot.statuses.append((status, size))
+            slot.used = size
+            self.publish()
+            return True
+        slot.data[slot.used : slot.used + size] = packet
+        slot.used += size
+        slot.statuses.append((status, slot.used))
+        if time.monotonic_ns() >= self.next_publish:
+            self.publish()
+        return True
+
+    def release(self, slot: Slot):
+        slot.reset()
+        self.free.put(slot)
+
+    def close(self):
+        self.publish()
+        self.ready.put(None)
+
+
+class BackpressureFlag:
+    """
+    Flag file that exists while a recorder is falling behind.
+
+    The file is touched every time the flag is set so that readers can ignore
+    flags left behind by recorders that did not exit cleanly.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.active = False
+        self.clear()
+
+    def set(self):
+        self.path.touch()
+        self.active = True
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+        self.active = False
+
+    def update(self, occupancy: int, slots: int, high: float = 0.5, low: float = 0.25):
+        """
+        Sets the flag when occupancy reaches high * slots and clears it when
+        occupancy drops to low * slots.
+        """
+        if occupancy >= high * slots:
+            self.set()
+        elif self.active and occupancy <= low * slots:
+            self.clear()
+
+
+class RingWriter(threading.Thread):
+    """
+    Drains a PacketRing into RecordingFiles.
+
+    A write or flush that takes longer than stall_threshold seconds is counted
+    as a stall. A summary of the ring statistics is printed every
+    report_interval seconds. If backpressure is not None, it is updated with
+    the ring occupancy after every write. If measurements is not None (see
+    evk4_measurements.MeasurementSampler), its queued measurements are
+    written after every write.
+    """
+
+    def __init__(
+        self,
+        ring: PacketRing,
+        files: RecordingFiles,
+        flush_interval: float = 0.5,
+        stall_threshold: float = 0.1,
+        report_interval: float = 60.0,
+        backpressure: BackpressureFlag = None,
+        measurements=None,
+    ):
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.files = files
+        self.flush_interval = flush_interval
+        self.stall_threshold = stall_threshold
+        self.report_interval = report_interval
+        self.backpressure = backpressure
+        self.measurements = measurements
+        self.error = None
+
+    def _write_measurements(self):
+        if self.measurements is not None:
+            for measurement_dict in self.measurements.drain():
+                self.files.write_measurement(measurement_dict)
+
+    def _timed(self, function, *args):
+        start = time.monotonic()
+        function(*args)
+        duration = time.monotonic() - start
+        stats = self.ring.stats
+        if duration > stats.longest_write:
+            stats.longest_write = duration
+        if duration >= self.stall_threshold:
+            stats.stalls += 1
+
+    def run(self):
+        stats = self.ring.stats
+        next_flush = time.monotonic() + self.flush_interval
+        next_report = time.monotonic() + self.report_interval
+        try:
+            while True:
+                slot = self.ring.ready.get()
+                if slot is None:
+                    break
+                data = slot.view()
+                self._timed(self.files.write_packets, data, slot.statuses)
+                stats.writes += 1
+                stats.bytes_written += len(data)
+                self.ring.release(slot)
+                if self.backpressure is not None:
+                    self.backpressure.update(self.ring.occupancy(), stats.slots)
+                self._write_measurements()
+                now = time.monotonic()
+                if now >= next_flush:
+                    self._timed(self.files.flush)
+                    next_flush = time.monotonic() + self.flush_interval
+                if now >= next_report:
+                    print(f"Writer {self.files.name}: {stats.summary()}", flush=True)
+                    next_report = now + self.report_interval
+            self._write_measurements()
+            self.files.flush()
+            if self.backpressure is not None:
+                self.backpressure.clear()
+        except Exception as error:
+            # the reader checks this to stop recording instead of silently
+            # dropping every packet once the ring fills up
+            self.error = error
+            raise
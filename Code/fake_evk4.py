@@ -0,0 +1,418 @@
+"""Stand-in for neuromorphic_drivers EVK4 devices.
+
+FakeDevice has the parts of the neuromorphic_drivers device interface used by
+the recorders and the event viewer (context manager, properties,
+temperature_celsius, illuminance, serial and packet iteration). It either
+replays an existing _events.raw recording (compressed recordings work too) or
+generates synthetic EVT3 at a given event rate. Packets are produced in real
+time, at N times real time, or as fast as possible (speed 0).
+
+A recording is replayed with the packet boundaries and timings of its binary
+samples file (compressed or not) if it has one, otherwise in fixed-size chunks
+timed with the TIME_HIGH words they contain (_samples.jsonl files are not
+read, convert them with evk4_samples.py). Replays loop back to the start of
+the file.
+
+The EVK4 scripts select the fake with --fake or the DAEDALUS_FAKE_EVK4
+environment variable, whose value is either "synthetic" or the path of an
+_events.raw file:
+
+    DAEDALUS_FAKE_EVK4=synthetic DAEDALUS_FAKE_EVK4_RATE=20e6 python3 record_raw_evk4_w_temp_and_illum_intervals.py --writer-thread 00000000
+    python3 eventviewer_server.py --fake recordings/evk4_00050420/2024-07-01T00-00-00Z_events.raw --fake-speed 4 00050420
+"""
+
+import argparse
+import dataclasses
+import math
+import mmap
+import os
+import pathlib
+import time
+import typing
+
+import numpy as np
+
+import evt3
+import segment_compressor
+
+ENVIRONMENT_VARIABLE = "DAEDALUS_FAKE_EVK4"
+SPEED_ENVIRONMENT_VARIABLE = "DAEDALUS_FAKE_EVK4_SPEED"
+RATE_ENVIRONMENT_VARIABLE = "DAEDALUS_FAKE_EVK4_RATE"
+
+TRIGGER_DTYPE = np.dtype([("t", "<u8"), ("id", "u1"), ("rising", "?")])
+
+
+# same fields as neuromorphic_drivers' statuses and properties
+@dataclasses.dataclass
+class Properties:
+    width: int = 1280
+    height: int = 720
+
+
+@dataclasses.dataclass
+class RawRingStatus:
+    system_time: float
+    backlog: int
+    raw_packets: int
+    clutch_engaged: bool
+    overflow_indices: typing.Optional[list[int]]
+
+
+@dataclasses.dataclass
+class RawStatus:
+    system_time: float
+    ring: typing.Optional[RawRingStatus]
+
+    def delay(self) -> typing.Optional[float]:
+        if self.ring is None:
+            return None
+        return self.system_time - self.ring.system_time
+
+
+@dataclasses.dataclass
+class RingStatus:
+    system_time: float
+    backlog: int
+    raw_packets: int
+    clutch_engaged: bool
+    current_t: int
+
+
+@dataclasses.dataclass
+class Status:
+    system_time: float
+    ring: typing.Optional[RingStatus]
+
+    def delay(self) -> typing.Optional[float]:
+        if self.ring is None:
+            return None
+        return self.system_time - self.ring.system_time
+
+
+class SyntheticSource:
+    """
+    Generates EVT3 packets with uniformly distributed events.
+
+    Every event is encoded as TIME_LOW, ADDR_Y and ADDR_X words, with a
+    TIME_HIGH word whenever the upper timestamp bits change.
+    """
+
+    def __init__(
+        self,
+        rate: float = 1e6,
+        packet_duration: float = 0.001,
+        properties: Properties = None,
+        seed: int = 0,
+    ):
+        if properties is None:
+            properties = Properties()
+        self.events_per_packet = max(1, round(rate * packet_duration))
+        self.packet_duration = max(1, round(packet_duration * 1e6))
+        generator = np.random.default_rng(seed)
+        # random addresses are generated once and reused cyclically
+        pool = max(1 << 20, self.events_per_packet)
+        self.y_words = (evt3.EVT_ADDR_Y << 12) | generator.integers(
+            0, properties.height, pool, dtype=np.uint16
+        )
+        self.x_words = (
+            (evt3.EVT_ADDR_X << 12)
+            | (generator.integers(0, 2, pool, dtype=np.uint16) << 11)
+            | generator.integers(0, properties.width, pool, dtype=np.uint16)
+        )
+        self.position = 0
+        self.t = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple[float, bytes]:
+        """
+        Returns the packet time in seconds from the start of the stream and
+        the packet.
+        """
+        count = self.events_per_packet
+        if self.position + count > len(self.y_words):
+            self.position = 0
+        ts = self.t + (np.arange(count, dtype=np.uint64) * self.packet_duration) // count
+        time_highs = (ts >> 12) & 0xFFF
+        words = np.empty((count, 4), dtype="<u2")
+        words[:, 0] = (evt3.EVT_TIME_HIGH << 12) | time_highs
+        words[:, 1] = (evt3.EVT_TIME_LOW << 12) | (ts & 0xFFF)
+        words[:, 2] = self.y_words[self.position : self.position + count]
+        words[:, 3] = self.x_words[self.position : self.position + count]
+        keep = np.ones((count, 4), dtype=bool)
+        keep[1:, 0] = time_highs[1:] != time_highs[:-1]
+        self.position += count
+        self.t += self.packet_duration
+        return self.t / 1e6, words[keep].tobytes()
+
+
+class ReplaySource:
+    """
+    Reads the packets of an _events.raw recording, looping at the end.
+    """
+
+    def __init__(self, path: pathlib.Path, chunk_size: int = 1 << 16, loop: bool = True):
+        path = pathlib.Path(path)
+        self.reader = None
+        source = segment_compressor.compressed_path(path)
+        if source.suffix in segment_compressor.EXTENSIONS.values():
+            self.reader = segment_compressor.SeekableReader(source)
+            self.data = None
+            size = self.reader.size
+        else:
+            size = source.stat().st_size
+            if size == 0:
+                raise ValueError(f"{path} is empty")
+            with open(source, "rb") as file:
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if size == 0:
+            raise ValueError(f"{path} is empty")
+        self.loop = loop
+        self.boundaries, self.times = self._samples(path, size)
+        if self.boundaries is None:
+            self.boundaries = np.append(np.arange(0, size, chunk_size), size)
+            self.times = None
+        self.index = 0
+        self.offset = 0.0
+        self.last_time = 0.0
+        self.first = 0
+        self.time_high = None
+        self.overflows = 0
+
+    @staticmethod
+    def _samples(path: pathlib.Path, size: int):
+        import evk4_samples
+
+        samples_path = path.with_name(path.name.replace("_events.raw", evk4_samples.SAMPLES_SUFFIX))
+        if samples_path == path or not segment_compressor.compressed_path(samples_path).exists():
+            return None, None
+        samples = evk4_samples.read_samples(samples_path)
+        samples = samples[(samples["events_cursor"] > 0) & (samples["events_cursor"] <= size)]
+        if len(samples) == 0:
+            return None, None
+        times = np.where(
+            np.isnan(samples["ring_system_time"]),
+            samples["system_time"],
+            samples["ring_system_time"],
+        )
+        boundaries = np.concatenate(([0], samples["events_cursor"].astype(np.int64)))
+        return boundaries, times - times[0]
+
+    def _read(self, start: int, end: int) -> bytes:
+        if self.reader is not None:
+            return self.reader.read(start, end - start)
+        return self.data[start:end]
+
+    def _time(self, packet: bytes) -> typing.Optional[float]:
+        # time of the last TIME_HIGH word, for recordings without samples
+        words = np.frombuffer(packet, dtype="<u2", count=len(packet) // 2)
+        time_highs = words[(words >> 12) == evt3.EVT_TIME_HIGH]
+        if len(time_highs) == 0:
+            return None
+        value = int(time_highs[-1] & 0xFFF) << 12
+        if self.time_high is None:
+            self.first = value
+        elif value < self.time_high:
+            self.overflows += 1
+        self.time_high = value
+        return (self.overflows * evt3.TIME_HIGH_PERIOD + value - self.first) / 1e6
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple[float, bytes]:
+        if self.index == len(self.boundaries) - 1:
+            if not self.loop:
+                raise StopIteration()
+            self.offset = self.last_time
+            self.index = 0
+            self.time_high = None
+            self.overflows = 0
+        packet = self._read(int(self.boundaries[self.index]), int(self.boundaries[self.index + 1]))
+        if self.times is None:
+            packet_time = self._time(packet)
+            packet_time = self.last_time if packet_time is None else self.offset + packet_time
+        else:
+            packet_time = self.offset + float(self.times[self.index])
+        self.last_time = packet_time
+        self.index += 1
+        return packet_time, packet
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        else:
+            self.data.close()
+
+
+class FakeDevice:
+    def __init__(
+        self,
+        source: str = "synthetic",
+        speed: float = 1.0,
+        rate: float = 1e6,
+        raw: bool = False,
+        serial: str = None,
+        configuration=None,
+    ):
+        """
+        source is either "synthetic" or the path of an _events.raw file.
+        speed is the replay speed relative to real time, 0 means as fast as
+        possible. rate is the event rate of synthetic sources in events per
+        second.
+        """
+        self.properties_ = Properties()
+        if source == "synthetic":
+            self.source = SyntheticSource(rate=rate, properties=self.properties_)
+        else:
+            self.source = ReplaySource(pathlib.Path(source))
+        self.speed = speed
+        self.raw = raw
+        self.serial_ = "00000000" if serial is None else serial
+        self.configuration = configuration
+        self.decoder = None if raw else evt3.Decoder()
+        self.start = None
+        self.start_time = time.time()
+        self.packets = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if isinstance(self.source, ReplaySource):
+            self.source.close()
+
+    def properties(self) -> Properties:
+        return self.properties_
+
+    def serial(self) -> str:
+        return self.serial_
+
+    def backlog(self) -> int:
+        return 0
+
+    def update_configuration(self, configuration):
+        self.configuration = configuration
+
+    def temperature_celsius(self) -> float:
+        return 35.0 + 2.0 * math.sin((time.time() - self.start_time) / 600.0)
+
+    def illuminance(self) -> int:
+        return round(200.0 + 100.0 * math.sin((time.time() - self.start_time) / 60.0))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        packet_time, packet = next(self.source)
+        if self.start is None:
+            self.start = time.monotonic() - packet_time / self.speed if self.speed > 0 else 0.0
+        if self.speed > 0:
+            delay = self.start + packet_time / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.packets += 1
+        system_time = time.time()
+        if self.raw:
+            return (
+                RawStatus(
+                    system_time=system_time,
+                    ring=RawRingStatus(
+                        system_time=system_time,
+                        backlog=0,
+                        raw_packets=self.packets,
+                        clutch_engaged=False,
+                        overflow_indices=None,
+                    ),
+                ),
+                packet,
+            )
+        events = self.decoder.decode(packet)
+        return (
+            Status(
+                system_time=system_time,
+                ring=RingStatus(
+                    system_time=system_time,
+                    backlog=0,
+                    raw_packets=self.packets,
+                    clutch_engaged=False,
+                    current_t=int(events["t"][-1]) if len(events) > 0 else 0,
+                ),
+            ),
+            {
+                "dvs_events": events,
+                "trigger_events": np.zeros(0, dtype=TRIGGER_DTYPE),
+            },
+        )
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the options that select a fake device, their defaults come from the
+    environment.
+    """
+    parser.add_argument(
+        "--fake",
+        default=os.environ.get(ENVIRONMENT_VARIABLE),
+        help=f'Use a fake camera instead of the EVK4, "synthetic" or the path of an _events.raw file to replay (defaults to ${ENVIRONMENT_VARIABLE})',
+    )
+    parser.add_argument(
+        "--fake-speed",
+        default=float(os.environ.get(SPEED_ENVIRONMENT_VARIABLE, 1.0)),
+        type=float,
+        help=f"Speed of the fake camera relative to real time, 0 means as fast as possible (defaults to ${SPEED_ENVIRONMENT_VARIABLE} or 1)",
+    )
+    parser.add_argument(
+        "--fake-rate",
+        default=float(os.environ.get(RATE_ENVIRONMENT_VARIABLE, 1e6)),
+        type=float,
+        help=f"Event rate of the synthetic fake camera in events per second (defaults to ${RATE_ENVIRONMENT_VARIABLE} or 1e6)",
+    )
+
+
+def open_device(args: argparse.Namespace, **kwargs):
+    """
+    Returns a FakeDevice if args.fake is set, otherwise the device returned by
+    neuromorphic_drivers.open(**kwargs).
+    """
+    if args.fake:
+        return FakeDevice(
+            source=args.fake,
+            speed=args.fake_speed,
+            rate=args.fake_rate,
+            raw=kwargs.get("raw", False),
+            serial=kwargs.get("serial"),
+            configuration=kwargs.get("configuration"),
+        )
+    import neuromorphic_drivers as nd
+
+    return nd.open(**kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the packet rate of a fake EVK4",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--duration", default=10.0, type=float, help="Duration of the measurement in seconds")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if not args.fake:
+        args.fake = "synthetic"
+
+    with open_device(args, raw=True) as device:
+        begin = time.monotonic()
+        packets = 0
+        size = 0
+        for status, packet in device:
+            packets += 1
+            size += len(packet)
+            if time.monotonic() - begin >= args.duration:
+                break
+    duration = time.monotonic() - begin
+    print(f"{packets} packets, {size / duration / 1e6:.1f} MB/s")
@@ -0,0 +1,168 @@
+"""Pre-trigger frame ring for the Pi cameras.
+
+FrameRing keeps the latest camera frames in a ring of preallocated NumPy
+arrays. The ring is allocated once, on the first frame, with as many slots
+as the requested duration needs or as fit in the memory cap (whichever is
+smaller), so its memory use does not change however long the camera runs.
+
+When a trigger arrives, the controller keeps filling the ring for the
+post-trigger window. It then freezes the ring and write_burst() dumps the
+frames of the window on a helper thread. Frames that arrive during the dump
+are not kept. A burst is written as two files:
+
+    cam_<N>_burst_<timestr>.npy    frames, shape (frames, height, width, channels)
+    cam_<N>_burst_<timestr>.json   trigger, per-frame timestamps and stream format
+
+Triggers are SIGUSR1 (supervisorctl signal USR1 <program>) or a datagram on
+the controller's Unix socket, whose content is recorded as the trigger source,
+for instance from a script that watches the EVK4 event rate:
+
+    python3 frame_ring.py /tmp/daedalus_camera_0.sock "event rate above 5e6"
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+
+import numpy as np
+
+
+class FrameRing:
+    def __init__(self, frames: int, memory_cap: int):
+        """
+        frames is the number of frames needed to cover the pre-trigger and
+        post-trigger windows, memory_cap is in bytes.
+        """
+        self.frames = frames
+        self.memory_cap = memory_cap
+        self.buffer = None
+        self.count = 0
+        self.frozen = False
+
+    def _allocate(self, frame: np.ndarray):
+        slots = min(self.frames, self.memory_cap // frame.nbytes)
+        if slots < 1:
+            raise ValueError(f"a {frame.shape} frame does not fit in {self.memory_cap} bytes")
+        self.buffer = np.empty((slots,) + frame.shape, dtype=frame.dtype)
+        self.sensor_timestamps = np.zeros(slots, dtype=np.int64)
+        self.times_ns = np.zeros(slots, dtype=np.int64)
+        print(
+            f"Frame ring of {slots} {frame.shape} frames ({self.buffer.nbytes / 1e6:.0f} MB)",
+            flush=True,
+        )
+
+    def put(self, frame: np.ndarray, sensor_timestamp: int, time_ns: int):
+        """
+        Copies the frame into the oldest slot, unless the ring is frozen.
+        sensor_timestamp is the request's SensorTimestamp and time_ns the
+        wall-clock time (time.time_ns()).
+        """
+        if self.frozen:
+            return
+        if self.buffer is None:
+            self._allocate(frame)
+        slot = self.count % len(self.buffer)
+        self.buffer[slot] = frame
+        self.sensor_timestamps[slot] = sensor_timestamp
+        self.times_ns[slot] = time_ns
+        self.count += 1
+
+    def window(self, start: int, end: int) -> list[int]:
+        """
+        Returns the slots of the frames whose sensor timestamps are in
+        [start, end], oldest first.
+        """
+        if self.buffer is None:
+            return []
+        slots = [index % len(self.buffer) for index in range(max(0, self.count - len(self.buffer)), self.count)]
+        return [slot for slot in slots if start <= self.sensor_timestamps[slot] <= end]
+
+
+def write_burst(ring: FrameRing, slots: list[int], path_stem: str, metadata: dict):
+    """
+    Writes the frames of slots to path_stem.npy, one frame at a time (no copy
+    of the burst is made), and their timestamps and metadata to
+    path_stem.json. The ring must be frozen while the burst is written.
+    """
+    with open(f"{path_stem}.npy", "wb") as npy:
+        np.lib.format.write_array_header_1_0(
+            npy,
+            {
+                "descr": np.lib.format.dtype_to_descr(ring.buffer.dtype),
+                "fortran_order": False,
+                "shape": (len(slots),) + ring.buffer.shape[1:],
+            },
+        )
+        for slot in slots:
+            npy.write(ring.buffer[slot].data)
+    with open(f"{path_stem}.json", "w") as f:
+        json.dump(
+            dict(
+                metadata,
+                frames=len(slots),
+                sensor_timestamps=[int(ring.sensor_timestamps[slot]) for slot in slots],
+                times_ns=[int(ring.times_ns[slot]) for slot in slots],
+            ),
+            f,
+        )
+
+
+class BurstDumper:
+    def __init__(self, ring: FrameRing):
+        self.ring = ring
+        self.thread = None
+
+    @property
+    def busy(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def dump(self, slots: list[int], path_stem: str, metadata: dict):
+        """
+        Freezes the ring and writes the burst on a helper thread, the ring
+        is unfrozen once the burst is on disk.
+        """
+        self.ring.frozen = True
+        self.thread = threading.Thread(target=self._dump, args=(slots, path_stem, metadata), daemon=True)
+        self.thread.start()
+
+    def _dump(self, slots, path_stem, metadata):
+        try:
+            write_burst(self.ring, slots, path_stem, metadata)
+            print(f"burst saved to {path_stem}.npy ({len(slots)} frames)", flush=True)
+        except OSError as error:
+            print(f"ERROR: burst could not be saved ({error!r})", flush=True)
+        finally:
+            self.ring.frozen = False
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+def trigger_socket(path: str) -> socket.socket:
+    """
+    Returns a non-blocking Unix datagram socket bound to path, every
+    datagram received is a trigger.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    trigger = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    trigger.bind(path)
+    trigger.setblocking(False)
+    return trigger
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Trigger a burst dump of a camera controller running with --ring",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("socket", help="The controller's --trigger_socket")
+    parser.add_argument("source", nargs="?", default="manual", help="Trigger source recorded in the burst metadata")
+    args = parser.parse_args()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as client:
+        client.sendto(args.source.encode(), args.socket)
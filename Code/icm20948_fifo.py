@@ -0,0 +1,316 @@
+"""FIFO burst reads for the ICM20948 IMU.
+
+Instead of reading the accelerometer, gyro and magnetometer registers for
+every sample, FIFOReader configures the sample rate dividers and the chip's
+FIFO (accelerometer, gyro and the magnetometer data that the chip's I2C
+master copies into EXT_SLV_SENS_DATA, as set up by adafruit_icm20x) and drains
+whole records with one block read.
+
+Records carry no timestamps. The chip writes one record per gyro output data
+rate period, 1100 / (1 + divider) Hz, so sample n is timestamped anchor + n *
+period. The newest record of each read was written before the read, so the
+anchor is moved back whenever a read shows that it is too late, which brings
+it close to the real sample times after a few reads. The anchor is reset
+after a FIFO overflow and when the reconstructed time of the newest sample
+falls behind the read time by more than one period (the age of the newest
+record is only known to within a period) plus max_drift, which bounds the
+effect of the chip's clock tolerance.
+
+Registers are accessed through an object with read(bank, register, length)
+and write(bank, register, value) methods: I2CRegisters for the real chip or
+SimulatedICM20948, a register-level stand-in with a FIFO filled at the
+configured rate, to check the parsing and timing without a board:
+
+    python3 icm20948_fifo.py --rate 1100 --duration 10
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from imu_records import IMU_DTYPE
+
+REG_BANK_SEL = 0x7F
+
+# bank 0
+WHO_AM_I = 0x00
+USER_CTRL = 0x03
+INT_STATUS_2 = 0x1B
+FIFO_EN_1 = 0x66
+FIFO_EN_2 = 0x67
+FIFO_RST = 0x68
+FIFO_MODE = 0x69
+FIFO_COUNTH = 0x70
+FIFO_R_W = 0x72
+
+# bank 2
+GYRO_SMPLRT_DIV = 0x00
+GYRO_CONFIG_1 = 0x01
+ODR_ALIGN_EN = 0x09
+ACCEL_SMPLRT_DIV_1 = 0x10
+ACCEL_SMPLRT_DIV_2 = 0x11
+ACCEL_CONFIG = 0x14
+
+DEVICE_ID = 0xEA
+USER_CTRL_FIFO_EN = 0x40
+FIFO_EN_1_SLV_0 = 0x01
+FIFO_EN_2_ACCEL_GYRO = 0x1E
+FIFO_OVERFLOW = 0x1F
+FIFO_SIZE = 512
+
+GYRO_RATE = 1100.0
+# LSB per g and LSB per degree per second of each full scale setting
+ACCEL_RANGES = {2: 16384.0, 4: 8192.0, 8: 4096.0, 16: 2048.0}
+GYRO_RANGES = {250: 131.0, 500: 65.5, 1000: 32.8, 2000: 16.4}
+STANDARD_GRAVITY = 9.80665
+RADIANS_PER_DEGREE = 0.017453293
+MICROTESLAS_PER_LSB = 0.15
+
+# accelerometer and gyro are big-endian, the AK09916 magnetometer little-endian
+RECORD_DTYPE = np.dtype([("accel", ">i2", (3,)), ("gyro", ">i2", (3,))])
+MAGNETOMETER_RECORD_DTYPE = np.dtype(
+    [("accel", ">i2", (3,)), ("gyro", ">i2", (3,)), ("magnetic", "<i2", (3,)), ("magnetic_status", "u1", (3,))]
+)
+
+
+class I2CRegisters:
+    """
+    Banked register access through an adafruit_bus_device I2CDevice (for
+    instance the i2c_device attribute of an adafruit_icm20x.ICM20948).
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.bank = None
+
+    def _select(self, bank: int):
+        if bank != self.bank:
+            with self.device as device:
+                device.write(bytes((REG_BANK_SEL, bank << 4)))
+            self.bank = bank
+
+    def read(self, bank: int, register: int, length: int) -> bytes:
+        self._select(bank)
+        buffer = bytearray(length)
+        with self.device as device:
+            device.write_then_readinto(bytes((register,)), buffer)
+        return bytes(buffer)
+
+    def write(self, bank: int, register: int, value: int):
+        self._select(bank)
+        with self.device as device:
+            device.write(bytes((register, value)))
+
+
+class SimulatedICM20948:
+    """
+    Register stand-in that fills its FIFO with one record per gyro output
+    data rate period of the clock, like the chip in stream mode: when the
+    FIFO is full the oldest bytes are overwritten and the overflow status is
+    set. clock_error is the relative error of the chip's oscillator.
+
+    Sample n has accelerometer x = n % 32768, which lets the caller check
+    that no record was lost or misaligned.
+    """
+
+    def __init__(self, clock=time.monotonic_ns, clock_error: float = 0.0, fifo_size: int = FIFO_SIZE):
+        self.clock = clock
+        self.clock_error = clock_error
+        self.fifo_size = fifo_size
+        self.registers = [bytearray(128) for _ in range(4)]
+        self.registers[0][WHO_AM_I] = DEVICE_ID
+        self.fifo = bytearray()
+        self.samples = 0
+        self.sample_times = []
+        self.last_tick = None
+
+    def _period(self) -> float:
+        return 1e9 * (1 + self.registers[2][GYRO_SMPLRT_DIV]) / (GYRO_RATE * (1 + self.clock_error))
+
+    def _record(self, index: int) -> bytes:
+        record = np.zeros(1, dtype=MAGNETOMETER_RECORD_DTYPE)
+        record["accel"] = (index % 32768, 100, -4096)
+        record["gyro"] = (-(index % 32768), 10, 0)
+        record["magnetic"] = (200, -100, 300)
+        data = record.tobytes()
+        if not self.registers[0][FIFO_EN_1] & FIFO_EN_1_SLV_0:
+            data = data[: RECORD_DTYPE.itemsize]
+        return data
+
+    def _advance(self):
+        now = self.clock()
+        enabled = self.registers[0][USER_CTRL] & USER_CTRL_FIFO_EN and self.registers[0][FIFO_EN_2]
+        if not enabled or self.last_tick is None:
+            self.last_tick = now
+            return
+        period = self._period()
+        while self.last_tick + period <= now:
+            self.last_tick += period
+            self.fifo += self._record(self.samples)
+            self.sample_times.append(self.last_tick)
+            self.samples += 1
+        if len(self.fifo) > self.fifo_size:
+            del self.fifo[: len(self.fifo) - self.fifo_size]
+            self.registers[0][INT_STATUS_2] |= FIFO_OVERFLOW
+
+    def read(self, bank: int, register: int, length: int) -> bytes:
+        self._advance()
+        if bank == 0 and register == FIFO_COUNTH:
+            return len(self.fifo).to_bytes(2, "big")[:length]
+        if bank == 0 and register == FIFO_R_W:
+            data = bytes(self.fifo[:length])
+            del self.fifo[:length]
+            return data + b"\xff" * (length - len(data))
+        data = bytes(self.registers[bank][register : register + length])
+        if bank == 0 and register == INT_STATUS_2:
+            # cleared on read
+            self.registers[0][INT_STATUS_2] = 0
+        return data
+
+    def write(self, bank: int, register: int, value: int):
+        self._advance()
+        if bank == 0 and register == FIFO_RST and value != 0:
+            self.fifo.clear()
+        self.registers[bank][register] = value
+
+
+class FIFOReader:
+    def __init__(
+        self,
+        registers,
+        rate: float = GYRO_RATE,
+        accel_range: int = 8,
+        gyro_range: int = 500,
+        magnetometer: bool = True,
+        clock=time.monotonic_ns,
+        max_drift: float = 0.005,
+    ):
+        """
+        rate is the requested sample rate in Hz, the output data rate is the
+        lowest 1100 / (1 + divider) at or above it. accel_range is in g,
+        gyro_range in degrees per second and max_drift in seconds.
+        """
+        if accel_range not in ACCEL_RANGES:
+            raise ValueError(f"unsupported accelerometer range {accel_range} (expected one of {list(ACCEL_RANGES)})")
+        if gyro_range not in GYRO_RANGES:
+            raise ValueError(f"unsupported gyro range {gyro_range} (expected one of {list(GYRO_RANGES)})")
+        self.registers = registers
+        self.divider = min(255, max(0, int(GYRO_RATE // rate) - 1))
+        self.rate = GYRO_RATE / (1 + self.divider)
+        self.period = 1e9 / self.rate
+        self.accel_range = accel_range
+        self.gyro_range = gyro_range
+        self.accel_scale = STANDARD_GRAVITY / ACCEL_RANGES[accel_range]
+        self.gyro_scale = RADIANS_PER_DEGREE / GYRO_RANGES[gyro_range]
+        self.magnetometer = magnetometer
+        self.record_dtype = MAGNETOMETER_RECORD_DTYPE if magnetometer else RECORD_DTYPE
+        self.clock = clock
+        self.max_drift = int(max_drift * 1e9)
+        self.anchor_time = None
+        self.anchor_index = 0
+        self.index = 0
+        self.overflows = 0
+        self.reanchors = 0
+
+    def _update(self, bank: int, register: int, mask: int, value: int):
+        current = self.registers.read(bank, register, 1)[0]
+        self.registers.write(bank, register, (current & ~mask) | value)
+
+    def reset_fifo(self):
+        self.registers.write(0, FIFO_RST, 0x1F)
+        self.registers.write(0, FIFO_RST, 0x00)
+        self.anchor_time = None
+
+    def configure(self):
+        # the bank register may have been changed by adafruit_icm20x
+        if isinstance(self.registers, I2CRegisters):
+            self.registers.bank = None
+        self._update(0, USER_CTRL, USER_CTRL_FIFO_EN, 0)
+        self.registers.write(2, GYRO_SMPLRT_DIV, self.divider)
+        self.registers.write(2, ACCEL_SMPLRT_DIV_1, self.divider >> 8)
+        self.registers.write(2, ACCEL_SMPLRT_DIV_2, self.divider & 0xFF)
+        self.registers.write(2, ODR_ALIGN_EN, 1)
+        self._update(2, ACCEL_CONFIG, 0x06, list(ACCEL_RANGES).index(self.accel_range) << 1)
+        self._update(2, GYRO_CONFIG_1, 0x06, list(GYRO_RANGES).index(self.gyro_range) << 1)
+        self.registers.write(0, FIFO_EN_1, FIFO_EN_1_SLV_0 if self.magnetometer else 0)
+        self.registers.write(0, FIFO_EN_2, FIFO_EN_2_ACCEL_GYRO)
+        # stream mode
+        self.registers.write(0, FIFO_MODE, 0)
+        self.reset_fifo()
+        self._update(0, USER_CTRL, USER_CTRL_FIFO_EN, USER_CTRL_FIFO_EN)
+
+    def read(self) -> np.ndarray:
+        """
+        Drains the complete records in the FIFO and returns them as IMU_DTYPE
+        records (see imu_records.py) with reconstructed timestamps.
+        """
+        now = self.clock()
+        if self.registers.read(0, INT_STATUS_2, 1)[0] & FIFO_OVERFLOW:
+            # the oldest records were overwritten, the FIFO may not start on a record boundary
+            self.overflows += 1
+            self.reset_fifo()
+            return np.zeros(0, dtype=IMU_DTYPE)
+        count = int.from_bytes(self.registers.read(0, FIFO_COUNTH, 2), "big") & 0x1FFF
+        length = count // self.record_dtype.itemsize
+        if length == 0:
+            return np.zeros(0, dtype=IMU_DTYPE)
+        raw = np.frombuffer(
+            self.registers.read(0, FIFO_R_W, length * self.record_dtype.itemsize), dtype=self.record_dtype
+        )
+        # the newest record was written at most one period before the count was read
+        newest = self.index + length - 1
+        if self.anchor_time is None:
+            self.anchor_time = now
+            self.anchor_index = newest
+        else:
+            drift = now - (self.anchor_time + (newest - self.anchor_index) * self.period)
+            if drift < 0:
+                self.anchor_time += drift
+            elif drift > self.period + self.max_drift:
+                # the newest record can be up to one period old when it is read
+                self.reanchors += 1
+                self.anchor_time = now
+                self.anchor_index = newest
+        records = np.zeros(length, dtype=IMU_DTYPE)
+        indices = np.arange(self.index, self.index + length, dtype=np.float64)
+        records["monotonic_ns"] = np.round(self.anchor_time + (indices - self.anchor_index) * self.period)
+        for axis, name in enumerate("xyz"):
+            records[f"a{name}"] = raw["accel"][:, axis] * self.accel_scale
+            records[f"g{name}"] = raw["gyro"][:, axis] * self.gyro_scale
+            if self.magnetometer:
+                records[f"m{name}"] = raw["magnetic"][:, axis] * MICROTESLAS_PER_LSB
+        self.index += length
+        return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the FIFO reader against the simulated ICM20948",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--rate", default=GYRO_RATE, type=float, help="Sample rate in Hz")
+    parser.add_argument("--drain-rate", default=100.0, type=float, help="FIFO reads per second")
+    parser.add_argument("--clock-error", default=0.001, type=float, help="Relative error of the simulated chip clock")
+    parser.add_argument("--duration", default=10.0, type=float, help="Duration of the check in seconds")
+    args = parser.parse_args()
+
+    chip = SimulatedICM20948(clock_error=args.clock_error)
+    reader = FIFOReader(chip, rate=args.rate)
+    reader.configure()
+    samples = []
+    begin = time.monotonic()
+    while time.monotonic() - begin < args.duration:
+        time.sleep(1.0 / args.drain_rate)
+        samples.append(reader.read())
+    samples = np.concatenate(samples)
+    if len(samples) == 0:
+        raise SystemExit(f"no samples, the FIFO overflowed {reader.overflows} times (increase --drain-rate)")
+    expected = np.arange(len(samples)) % 32768 * reader.accel_scale
+    errors = samples["monotonic_ns"] - np.array(chip.sample_times[: len(samples)])
+    print(
+        f"{len(samples)} samples at {reader.rate:.1f} Hz, "
+        f"{'ordered' if np.allclose(samples['ax'], expected, rtol=1e-6) else 'lost or misaligned records'}, "
+        f"overflows={reader.overflows} reanchors={reader.reanchors} "
+        f"timestamp error mean={np.mean(errors) / 1e3:.0f}us max={np.max(np.abs(errors)) / 1e3:.0f}us"
+    )
@@ -2,7 +2,7 @@
 #-----------------------------------------------------------------------------
 # imu_reader.py
 #
-# Script to read data over I2C from two ICM20948 boards using the Adafruit ICM libraries
+# Script to read data over I2C from one or more ICM20948 boards using the Adafruit ICM libraries
 #
 #==================================================================================
 
@@ -10,80 +10,190 @@ import time
 from datetime import datetime
 import sys
 import csv
+import contextlib
 import os
 import argparse
+import signal
 from pathlib import Path
 import board
 import adafruit_icm20x
 
+from deadline_scheduler import DeadlineScheduler
+from icm20948_fifo import FIFOReader, I2CRegisters
+from imu_records import IMURecorder
+
 ADDRESS_1 = 0x69
 ADDRESS_2 = 0x68
 
-def readIMU(i2c_address, dir_path):
+def openIMU(i2c, i2c_address, rate):
+	icm = adafruit_icm20x.ICM20948(i2c,i2c_address)
+	# the default output data rates (about 56 Hz accelerometer, 100 Hz gyro) would repeat samples at higher rates
+	icm.accelerometer_data_rate = min(rate, 1125)
+	icm.gyro_data_rate = min(rate, 1100)
+	return icm
+
+def csvSampler(icm, stack, dir_path):
+	fieldnames = ['Timestamp', 'ax', 'ay', 'az', 'gx', 'gy', 'gz', 'mx', 'my', 'mz']
+
+	start_time = datetime.now().strftime("%Y-%d-%m_%H-%M-%S")
+	filename = "imu-data_" + start_time + ".csv"
+
+	csvfile = stack.enter_context(open(os.path.join(dir_path, filename), 'w', newline=''))
+	writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+	writer.writeheader()
+
+	def sample():
+		accel = icm.acceleration
+		gyro = icm.gyro
+		mag = icm.magnetic
+		
+		IMU_data = {'Timestamp': datetime.now(),
+		'ax': accel[0], 
+		'ay': accel[1], 
+		'az': accel[2],
+		'gx': gyro[0],
+		'gy': gyro[1],
+		'gz': gyro[2],
+		'mx': mag[0],
+		'my': mag[1],
+		'mz': mag[2]}
+		
+		writer.writerow(IMU_data)
+		return IMU_data
+	return sample
+
+def binarySampler(icm, recorder):
+	# samples are packed into fixed-width records, see imu_records.py
+	def sample():
+		accel = icm.acceleration
+		gyro = icm.gyro
+		mag = icm.magnetic
+		recorder.append(time.monotonic_ns(), accel, gyro, mag)
+		return (accel, gyro, mag)
+	return sample
+
+def fifoSampler(icm, recorder, rate):
+	# samples are drained from the chip's FIFO in blocks, see icm20948_fifo.py
+	reader = FIFOReader(I2CRegisters(icm.i2c_device), rate=rate)
+	reader.configure()
+	print(f"FIFO sample rate {reader.rate:.1f} Hz", flush=True)
+
+	def sample():
+		records = reader.read()
+		recorder.extend(records)
+		return f"{records[-1] if len(records) > 0 else None} overflows={reader.overflows} reanchors={reader.reanchors}"
+	return sample
+
+def readIMU(i2c_addresses, dir_paths, logFormat="csv", rotationInterval=3600.0, anchorInterval=60.0, rate=100.0, fifo=False, drainRate=100.0):
+	# every IMU is read in turn on the same bus by one loop, with one output directory each
 	counter = 0
 	
 	i2c = board.I2C()  # uses board.SCL and board.SDA
 
-	icm = adafruit_icm20x.ICM20948(i2c,i2c_address)
-
 	print("\nDaedalus IMU Reader\n")
 
-	fieldnames = ['Timestamp', 'ax', 'ay', 'az', 'gx', 'gy', 'gz', 'mx', 'my', 'mz']
+	for dir_path in dir_paths:
+		if not os.path.isdir(dir_path):
+			os.makedirs(dir_path)
+		print(dir_path)
 
-	if not os.path.isdir(dir_path):
-		os.makedirs(dir_path)
+	# achieved rate and jitter are logged every minute and appended to the timing sidecars
+	scheduler = DeadlineScheduler(
+		drainRate if fifo else rate,
+		sidecars=[os.path.join(dir_path, "imu-timing.jsonl") for dir_path in dir_paths],
+		name=",".join(hex(address) for address in i2c_addresses),
+	)
+	# the last block is written when supervisord stops the reader
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-	print(dir_path)
+	with contextlib.ExitStack() as stack:
+		samplers = []
+		for i2c_address, dir_path in zip(i2c_addresses, dir_paths):
+			icm = openIMU(i2c, i2c_address, rate)
+			if logFormat == "csv":
+				samplers.append(csvSampler(icm, stack, dir_path))
+				continue
+			recorder = stack.enter_context(IMURecorder(dir_path, rotation_interval=rotationInterval, anchor_interval=anchorInterval))
+			if fifo:
+				samplers.append(fifoSampler(icm, recorder, rate))
+			else:
+				samplers.append(binarySampler(icm, recorder))
 
-	start_time = datetime.now().strftime("%Y-%d-%m_%H-%M-%S")
-	filename = "imu-data_" + start_time + ".csv"
-	
-	with open(os.path.join(dir_path, filename), 'w', newline='') as csvfile:
-		writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-		writer.writeheader()
-			
+		# a failing IMU is reported without stopping the others
+		errors = [0] * len(samplers)
+		latest = [None] * len(samplers)
 		while True:
-			# print("Writing data...")
-			
-			# Update and write data from first IMU
-			accel = icm.acceleration
-			gyro = icm.gyro
-			mag = icm.magnetic
-			
-			IMU_data = {'Timestamp': datetime.now(),
-			'ax': accel[0], 
-			'ay': accel[1], 
-			'az': accel[2],
-			'gx': gyro[0],
-			'gy': gyro[1],
-			'gz': gyro[2],
-			'mx': mag[0],
-			'my': mag[1],
-			'mz': mag[2]}
-			
-			writer.writerow(IMU_data)
+			for index, sample in enumerate(samplers):
+				try:
+					latest[index] = sample()
+				except OSError as error:
+					if errors[index] == 0:
+						print(f"IMU {hex(i2c_addresses[index])} read failed ({error!r})", flush=True)
+					errors[index] += 1
 			counter+=1
-			if counter == 100:
-				print(IMU_data, flush=True) 
+			if counter >= scheduler.rate:
+				for index, i2c_address in enumerate(i2c_addresses):
+					print(hex(i2c_address), latest[index], f"errors={errors[index]}", flush=True)
 				counter = 0
 		
-			time.sleep(0.01)
+			scheduler.wait()
 
 
 if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-	parser.add_argument("i2c_address", help="I2C address for IMU", type=str)
+	parser.add_argument("i2c_address", nargs="+", help="I2C addresses of the IMUs, read in turn by one process", type=str)
 	parser.add_argument(
 		"--path",
-		default=str(Path.home() / 'data/imu_horizon'),
-		help="Path to folder to save IMU data",
+		action="append",
+		help="Path to folder to save IMU data, once per I2C address in the same order (default ~/data/imu_horizon for a single IMU)",
+	)
+	parser.add_argument(
+		"--format",
+		default="csv",
+		choices=["csv", "binary"],
+		help="Log format, binary writes monotonic timestamps and wall-clock anchors (convert with imu_records.py)",
+	)
+	parser.add_argument(
+		"--rate",
+		default=100.0,
+		type=float,
+		help="Target sampling rate in Hz, missed samples are skipped rather than caught up",
+	)
+	parser.add_argument(
+		"--rotation-interval",
+		default=3600.0,
+		type=float,
+		help="Interval between binary log files in seconds (0 writes a single file)",
+	)
+	parser.add_argument(
+		"--anchor-interval",
+		default=60.0,
+		type=float,
+		help="Interval between wall-clock anchors in the binary log in seconds",
+	)
+	parser.add_argument(
+		"--fifo",
+		action="store_true",
+		help="Read samples in blocks from the IMU's FIFO at --rate (up to 1100 Hz), requires --format binary",
+	)
+	parser.add_argument(
+		"--drain-rate",
+		default=100.0,
+		type=float,
+		help="FIFO reads per second (--fifo only), the FIFO holds about 24 samples",
 	)
 	args = parser.parse_args()
+	if args.fifo and args.format != "binary":
+		parser.error("--fifo requires --format binary")
+	if args.path is None and len(args.i2c_address) == 1:
+		args.path = [str(Path.home() / 'data/imu_horizon')]
+	if args.path is None or len(args.path) != len(args.i2c_address):
+		parser.error("--path must be given once per I2C address")
 
 	try:
-		readIMU(int(args.i2c_address, 16), args.path)
+		readIMU([int(address, 16) for address in args.i2c_address], args.path, args.format, args.rotation_interval, args.anchor_interval, args.rate, args.fifo, args.drain_rate)
 	except (KeyboardInterrupt, SystemExit) as exErr:
 		print("\nEnding imu_reader.py")
 		sys.exit(0)
@@ -0,0 +1,188 @@
+"""Binary IMU logs.
+
+IMURecorder writes one fixed-width record per IMU sample into a record file
+(see record_file.py), timestamped with time.monotonic_ns() so that clock
+corrections never make timestamps jump. Wall-clock anchors (monotonic and
+wall-clock time read back to back) are written to a second record file every
+anchor interval and at each rotation. A new pair of files is started every
+rotation interval:
+
+    imu-data_<start>.bin
+    imu-data_<start>_anchors.bin
+
+Samples are kept in a preallocated block and written to disk one block at a
+time. Each block (and each anchor) is synced to disk as soon as it is written,
+so a power loss loses at most the block being filled.
+
+Converting to the CSV format of the text mode of imu_reader_adafruit.py (each
+sample's wall-clock time is computed from the latest anchor before it):
+
+    python3 imu_records.py data/imu_horizon/imu-data_*.bin
+"""
+
+import argparse
+import csv
+import datetime
+import pathlib
+import time
+
+import numpy as np
+
+from record_file import RecordWriter, read_header, read_records
+
+ANCHORS_SUFFIX = "_anchors.bin"
+FIELDNAMES = ["ax", "ay", "az", "gx", "gy", "gz", "mx", "my", "mz"]
+
+IMU_DTYPE = np.dtype([("monotonic_ns", "<u8")] + [(name, "<f4") for name in FIELDNAMES])
+
+ANCHOR_DTYPE = np.dtype(
+    [
+        ("monotonic_ns", "<u8"),
+        ("time_ns", "<i8"),
+    ]
+)
+
+
+def anchors_path(path: pathlib.Path) -> pathlib.Path:
+    path = pathlib.Path(path)
+    return path.with_name(f"{path.stem}{ANCHORS_SUFFIX}")
+
+
+class IMURecorder:
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        rotation_interval: float = 3600.0,
+        anchor_interval: float = 60.0,
+        block_length: int = 1024,
+        metadata: dict = None,
+    ):
+        """
+        Intervals are in seconds, a rotation interval of 0 writes a single
+        pair of files.
+        """
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.rotation_interval = int(rotation_interval * 1e9)
+        self.anchor_interval = int(anchor_interval * 1e9)
+        self.block_length = block_length
+        self.metadata = {} if metadata is None else metadata
+        self.samples = None
+        self.anchors = None
+        self.next_rotation = 0
+        self.next_anchor = 0
+
+    def _open(self, monotonic_ns: int):
+        self.close()
+        start_time = datetime.datetime.now().strftime("%Y-%d-%m_%H-%M-%S")
+        path = self.directory / f"imu-data_{start_time}.bin"
+        index = 1
+        while path.exists():
+            path = self.directory / f"imu-data_{start_time}_{index}.bin"
+            index += 1
+        metadata = dict(self.metadata, kind="imu_samples")
+        self.samples = RecordWriter(
+            path, IMU_DTYPE, block_length=self.block_length, metadata=metadata, sync=True
+        )
+        self.anchors = RecordWriter(
+            anchors_path(path),
+            ANCHOR_DTYPE,
+            block_length=16,
+            metadata=dict(self.metadata, kind="imu_anchors"),
+            sync=True,
+        )
+        print(f"Started IMU log {path}", flush=True)
+        self.next_rotation = (
+            monotonic_ns + self.rotation_interval if self.rotation_interval > 0 else np.iinfo(np.int64).max
+        )
+        self.anchor()
+
+    def anchor(self):
+        self.anchors.append((time.monotonic_ns(), time.time_ns()))
+        self.anchors.flush()
+        self.next_anchor = time.monotonic_ns() + self.anchor_interval
+
+    def append(self, monotonic_ns: int, acceleration, gyro, magnetic):
+        if monotonic_ns >= self.next_rotation:
+            self._open(monotonic_ns)
+        elif monotonic_ns >= self.next_anchor:
+            self.anchor()
+        self.samples.append((monotonic_ns, *acceleration, *gyro, *magnetic))
+
+    def extend(self, records: np.ndarray):
+        """
+        Appends an array of IMU_DTYPE records, for instance read from the
+        sensor's FIFO (see icm20948_fifo.py).
+        """
+        if len(records) == 0:
+            return
+        monotonic_ns = int(records["monotonic_ns"][0])
+        if monotonic_ns >= self.next_rotation:
+            self._open(monotonic_ns)
+        elif monotonic_ns >= self.next_anchor:
+            self.anchor()
+        self.samples.extend(records)
+
+    def close(self):
+        if self.samples is not None:
+            self.anchor()
+            self.samples.close()
+            self.anchors.close()
+            self.samples = None
+            self.anchors = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
+
+
+def wall_clock_ns(samples: np.ndarray, anchors: np.ndarray) -> np.ndarray:
+    """
+    Returns the wall-clock time of each sample in nanoseconds since the epoch.
+    """
+    indices = np.searchsorted(anchors["monotonic_ns"], samples["monotonic_ns"], side="right") - 1
+    indices = np.clip(indices, 0, len(anchors) - 1)
+    return anchors["time_ns"][indices] + (
+        samples["monotonic_ns"].astype(np.int64) - anchors["monotonic_ns"][indices].astype(np.int64)
+    )
+
+
+def convert_csv(source: pathlib.Path, target: pathlib.Path = None) -> pathlib.Path:
+    source = pathlib.Path(source)
+    if target is None:
+        target = source.with_suffix(".csv")
+    _, metadata, _ = read_header(source)
+    if metadata.get("kind") != "imu_samples":
+        raise ValueError(f"{source} is not an IMU log")
+    samples = read_records(source)
+    anchors = read_records(anchors_path(source))
+    if len(anchors) == 0:
+        raise ValueError(f"{anchors_path(source)} has no anchors")
+    times = wall_clock_ns(samples, anchors)
+    with open(target, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Timestamp"] + FIELDNAMES + ["monotonic_ns"])
+        for sample, time_ns in zip(samples, times):
+            writer.writerow(
+                [datetime.datetime.fromtimestamp(time_ns / 1e9)]
+                + [sample[name] for name in FIELDNAMES]
+                + [int(sample["monotonic_ns"])]
+            )
+    return target
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert binary IMU logs to CSV",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("files", nargs="+", help="imu-data_*.bin files to convert (anchor files are skipped)")
+    args = parser.parse_args()
+    for file in args.files:
+        if file.endswith(ANCHORS_SUFFIX):
+            continue
+        target = convert_csv(pathlib.Path(file))
+        print(f"{file} -> {target}")
@@ -1,12 +1,16 @@
 import time
 import argparse
 import json
+import signal
+import sys
 
 from pathlib import Path
 from picamera2 import Picamera2
 from libcamera import controls
 from picamera2.encoders import H264Encoder, Quality
 
+from video_segments import SegmentedOutput
+
 dirname = Path(__file__).resolve().parent
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -19,8 +23,13 @@ parser.add_argument(
 parser.add_argument(
     "--vid_duration",
     default=60,
+    type=float,
+    help="Time for each video duration in seconds, segments are split at the first keyframe after this duration",
+)
+parser.add_argument(
+    "--iperiod",
     type=int,
-    help="Time for each video duration in seconds",
+    help="Frames between keyframes (encoder default if not set), this bounds how much longer than --vid_duration a segment can be",
 )
 parser.add_argument(
     "--config",
@@ -70,14 +79,16 @@ if __name__ == "__main__":
     time.sleep(1)
     cameraControls(picam, args.config)
 
-    encoder = H264Encoder()
+    # the encoder runs continuously, the output starts a new file (and timestamp sidecar) at a keyframe
+    encoder = H264Encoder(iperiod=args.iperiod)
+    output = SegmentedOutput(args.data_path, picam.camera_idx, args.vid_duration, encoder)
 
-    while True:
-        timestr = time.strftime("%Y%m%d-%H%M%S")
-        output = f'{args.data_path}/cam_{picam.camera_idx}_vid_{timestr}'
-
-        picam.start_encoder(encoder, f'{output}.h264',quality=Quality.HIGH)
-        time.sleep(args.vid_duration)
+    # the last segment is closed when supervisord stops the recorder
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    picam.start_encoder(encoder, output, quality=Quality.HIGH)
+    try:
+        while True:
+            time.sleep(1)
+    finally:
         picam.stop_encoder()
-
-    picam.stop()
\ No newline at end of file
+        picam.stop()
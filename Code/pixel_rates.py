@@ -0,0 +1,119 @@
+"""Per-pixel event rates for the event viewer.
+
+PixelRateMap keeps an exponentially decaying event count per pixel, with the
+row and column sums and the total kept alongside. Decay is lazy: events are
+added with weight exp((t - reference) / tau) and every query multiplies by
+exp(-(now - reference) / tau), so adding a packet only touches the pixels of
+its events and the buffers are rescaled only when the weights grow large.
+
+Queries cost the same whatever the event history: the total rate is a single
+value, the histograms are width + height values, and the hot pixels and the
+rate image are one pass over the width x height buffer.
+"""
+
+import math
+import threading
+
+import numpy as np
+
+# weights are rescaled before they reach exp(RESCALE_EXPONENT)
+RESCALE_EXPONENT = 30.0
+
+
+class PixelRateMap:
+    def __init__(self, width: int, height: int, tau: float = 1.0):
+        """
+        tau is the decay time constant in seconds, rates are in events per
+        second and pixel coordinates are sensor coordinates.
+        """
+        self.width = width
+        self.height = height
+        self.tau = tau * 1e6
+        self.counts = np.zeros(width * height, dtype=np.float64)
+        self.rows = np.zeros(height, dtype=np.float64)
+        self.columns = np.zeros(width, dtype=np.float64)
+        self.total = 0.0
+        self.reference = None
+        self.now = 0
+        self.lock = threading.Lock()
+
+    def add(self, events: np.ndarray):
+        """
+        events is a structured array with t, x and y fields, sorted by t.
+        """
+        if len(events) == 0:
+            return
+        with self.lock:
+            if self.reference is None:
+                self.reference = int(events["t"][0])
+            self.now = max(self.now, int(events["t"][-1]))
+            if (self.now - self.reference) / self.tau > RESCALE_EXPONENT:
+                self._rescale(self.now)
+            weights = np.exp((events["t"].astype(np.float64) - self.reference) / self.tau)
+            np.add.at(self.counts, events["y"].astype(np.intp) * self.width + events["x"], weights)
+            np.add.at(self.rows, events["y"], weights)
+            np.add.at(self.columns, events["x"], weights)
+            self.total += float(weights.sum())
+
+    def _rescale(self, reference: int):
+        factor = math.exp(-(reference - self.reference) / self.tau)
+        self.counts *= factor
+        self.rows *= factor
+        self.columns *= factor
+        self.total *= factor
+        self.reference = reference
+
+    def _scale(self) -> float:
+        # from stored weights to events per second
+        if self.reference is None:
+            return 0.0
+        return math.exp(-(self.now - self.reference) / self.tau) * 1e6 / self.tau
+
+    def total_rate(self) -> float:
+        with self.lock:
+            return self.total * self._scale()
+
+    def histograms(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the event rates of every row and every column.
+        """
+        with self.lock:
+            scale = self._scale()
+            return self.rows * scale, self.columns * scale
+
+    def hot_pixels(self, count: int = 10) -> list[dict]:
+        """
+        Returns the count pixels with the highest rates, highest first.
+        """
+        with self.lock:
+            scale = self._scale()
+            count = min(count, len(self.counts))
+            if count <= 0:
+                return []
+            indices = np.argpartition(self.counts, -count)[-count:]
+            indices = indices[np.argsort(self.counts[indices])[::-1]]
+            rates = self.counts[indices] * scale
+        return [
+            {"x": int(index % self.width), "y": int(index // self.width), "rate": float(rate)}
+            for index, rate in zip(indices, rates)
+        ]
+
+    def image(self) -> np.ndarray:
+        """
+        Returns the rates as a (height, width) uint8 image on a log scale,
+        255 is the highest rate.
+        """
+        with self.lock:
+            rates = np.log1p(self.counts * self._scale())
+        maximum = rates.max()
+        if maximum > 0:
+            rates *= 255.0 / maximum
+        return rates.astype(np.uint8).reshape(self.height, self.width)
+
+    def summary(self, count: int = 10) -> dict:
+        return {
+            "t": self.now,
+            "tau": self.tau / 1e6,
+            "total_rate": self.total_rate(),
+            "hot_pixels": self.hot_pixels(count),
+        }
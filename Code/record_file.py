@@ -0,0 +1,157 @@
+"""Self-describing files of fixed-width binary records.
+
+A record file starts with a short header (magic, header length and a JSON
+description of the NumPy dtype plus free-form metadata) followed by packed
+records. Records are only ever appended, so a file cut short by a power loss
+is still readable up to its last complete record.
+"""
+
+import json
+import os
+import pathlib
+import struct
+
+import numpy as np
+
+MAGIC = b"DDLSREC1"
+HEADER_ALIGNMENT = 64
+
+
+def encode_header(dtype: np.dtype, metadata: dict = None) -> bytes:
+    description = json.dumps(
+        {
+            "dtype": np.lib.format.dtype_to_descr(dtype),
+            "metadata": {} if metadata is None else metadata,
+        }
+    ).encode()
+    length = len(MAGIC) + 4 + len(description)
+    padding = -length % HEADER_ALIGNMENT
+    return b"".join(
+        (
+            MAGIC,
+            struct.pack("<I", length + padding),
+            description,
+            b" " * padding,
+        )
+    )
+
+
+def decode_header(data: bytes) -> tuple[np.dtype, dict, int]:
+    """
+    Returns the record dtype, the metadata dict and the offset of the first
+    record, data must hold at least the whole header.
+    """
+    if len(data) < len(MAGIC) + 4 or data[: len(MAGIC)] != MAGIC:
+        raise ValueError("not a record file")
+    (offset,) = struct.unpack_from("<I", data, len(MAGIC))
+    description = json.loads(bytes(data[len(MAGIC) + 4 : offset]))
+    return (
+        np.lib.format.descr_to_dtype(
+            [tuple(field) for field in description["dtype"]]
+            if isinstance(description["dtype"], list)
+            else description["dtype"]
+        ),
+        description["metadata"],
+        offset,
+    )
+
+
+def read_header(path) -> tuple[np.dtype, dict, int]:
+    """
+    Returns the record dtype, the metadata dict and the offset of the first
+    record.
+    """
+    with open(path, "rb") as file:
+        prefix = file.read(len(MAGIC) + 4)
+        if len(prefix) < len(MAGIC) + 4 or prefix[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a record file")
+        (offset,) = struct.unpack("<I", prefix[len(MAGIC) :])
+        return decode_header(prefix + file.read(offset - len(prefix)))
+
+
+def read_records(path) -> np.ndarray:
+    """
+    Memory-maps the records of a record file as a read-only NumPy array.
+    """
+    dtype, _, offset = read_header(path)
+    length = (os.path.getsize(path) - offset) // dtype.itemsize
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(length,))
+
+
+def decode_records(data: bytes) -> np.ndarray:
+    """
+    Returns the records of a record file read into memory (for instance a
+    decompressed one) as a read-only NumPy array.
+    """
+    dtype, _, offset = decode_header(data)
+    return np.frombuffer(data, dtype=dtype, count=(len(data) - offset) // dtype.itemsize, offset=offset)
+
+
+class RecordWriter:
+    """
+    Appends records to a record file through a preallocated block.
+
+    Records are copied into the block by append and the block is written to
+    disk when it is full or when flush is called. With sync, every block is
+    also flushed from Python's file buffer and synced (fdatasync) as soon as
+    it is written, so a power loss loses at most the block being filled.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        dtype: np.dtype,
+        block_length: int = 4096,
+        metadata: dict = None,
+        sync: bool = False,
+    ):
+        self.path = pathlib.Path(path)
+        self.dtype = np.dtype(dtype)
+        self.sync = sync
+        self.block = np.zeros(block_length, dtype=self.dtype)
+        self.length = 0
+        self.file = open(self.path, "wb")
+        self.file.write(encode_header(self.dtype, metadata))
+
+    def append(self, record: tuple):
+        self.block[self.length] = record
+        self.length += 1
+        if self.length == len(self.block):
+            self.write_block()
+
+    def extend(self, records: np.ndarray):
+        """
+        Appends an array of records with the writer's dtype.
+        """
+        while len(records) > 0:
+            count = min(len(records), len(self.block) - self.length)
+            self.block[self.length : self.length + count] = records[:count]
+            self.length += count
+            records = records[count:]
+            if self.length == len(self.block):
+                self.write_block()
+
+    def write_block(self):
+        if self.length > 0:
+            self.file.write(self.block[: self.length].data)
+            self.length = 0
+            if self.sync:
+                self.file.flush()
+                os.fdatasync(self.file.fileno())
+
+    def flush(self):
+        self.write_block()
+        self.file.flush()
+
+    def close(self):
+        self.write_block()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
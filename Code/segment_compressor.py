@@ -0,0 +1,429 @@
+"""Background compression of finished EVK4 recording segments.
+
+Watches the recordings directories for segments whose metadata says they are
+closed (see evk4_segments.py) and compresses their _events.raw, samples and
+measurements files in a pool of low priority processes. The metadata and the
+seek index are left uncompressed.
+
+Compressed files use the zstd seekable format: the input is cut into fixed-size
+chunks that are compressed as independent frames, followed by a skippable frame
+holding a table of frame sizes. The zstd (or lz4) command line tools decompress
+these files as usual, and SeekableReader decompresses only the frames that
+cover a byte range, so evk4_seek.py keeps working on compressed recordings.
+
+Every compressed file is decompressed and compared with the original before the
+original is deleted. Reads are rate limited and compression pauses while a
+recorder signals backpressure (see evk4_writer.BackpressureFlag).
+
+Once a segment is done, its metadata gets a "compression" entry listing the
+compressed files found on disk. A segment whose files fail to compress is
+retried with an exponential backoff. After --max-attempts failed attempts,
+the failed files and their errors are recorded under "failed" in that entry
+and the files are left uncompressed. Delete the entry to try again.
+
+zstd requires the zstandard package and lz4 the lz4 package.
+"""
+
+import argparse
+import bisect
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import struct
+import subprocess
+import time
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+ZSTD_MAGIC = 0xFD2FB528
+LZ4_MAGIC = 0x184D2204
+
+EXTENSIONS = {"zstd": ".zst", "lz4": ".lz4"}
+COMPRESSED_SUFFIXES = (
+    "_events.raw",
+    "_samples.bin",
+    "_samples.jsonl",
+    "_measurements.jsonl",
+)
+BACKPRESSURE_PATTERN = "/dev/shm/daedalus_backpressure_*"
+
+
+def compress_function(codec: str, level: int):
+    if codec == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=level, write_content_size=True).compress
+    if codec == "lz4":
+        import lz4.frame
+
+        return lambda data: lz4.frame.compress(data, compression_level=level)
+    raise ValueError(f'unknown codec "{codec}" (expected one of {tuple(EXTENSIONS)})')
+
+
+def decompress_function(codec: str):
+    if codec == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress
+    if codec == "lz4":
+        import lz4.frame
+
+        return lz4.frame.decompress
+    raise ValueError(f'unknown codec "{codec}" (expected one of {tuple(EXTENSIONS)})')
+
+
+def seek_table(frames: list[tuple[int, int]]) -> bytes:
+    """
+    Encodes a seek table skippable frame, frames is a list of
+    (compressed size, decompressed size) pairs.
+    """
+    entries = b"".join(struct.pack("<II", *frame) for frame in frames)
+    footer = struct.pack("<IBI", len(frames), 0, SEEKABLE_MAGIC)
+    return struct.pack("<II", SKIPPABLE_MAGIC, len(entries) + len(footer)) + entries + footer
+
+
+class SeekableReader:
+    """
+    Random access to a file written by compress_file.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.file = open(self.path, "rb")
+        self.file.seek(-9, os.SEEK_END)
+        count, descriptor, magic = struct.unpack("<IBI", self.file.read(9))
+        if magic != SEEKABLE_MAGIC:
+            raise ValueError(f"{path} has no seek table")
+        entry_size = 12 if descriptor & 0x80 else 8
+        self.file.seek(-9 - count * entry_size, os.SEEK_END)
+        table = self.file.read(count * entry_size)
+        self.compressed_offsets = [0]
+        self.offsets = [0]
+        for index in range(count):
+            compressed_size, size = struct.unpack_from("<II", table, index * entry_size)
+            self.compressed_offsets.append(self.compressed_offsets[-1] + compressed_size)
+            self.offsets.append(self.offsets[-1] + size)
+        self.size = self.offsets[-1]
+        self.decompress = None
+        if count > 0:
+            self.file.seek(0)
+            (frame_magic,) = struct.unpack("<I", self.file.read(4))
+            self.decompress = decompress_function("zstd" if frame_magic == ZSTD_MAGIC else "lz4")
+        self.cached = (-1, b"")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def frame(self, index: int) -> bytes:
+        if self.cached[0] != index:
+            self.file.seek(self.compressed_offsets[index])
+            self.cached = (
+                index,
+                self.decompress(
+                    self.file.read(
+                        self.compressed_offsets[index + 1] - self.compressed_offsets[index]
+                    )
+                ),
+            )
+        return self.cached[1]
+
+    def read(self, offset: int = 0, size: int = None) -> bytes:
+        end = self.size if size is None else min(offset + size, self.size)
+        if offset >= end:
+            return b""
+        first = bisect.bisect_right(self.offsets, offset) - 1
+        last = bisect.bisect_left(self.offsets, end)
+        data = b"".join(self.frame(index) for index in range(first, last))
+        return data[offset - self.offsets[first] : end - self.offsets[first]]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
+
+
+def compressed_path(path: pathlib.Path) -> pathlib.Path:
+    """
+    Returns the compressed version of path if it exists, otherwise path.
+    """
+    path = pathlib.Path(path)
+    if not path.exists():
+        for extension in EXTENSIONS.values():
+            candidate = path.with_name(path.name + extension)
+            if candidate.exists():
+                return candidate
+    return path
+
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        """
+        rate is in bytes per second, 0 disables the limit.
+        """
+        self.rate = rate
+        self.next = time.monotonic()
+
+    def consume(self, size: int):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        if self.next > now:
+            time.sleep(self.next - now)
+        self.next = max(self.next, now) + size / self.rate
+
+
+def wait_for_recorders(pattern: str, stale: float):
+    """
+    Sleeps while a recorder reports backpressure. Flags that have not been
+    refreshed for stale seconds are left by recorders that did not exit
+    cleanly and are ignored.
+    """
+    while True:
+        now = time.time()
+        active = False
+        for flag in glob.glob(pattern):
+            try:
+                if now - os.path.getmtime(flag) < stale:
+                    active = True
+                    break
+            except FileNotFoundError:
+                pass
+        if not active:
+            return
+        time.sleep(1.0)
+
+
+def compress_file(
+    source: pathlib.Path,
+    codec: str = "zstd",
+    level: int = 3,
+    chunk_size: int = 1 << 22,
+    rate: float = 0.0,
+    backpressure_pattern: str = BACKPRESSURE_PATTERN,
+    backpressure_stale: float = 30.0,
+) -> tuple[int, int]:
+    """
+    Compresses source, verifies the result and deletes source. Returns the
+    original and compressed sizes.
+    """
+    source = pathlib.Path(source)
+    target = source.with_name(source.name + EXTENSIONS[codec])
+    temporary = target.with_name(target.name + ".tmp")
+    compress = compress_function(codec, level)
+    limiter = RateLimiter(rate)
+    digest = hashlib.blake2b()
+    frames = []
+    with open(source, "rb") as input, open(temporary, "wb") as output:
+        while True:
+            wait_for_recorders(backpressure_pattern, backpressure_stale)
+            chunk = input.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            limiter.consume(len(chunk))
+            digest.update(chunk)
+            frame = compress(chunk)
+            output.write(frame)
+            frames.append((len(frame), len(chunk)))
+        output.write(seek_table(frames))
+        output.flush()
+        os.fsync(output.fileno())
+
+    # verify before deleting the original
+    check = hashlib.blake2b()
+    with SeekableReader(temporary) as reader:
+        for index in range(len(reader)):
+            wait_for_recorders(backpressure_pattern, backpressure_stale)
+            frame = reader.frame(index)
+            limiter.consume(len(frame))
+            check.update(frame)
+        size = reader.size
+    if check.digest() != digest.digest() or size != source.stat().st_size:
+        temporary.unlink()
+        raise RuntimeError(f"verification of {temporary} failed")
+    os.rename(temporary, target)
+    directory = os.open(source.parent, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    source.unlink()
+    return size, target.stat().st_size
+
+
+def lower_priority():
+    """
+    Process pool initializer, the workers run at the lowest CPU priority and
+    in the idle I/O scheduling class.
+    """
+    os.nice(19)
+    if shutil.which("ionice") is not None:
+        subprocess.run(
+            ["ionice", "-c", "3", "-p", str(os.getpid())],
+            check=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def finished_segments(directories: list[str]):
+    """
+    Yields the metadata paths of closed segments that have not been compressed.
+    """
+    for directory in directories:
+        for path in sorted(pathlib.Path(directory).glob("**/*_metadata.json")):
+            try:
+                with open(path) as json_file:
+                    metadata = json.load(json_file)
+            except (OSError, ValueError):
+                continue
+            if metadata.get("closed", False) and "compression" not in metadata:
+                yield path
+
+
+def segment_files(metadata_path: pathlib.Path) -> list[pathlib.Path]:
+    name = metadata_path.name[: -len("_metadata.json")]
+    return [
+        metadata_path.with_name(f"{name}{suffix}")
+        for suffix in COMPRESSED_SUFFIXES
+        if metadata_path.with_name(f"{name}{suffix}").exists()
+    ]
+
+
+def compressed_files(metadata_path: pathlib.Path) -> list[pathlib.Path]:
+    name = metadata_path.name[: -len("_metadata.json")]
+    return [
+        metadata_path.with_name(f"{name}{suffix}{extension}")
+        for suffix in COMPRESSED_SUFFIXES
+        for extension in EXTENSIONS.values()
+        if metadata_path.with_name(f"{name}{suffix}{extension}").exists()
+    ]
+
+
+def mark_compressed(metadata_path: pathlib.Path, codec: str, failed: dict[str, str] = None):
+    """
+    Lists the compressed files of the segment that are on disk (including
+    files compressed by earlier attempts) in its metadata. failed maps the
+    names of the files that could not be compressed to their errors.
+    """
+    with open(metadata_path) as json_file:
+        metadata = json.load(json_file)
+    metadata["compression"] = {
+        "codec": codec,
+        "files": [path.name for path in compressed_files(metadata_path)],
+    }
+    if failed:
+        metadata["compression"]["failed"] = failed
+    temporary = metadata_path.with_name(metadata_path.name + ".tmp")
+    with open(temporary, "w") as json_file:
+        json.dump(metadata, json_file, indent=4)
+    os.rename(temporary, metadata_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compress finished EVK4 segments in the background",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("directories", nargs="+", help="Recordings directories to watch")
+    parser.add_argument("--codec", default="zstd", choices=tuple(EXTENSIONS), help="Compression codec")
+    parser.add_argument("--level", default=3, type=int, help="Compression level")
+    parser.add_argument(
+        "--chunk-size",
+        default=1 << 22,
+        type=int,
+        help="Size of the independently compressed chunks in bytes",
+    )
+    parser.add_argument("--workers", default=1, type=int, help="Number of compression processes")
+    parser.add_argument(
+        "--rate",
+        default=8e6,
+        type=float,
+        help="Maximum read rate of each worker in bytes per second (0 disables the limit)",
+    )
+    parser.add_argument("--scan-interval", default=30.0, type=float, help="Interval between scans in seconds")
+    parser.add_argument(
+        "--max-attempts",
+        default=3,
+        type=int,
+        help="Number of attempts at compressing a segment before its failed files are left uncompressed",
+    )
+    parser.add_argument(
+        "--backpressure",
+        default=BACKPRESSURE_PATTERN,
+        help="Glob pattern of the recorders' backpressure flag files",
+    )
+    args = parser.parse_args()
+
+    # fail early if the codec is not installed
+    compress_function(args.codec, args.level)
+
+    print(f"Compressing finished segments in {args.directories} with {args.codec}", flush=True)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers, initializer=lower_priority
+    ) as executor:
+        in_progress = {}
+        # metadata path to (failed attempts, monotonic time of the next attempt)
+        attempts = {}
+        while True:
+            for metadata_path in finished_segments(args.directories):
+                if metadata_path in in_progress:
+                    continue
+                if time.monotonic() < attempts.get(metadata_path, (0, 0.0))[1]:
+                    continue
+                in_progress[metadata_path] = [
+                    (
+                        path,
+                        executor.submit(
+                            compress_file,
+                            path,
+                            args.codec,
+                            args.level,
+                            args.chunk_size,
+                            args.rate,
+                            args.backpressure,
+                        ),
+                    )
+                    for path in segment_files(metadata_path)
+                ]
+            for metadata_path, jobs in list(in_progress.items()):
+                if not all(future.done() for _, future in jobs):
+                    continue
+                del in_progress[metadata_path]
+                failed = {}
+                for path, future in jobs:
+                    try:
+                        size, compressed_size = future.result()
+                        print(
+                            f"Compressed {path} ({size} -> {compressed_size} bytes)",
+                            flush=True,
+                        )
+                    except Exception as error:
+                        failed[path.name] = repr(error)
+                        print(f"Compressing {path} failed: {error}", flush=True)
+                if len(failed) == 0:
+                    mark_compressed(metadata_path, args.codec)
+                    attempts.pop(metadata_path, None)
+                    continue
+                failures = attempts.get(metadata_path, (0, 0.0))[0] + 1
+                if failures >= args.max_attempts:
+                    print(
+                        f"Giving up on {sorted(failed)} after {failures} attempts",
+                        flush=True,
+                    )
+                    mark_compressed(metadata_path, args.codec, failed)
+                    attempts.pop(metadata_path, None)
+                else:
+                    attempts[metadata_path] = (
+                        failures,
+                        time.monotonic() + args.scan_interval * (1 << failures),
+                    )
+            time.sleep(args.scan_interval)
@@ -2,12 +2,18 @@ import time
 import datetime
 import json
 import argparse
+import signal
+import sys
 from pathlib import Path
 import logging
 
 from picamera2 import Picamera2
 from libcamera import controls
 
+from deadline_scheduler import SlotScheduler
+from snapshot_metadata import MetadataStore
+from snapshot_writer import SnapshotWriter
+
 def check_request_timestamp(request, check_time):
     md = request.get_metadata()
     # 'SensorTimestamp' is when the first pixel was read out, so it started being
@@ -15,25 +21,54 @@ def check_request_timestamp(request, check_time):
     exposure_start_time = md['SensorTimestamp'] - 1000 * md['ExposureTime']
     if exposure_start_time < check_time:
         print("ERROR: request captured too early by", check_time - exposure_start_time, "nanoseconds")
+    return exposure_start_time - check_time
 
-def snapshot(camera:Picamera2, data_path:str):
+def snapshot(camera:Picamera2, data_path:str, slots:SlotScheduler, writer:SnapshotWriter=None, store:MetadataStore=None):
 
-    timestr = time.strftime("%Y%m%d-%H%M%S")
-    ct = datetime.datetime.now()
-    check_time = time.monotonic_ns() + 5e8
+    # the first frame exposed after the slot's start is captured, slots are aligned to the wall clock
+    slot_ns, check_time = slots.next_slot()
+    ct = datetime.datetime.fromtimestamp(slot_ns / 1e9)
+    timestr = ct.strftime("%Y%m%d-%H%M%S")
+    if slot_ns % 1000000000 != 0:
+        # sub-second timers would otherwise reuse file names
+        timestr += f"-{slot_ns // 1000000 % 1000:03d}"
     job = camera.capture_request(flush=check_time, wait=False)
 
     request = camera.wait(job)
-    check_request_timestamp(request, check_time)
+    captured_ns = time.monotonic_ns()
+    offset = check_request_timestamp(request, check_time)
+    print(f"slot {ct} exposure start offset {offset / 1e6:+.1f} ms, missed slots {slots.skipped} (total {slots.missed})", flush=True)
     imgMetadata = request.get_metadata()
     imgMetadata2 = {
         "filename":f"cam_{camera.camera_idx}_image_{timestr}.jpg",
         "timestamp":str(ct),
-        "timestamp(ns)":check_time
+        "timestamp(ns)":check_time,
+        "exposure_start_offset(ns)":offset,
+        "missed_slots":slots.skipped,
     }
-    
-    with open(f'{data_path}/cam_{camera.camera_idx}_metadata_{timestr}.json', 'w') as f:
-        f.write(json.dumps([imgMetadata2, imgMetadata]))
+    json_path = f'{data_path}/cam_{camera.camera_idx}_metadata_{timestr}.json'
+    if store is not None:
+        # one line of the camera's daily store instead of a JSON file per snapshot (see snapshot_metadata.py)
+        store.append(slot_ns, Path(json_path).name, [imgMetadata2, imgMetadata])
+        json_path = None
+
+    if writer is not None:
+        # copy the frame out and release the request, encoding and writing happen on the writer's workers
+        buffer = request.make_buffer('main')
+        request.release()
+        writer.submit(
+            buffer,
+            imgMetadata,
+            [imgMetadata2, imgMetadata],
+            f'{data_path}/cam_{camera.camera_idx}_image_{timestr}.jpg',
+            json_path,
+            captured_ns,
+        )
+        return
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            f.write(json.dumps([imgMetadata2, imgMetadata]))
     request.save('main', f'{data_path}/cam_{camera.camera_idx}_image_{timestr}.jpg')
     request.release()
 
@@ -74,8 +109,26 @@ parser.add_argument(
 parser.add_argument(
     "--timer",
     default=1,
+    type=float,
+    help="Time in seconds between snapshots, snapshots are taken on multiples of this period since the Unix epoch (which are also multiples since midnight UTC when the period divides 86400)"
+)
+parser.add_argument(
+    "--metadata",
+    default="store",
+    choices=["store", "files"],
+    help="Write snapshot metadata to one JSON lines file per day (export with snapshot_metadata.py) or one JSON file per snapshot",
+)
+parser.add_argument(
+    "--encoders",
+    default=0,
+    type=int,
+    help="Number of background threads encoding and writing snapshots (0 saves each snapshot before the next capture)",
+)
+parser.add_argument(
+    "--queue_length",
+    default=4,
     type=int,
-    help="Time in seconds between snapshots"
+    help="Maximum number of snapshots waiting to be written (--encoders only), captures wait when the queue is full",
 )
 parser.add_argument(
     "--config",
@@ -96,6 +149,20 @@ if __name__ == "__main__":
 
     time.sleep(2)
 
-    while True:
-        snapshot(picam, args.data_path)
-        time.sleep(args.timer)
+    writer = None
+    if args.encoders > 0:
+        writer = SnapshotWriter(picam, workers=args.encoders, queue_length=args.queue_length)
+    # queued snapshots are written when supervisord stops the controller
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    store = None
+    if args.metadata == "store":
+        store = MetadataStore(args.data_path, picam.camera_idx)
+    try:
+        slots = SlotScheduler(args.timer)
+        while True:
+            snapshot(picam, args.data_path, slots, writer, store)
+    finally:
+        if writer is not None:
+            writer.close()
+        if store is not None:
+            store.close()
@@ -0,0 +1,199 @@
+"""Per-day metadata stores for camera snapshots.
+
+MetadataStore appends the metadata of every snapshot as one JSON line to a
+file per camera and per day, instead of writing one JSON file per snapshot:
+
+    cam_<N>_metadata_<YYYYMMDD>.jsonl
+
+Each line holds the snapshot's wall-clock time in nanoseconds since the epoch
+("time_ns"), the name of the JSON file the snapshot used to have
+("json_filename") and that file's content ("content"). Lines are kept in
+memory and written a block at a time, so a power loss loses at most one block
+and a partially written last line is ignored by the readers.
+
+Lines are appended in time order, so nearest() finds the snapshot closest to
+a timestamp with a binary search on byte offsets, reading O(log n) lines of
+the store.
+
+    python3 snapshot_metadata.py nearest data/cmos_horizon 1 2024-06-01T12:00:05
+    python3 snapshot_metadata.py export data/cmos_horizon/cam_1_metadata_*.jsonl
+
+export writes the per-snapshot JSON files of the previous layout (next to the
+store by default).
+"""
+
+import argparse
+import bisect
+import datetime
+import json
+import pathlib
+
+# below this distance between the search bounds, lines are read in turn
+SCAN_BYTES = 1 << 14
+
+
+def store_name(camera_idx: int, time_ns: int) -> str:
+    day = datetime.datetime.fromtimestamp(time_ns / 1e9).strftime("%Y%m%d")
+    return f"cam_{camera_idx}_metadata_{day}.jsonl"
+
+
+class MetadataStore:
+    def __init__(self, directory: pathlib.Path, camera_idx: int, block_length: int = 8):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.camera_idx = camera_idx
+        self.block_length = block_length
+        self.lines = []
+        self.path = None
+
+    def append(self, time_ns: int, json_filename: str, content):
+        path = self.directory / store_name(self.camera_idx, time_ns)
+        if path != self.path:
+            self.flush()
+            self.path = path
+        self.lines.append(
+            json.dumps({"time_ns": time_ns, "json_filename": json_filename, "content": content}) + "\n"
+        )
+        if len(self.lines) >= self.block_length:
+            self.flush()
+
+    def flush(self):
+        if len(self.lines) > 0:
+            with open(self.path, "a") as store:
+                store.write("".join(self.lines))
+            self.lines = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
+
+
+def _decode(line: bytes):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    return entry if isinstance(entry, dict) and "time_ns" in entry else None
+
+
+def _line_after(store, offset: int):
+    """
+    Returns the offset and the entry of the first complete line that starts
+    at or after offset, or (None, None).
+    """
+    store.seek(offset)
+    if offset > 0:
+        store.seek(offset - 1)
+        store.readline()
+    while True:
+        start = store.tell()
+        line = store.readline()
+        if not line.endswith(b"\n"):
+            return None, None
+        entry = _decode(line)
+        if entry is not None:
+            return start, entry
+
+
+def nearest_in_store(path: pathlib.Path, time_ns: int):
+    """
+    Returns the entry of the store closest in time to time_ns, or None if the
+    store is empty.
+    """
+    with open(path, "rb") as store:
+        low = 0
+        high = store.seek(0, 2)
+        # the first entry after low is before time_ns (unless low is 0), the first entry after high is not
+        while high - low > SCAN_BYTES:
+            middle = (low + high) // 2
+            _, entry = _line_after(store, middle)
+            if entry is None or entry["time_ns"] >= time_ns:
+                high = middle
+            else:
+                low = middle
+        previous = None
+        _, entry = _line_after(store, low)
+        while entry is not None and entry["time_ns"] < time_ns:
+            previous = entry
+            _, entry = _line_after(store, store.tell())
+    candidates = [candidate for candidate in (previous, entry) if candidate is not None]
+    if len(candidates) == 0:
+        return None
+    return min(candidates, key=lambda candidate: abs(candidate["time_ns"] - time_ns))
+
+
+def nearest(directory: pathlib.Path, camera_idx: int, time_ns: int):
+    """
+    Returns the entry of the camera's stores closest in time to time_ns, or
+    None. Only the stores of the day of time_ns and the closest days before
+    and after are searched.
+    """
+    paths = sorted(pathlib.Path(directory).glob(f"cam_{camera_idx}_metadata_*.jsonl"))
+    index = bisect.bisect_right([path.name for path in paths], store_name(camera_idx, time_ns))
+    candidates = []
+    # the day's store may only hold later snapshots, the previous store then holds the closest earlier one
+    for path in paths[max(0, index - 2) : index + 1]:
+        entry = nearest_in_store(path, time_ns)
+        if entry is not None:
+            candidates.append(entry)
+    if len(candidates) == 0:
+        return None
+    return min(candidates, key=lambda candidate: abs(candidate["time_ns"] - time_ns))
+
+
+def export(path: pathlib.Path, output_directory: pathlib.Path = None) -> int:
+    """
+    Writes one JSON file per snapshot of the store, as written by the
+    controllers before the stores, and returns the number of files.
+    """
+    path = pathlib.Path(path)
+    output_directory = path.parent if output_directory is None else pathlib.Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with open(path, "rb") as store:
+        for line in store:
+            entry = _decode(line)
+            if entry is None:
+                continue
+            with open(output_directory / entry["json_filename"], "w") as f:
+                f.write(json.dumps(entry["content"]))
+            count += 1
+    return count
+
+
+def parse_time(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+    return int(datetime.datetime.fromisoformat(value).timestamp() * 1e9)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query and export snapshot metadata stores",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    nearest_parser = subparsers.add_parser("nearest", help="Print the snapshot closest to a time")
+    nearest_parser.add_argument("directory", help="Directory of the stores (the controller's --data_path)")
+    nearest_parser.add_argument("camera", type=int, help="Camera number (for example 0 or 1)")
+    nearest_parser.add_argument("time", help="Local ISO time (2024-06-01T12:00:05) or nanoseconds since the epoch")
+    export_parser = subparsers.add_parser("export", help="Write one JSON file per snapshot")
+    export_parser.add_argument("files", nargs="+", help="cam_*_metadata_*.jsonl stores")
+    export_parser.add_argument("--output", help="Output directory (default: the store's directory)")
+    args = parser.parse_args()
+
+    if args.command == "nearest":
+        entry = nearest(pathlib.Path(args.directory), args.camera, parse_time(args.time))
+        if entry is None:
+            parser.exit(1, "no snapshots found\n")
+        print(json.dumps(entry, indent=4))
+    else:
+        for file in args.files:
+            count = export(pathlib.Path(file), args.output)
+            print(f"{file} -> {count} files")
@@ -0,0 +1,93 @@
+"""Background encoding of camera snapshots.
+
+SnapshotWriter takes frames that have already been copied out of a
+Picamera2 request, so the capture thread can release the request right away.
+Converting to an image, PNG/JPEG compression and writing the image (and its
+JSON metadata file, if any) run on a pool of worker threads.
+
+At most queue_length frames are waiting or being encoded at any time. A
+submit() beyond that blocks the capture thread until a worker finishes, so a
+slow disk slows the capture rate down instead of filling the memory (a full
+resolution frame is tens of megabytes).
+
+Every saved snapshot is logged with its capture-to-disk latency and the queue
+occupancy. The controllers use it with --encoders (see snapshot() in
+camera_controller.py):
+
+    writer = SnapshotWriter(picam, workers=2, queue_length=4)
+    writer.submit(request.make_buffer("main"), metadata, content, image_path, json_path, captured_ns)
+    request.release()
+"""
+
+import concurrent.futures
+import json
+import threading
+import time
+
+
+class SnapshotWriter:
+    def __init__(self, camera, workers: int = 2, queue_length: int = 4):
+        """
+        camera is the configured Picamera2 whose frames are submitted,
+        queue_length must be at least workers to keep every worker busy.
+        """
+        self.camera = camera
+        self.config = camera.camera_configuration()["main"]
+        self.queue_length = max(queue_length, 1)
+        self.slots = threading.BoundedSemaphore(self.queue_length)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="snapshot"
+        )
+
+    def submit(
+        self,
+        buffer,
+        metadata: dict,
+        json_content,
+        image_path: str,
+        json_path: str,
+        captured_ns: int,
+    ):
+        """
+        buffer is a copy of the main stream (request.make_buffer("main")),
+        metadata is passed to the image encoder (EXIF for JPEG) and
+        json_content is written to json_path unless json_path is None.
+        captured_ns is the time.monotonic_ns() when the request completed.
+        """
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(
+            self._write, buffer, metadata, json_content, image_path, json_path, captured_ns
+        )
+        future.add_done_callback(self._release)
+
+    def _write(self, buffer, metadata, json_content, image_path, json_path, captured_ns):
+        if json_path is not None:
+            with open(json_path, "w") as f:
+                f.write(json.dumps(json_content))
+        image = self.camera.helpers.make_image(buffer, self.config)
+        self.camera.helpers.save(image, metadata, image_path)
+        latency = (time.monotonic_ns() - captured_ns) / 1e9
+        with self.lock:
+            pending = self.pending
+        print(
+            f"snapshot saved to {image_path} (capture to disk {latency:.3f} s, queue {pending}/{self.queue_length})",
+            flush=True,
+        )
+
+    def _release(self, future: concurrent.futures.Future):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+        exception = future.exception()
+        if exception is not None:
+            print(f"ERROR: snapshot could not be saved ({exception!r})", flush=True)
+
+    def close(self):
+        """
+        Waits for the queued snapshots to be written.
+        """
+        self.executor.shutdown(wait=True)
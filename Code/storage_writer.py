@@ -0,0 +1,244 @@
+"""Block writer for high-rate recording files.
+
+StorageWriter replaces a buffered file for the EVK4 events files:
+
+- data is copied into a page-aligned block buffer and written with one
+  pwrite per block (flush writes the partial block, the rest of the block is
+  written from the same buffer later)
+- the file is preallocated in large steps with fallocate (keeping the
+  reported size unchanged) to limit fragmentation, and truncated to its real
+  length on close, which releases the unused preallocated space
+- O_DIRECT bypasses the page cache; partial blocks are then written padded to
+  the alignment and rewritten by the next flush
+- durability is "none" (left to the kernel), "periodic" (fdatasync at most
+  every sync_interval seconds, on flush) or "segment" (fdatasync on close)
+
+After a power cut, an O_DIRECT file may end with up to ALIGNMENT bytes of zero
+padding.
+"""
+
+import ctypes
+import ctypes.util
+import dataclasses
+import errno
+import mmap
+import os
+import pathlib
+import time
+
+ALIGNMENT = 4096
+DURABILITIES = ("none", "periodic", "segment")
+FALLOC_FL_KEEP_SIZE = 0x01
+# fallocate step of the events files, shared by StorageOptions and the command line
+PREALLOCATE = 1 << 26
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_fallocate = getattr(_libc, "fallocate64", None) or getattr(_libc, "fallocate", None)
+if _fallocate is not None:
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+
+
+def fallocate(fd: int, offset: int, length: int) -> bool:
+    """
+    Reserves space without changing the file size, returns False if the
+    filesystem does not support it.
+    """
+    if _fallocate is None:
+        return False
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        error = ctypes.get_errno()
+        if error in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return False
+        raise OSError(error, os.strerror(error))
+    return True
+
+
+class StorageWriter:
+    def __init__(
+        self,
+        path: pathlib.Path,
+        block_size: int = 1 << 22,
+        preallocate: int = PREALLOCATE,
+        direct: bool = False,
+        durability: str = "none",
+        sync_interval: float = 5.0,
+    ):
+        """
+        preallocate is the size in bytes of each fallocate step, 0 disables
+        preallocation.
+        """
+        if durability not in DURABILITIES:
+            raise ValueError(f'unknown durability "{durability}" (expected one of {DURABILITIES})')
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if direct:
+            if not hasattr(os, "O_DIRECT"):
+                raise ValueError("O_DIRECT is not supported on this platform")
+            flags |= os.O_DIRECT
+        self.path = pathlib.Path(path)
+        self.fd = os.open(self.path, flags, 0o644)
+        self.direct = direct
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.next_sync = time.monotonic() + sync_interval
+        self.preallocate = preallocate
+        self.allocated = 0
+        # anonymous maps are page-aligned, as required by O_DIRECT
+        self.buffer = mmap.mmap(-1, -(-block_size // ALIGNMENT) * ALIGNMENT)
+        self.view = memoryview(self.buffer)
+        self.base = 0
+        self.used = 0
+        self.written = 0
+        self.syncs = 0
+        self.longest_sync = 0.0
+        self.closed = False
+
+    @property
+    def length(self) -> int:
+        return self.base + self.used
+
+    def _reserve(self, end: int):
+        if self.preallocate > 0 and end > self.allocated:
+            size = max(end, self.allocated + self.preallocate) - self.allocated
+            if fallocate(self.fd, self.allocated, size):
+                self.allocated += size
+            else:
+                self.preallocate = 0
+
+    def _pwrite(self, data, offset: int):
+        while len(data) > 0:
+            count = os.pwrite(self.fd, data, offset)
+            data = data[count:]
+            offset += count
+
+    def _write_buffer(self):
+        start, end = self.written, self.used
+        if start == end:
+            return
+        if self.direct:
+            start -= start % ALIGNMENT
+            padded = -(-end // ALIGNMENT) * ALIGNMENT
+            self.view[end:padded] = bytes(padded - end)
+            end = padded
+        self._reserve(self.base + end)
+        self._pwrite(self.view[start:end], self.base + start)
+        self.written = self.used
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        size = len(self.buffer)
+        if not self.direct and self.used == 0 and len(data) >= size:
+            # whole blocks skip the copy into the buffer
+            count = len(data) - len(data) % size
+            self._reserve(self.base + count)
+            self._pwrite(data[:count], self.base)
+            self.base += count
+            data = data[count:]
+        while len(data) > 0:
+            count = min(len(data), size - self.used)
+            self.view[self.used : self.used + count] = data[:count]
+            self.used += count
+            data = data[count:]
+            if self.used == size:
+                self._write_buffer()
+                self.base += size
+                self.used = 0
+                self.written = 0
+
+    def sync(self):
+        start = time.monotonic()
+        os.fdatasync(self.fd)
+        duration = time.monotonic() - start
+        self.syncs += 1
+        if duration > self.longest_sync:
+            self.longest_sync = duration
+        self.next_sync = time.monotonic() + self.sync_interval
+
+    def flush(self) -> bool:
+        """
+        Writes the partial block, returns True if the file was also synced.
+        """
+        self._write_buffer()
+        if self.durability == "periodic" and time.monotonic() >= self.next_sync:
+            self.sync()
+            return True
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self._write_buffer()
+        os.ftruncate(self.fd, self.length)
+        if self.durability != "none":
+            self.sync()
+        os.close(self.fd)
+        self.view.release()
+        self.buffer.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+        return False
+
+
+@dataclasses.dataclass
+class StorageOptions:
+    block_size: int = 1 << 22
+    preallocate: int = PREALLOCATE
+    direct: bool = False
+    durability: str = "none"
+    sync_interval: float = 5.0
+
+    def open(self, path: pathlib.Path) -> StorageWriter:
+        return StorageWriter(
+            path,
+            block_size=self.block_size,
+            preallocate=self.preallocate,
+            direct=self.direct,
+            durability=self.durability,
+            sync_interval=self.sync_interval,
+        )
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--write-block-size",
+        default=1 << 22,
+        type=int,
+        help="Size of the aligned blocks written to the events file in bytes",
+    )
+    parser.add_argument(
+        "--preallocate",
+        default=PREALLOCATE,
+        type=int,
+        help="Size of each preallocation step of the events file in bytes (0 disables preallocation)",
+    )
+    parser.add_argument(
+        "--direct-io",
+        action="store_true",
+        help="Write the events file with O_DIRECT, bypassing the page cache",
+    )
+    parser.add_argument(
+        "--durability",
+        default="none",
+        choices=DURABILITIES,
+        help="When the recording files are synced to the storage device: never explicitly, every --sync-interval, or when a segment closes",
+    )
+    parser.add_argument(
+        "--sync-interval",
+        default=5.0,
+        type=float,
+        help="Minimum interval between syncs in seconds (--durability periodic only)",
+    )
+
+
+def options_from_arguments(args) -> StorageOptions:
+    return StorageOptions(
+        block_size=args.write_block_size,
+        preallocate=args.preallocate,
+        direct=args.direct_io,
+        durability=args.durability,
+        sync_interval=args.sync_interval,
+    )
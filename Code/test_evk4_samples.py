@@ -0,0 +1,33 @@
+import json
+
+import evk4_samples
+
+
+def status_dict(events_cursor: int, overflow_indices) -> dict:
+    return {
+        "system_time": 1.0,
+        "events_cursor": events_cursor,
+        "ring": {
+            "system_time": 1.5,
+            "backlog": 2,
+            "raw_packets": 3,
+            "clutch_engaged": True,
+            "overflow_indices": overflow_indices,
+        },
+    }
+
+
+def test_convert_jsonl_keeps_overflow_indices(tmp_path):
+    source = tmp_path / "recording_samples.jsonl"
+    many = list(range(100, 100 + evk4_samples.OVERFLOW_SLOTS + 3))
+    with open(source, "w") as lines:
+        for index, overflow_indices in enumerate(([], [7, 9], None, many)):
+            lines.write(f"{json.dumps(status_dict(index * 10, overflow_indices))}\n")
+        lines.write('{"system_time": 1.0, "ev')
+    samples = evk4_samples.read_samples(evk4_samples.convert_jsonl(source))
+    assert len(samples) == 4
+    assert samples["events_cursor"].tolist() == [0, 10, 20, 30]
+    assert samples["overflow_count"].tolist() == [0, 2, 0, len(many)]
+    assert samples["overflow_indices"][1][:2].tolist() == [7, 9]
+    assert samples["overflow_indices"][3].tolist() == many[: evk4_samples.OVERFLOW_SLOTS]
+    assert not samples["overflow_indices"][0].any()
@@ -0,0 +1,38 @@
+import pytest
+
+from evk4_writer import RecordingFiles
+from storage_writer import DURABILITIES, StorageOptions
+
+
+@pytest.mark.parametrize("durability", DURABILITIES)
+def test_close_under_every_durability(tmp_path, durability):
+    # sync_interval=0 makes every flush sync the files
+    files = RecordingFiles(
+        tmp_path,
+        "recording",
+        storage=StorageOptions(durability=durability, sync_interval=0.0),
+    )
+    files.write_packets(bytes(range(256)) * 16, [])
+    files.write_measurement({"temperature": 40.0})
+    files.flush()
+    files.write_packets(b"\x00\x80" * 100, [])
+    files.close()
+    assert files.events.closed
+    for file in files._sidecars():
+        assert file.closed
+    assert files.path("_events.raw").read_bytes() == bytes(range(256)) * 16 + b"\x00\x80" * 100
+    assert files.path("_measurements.jsonl").read_bytes() == b'{"temperature": 40.0}\n'
+
+
+def test_close_closes_every_file_after_an_error(tmp_path):
+    files = RecordingFiles(tmp_path, "recording", storage=StorageOptions(durability="periodic"))
+
+    def broken_flush():
+        raise OSError("flush failed")
+
+    files.measurements.flush = broken_flush
+    with pytest.raises(OSError):
+        files.close()
+    assert files.events.closed
+    for file in files._sidecars():
+        assert file.closed
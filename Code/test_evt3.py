@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+import evt3
+
+
+def generate(words: int, seed: int = 0) -> bytes:
+    """
+    Random EVT3 stream with every word type, TIME_HIGH overflows and vectors
+    that run past the end of their row.
+    """
+    generator = np.random.default_rng(seed)
+    stream = []
+    t = 0
+    time_high = -1
+    while len(stream) < words:
+        t += int(generator.integers(0, 1 << 16))
+        if (t >> 12) & 0xFFF != time_high:
+            time_high = (t >> 12) & 0xFFF
+            stream.append((evt3.EVT_TIME_HIGH << 12) | time_high)
+        stream.append((evt3.EVT_TIME_LOW << 12) | (t & 0xFFF))
+        stream.append((evt3.EVT_ADDR_Y << 12) | int(generator.integers(0, 720)))
+        kind = generator.random()
+        if kind < 0.4:
+            stream.append((evt3.EVT_ADDR_X << 12) | int(generator.integers(0, 1 << 12)))
+        elif kind < 0.8:
+            stream.append((evt3.VECT_BASE_X << 12) | int(generator.integers(0, 1 << 12)))
+            for _ in range(int(generator.integers(1, 4))):
+                if generator.random() < 0.5:
+                    stream.append((evt3.VECT_12 << 12) | int(generator.integers(0, 1 << 12)))
+                else:
+                    stream.append((evt3.VECT_8 << 12) | int(generator.integers(0, 1 << 8)))
+        else:
+            # vector words carry on from the previous base
+            stream.append((evt3.VECT_8 << 12) | int(generator.integers(0, 1 << 8)))
+            stream.append((evt3.EXT_TRIGGER << 12) | 1)
+            stream.append((evt3.OTHERS << 12) | 5)
+    return np.array(stream, dtype="<u2").tobytes()
+
+
+def reference(data: bytes) -> np.ndarray:
+    """
+    Decodes a stream one word at a time.
+    """
+    time_high = -1
+    overflows = 0
+    time_low = 0
+    y = -1
+    base_x = -1
+    polarity = 0
+    events = []
+    for word in np.frombuffer(data, dtype="<u2", count=len(data) // 2).tolist():
+        kind = word >> 12
+        if kind == evt3.EVT_TIME_HIGH:
+            if 0 <= time_high and (word & 0xFFF) < time_high:
+                overflows += 1
+            time_high = word & 0xFFF
+        elif kind == evt3.EVT_TIME_LOW:
+            time_low = word & 0xFFF
+        elif kind == evt3.EVT_ADDR_Y:
+            y = word & 0x7FF
+        elif kind == evt3.VECT_BASE_X:
+            base_x = word & 0x7FF
+            polarity = (word >> 11) & 1
+        elif kind in (evt3.EVT_ADDR_X, evt3.VECT_12, evt3.VECT_8):
+            t = (overflows << 24) | (time_high << 12) | time_low
+            if kind == evt3.EVT_ADDR_X:
+                if time_high >= 0 and y >= 0:
+                    events.append((t, word & 0x7FF, y, (word >> 11) & 1))
+                continue
+            bits = 12 if kind == evt3.VECT_12 else 8
+            if time_high >= 0 and y >= 0 and base_x >= 0:
+                for bit in range(bits):
+                    if (word >> bit) & 1:
+                        events.append((t, base_x + bit, y, polarity))
+            if base_x >= 0:
+                base_x += bits
+    return np.array(events, dtype=evt3.EVENT_DTYPE)
+
+
+DATA = generate(3000)
+
+
+@pytest.fixture(scope="module")
+def references():
+    return {start: reference(DATA[start:]) for start in (0, 1, 2, 10, 11, 1000)}
+
+
+@pytest.mark.parametrize("start", [0, 1, 2, 10, 11, 1000])
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1001, 1 << 20])
+def test_chunked_decoding_matches_the_reference(references, start, chunk_size):
+    data = DATA[start:]
+    decoder = evt3.Decoder()
+    events = np.concatenate(
+        [decoder.decode(data[offset : offset + chunk_size]) for offset in range(0, len(data), chunk_size)]
+    )
+    assert np.array_equal(events, references[start])
@@ -0,0 +1,32 @@
+import random
+
+import numpy as np
+
+from icm20948_fifo import FIFOReader, SimulatedICM20948
+
+
+class SteppedClock:
+    def __init__(self):
+        self.now = 1_000_000_000
+
+    def __call__(self) -> int:
+        return self.now
+
+
+def test_no_reanchors_at_100_hz_without_clock_error():
+    clock = SteppedClock()
+    chip = SimulatedICM20948(clock=clock, clock_error=0.0)
+    reader = FIFOReader(chip, rate=100.0, clock=clock)
+    reader.configure()
+    generator = random.Random(0)
+    samples = []
+    # 10 s of reads at about 100 Hz, with up to 2 ms of scheduling jitter
+    for _ in range(1000):
+        clock.now += 10_000_000 + generator.randrange(-2_000_000, 2_000_000)
+        samples.append(reader.read())
+    samples = np.concatenate(samples)
+    assert reader.rate == 100.0
+    assert reader.overflows == 0
+    assert reader.reanchors == 0
+    errors = samples["monotonic_ns"] - np.array(chip.sample_times[: len(samples)])
+    assert np.max(np.abs(errors)) < reader.period
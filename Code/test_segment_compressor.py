@@ -0,0 +1,36 @@
+import json
+import math
+
+import numpy as np
+import pytest
+
+import evk4_samples
+import segment_compressor
+
+
+def test_mark_compressed_lists_the_files_on_disk(tmp_path):
+    metadata_path = tmp_path / "recording_metadata.json"
+    metadata_path.write_text(json.dumps({"closed": True}))
+    # the events were compressed by an earlier attempt, the measurements failed
+    (tmp_path / "recording_events.raw.zst").write_bytes(b"events")
+    (tmp_path / "recording_samples.bin.zst").write_bytes(b"samples")
+    (tmp_path / "recording_measurements.jsonl").write_bytes(b"{}\n")
+    segment_compressor.mark_compressed(
+        metadata_path, "zstd", {"recording_measurements.jsonl": "OSError()"}
+    )
+    compression = json.loads(metadata_path.read_text())["compression"]
+    assert compression["files"] == ["recording_events.raw.zst", "recording_samples.bin.zst"]
+    assert compression["failed"] == {"recording_measurements.jsonl": "OSError()"}
+    assert list(segment_compressor.finished_segments([tmp_path])) == []
+
+
+def test_compressed_samples_are_read(tmp_path):
+    pytest.importorskip("zstandard")
+    path = tmp_path / f"recording{evk4_samples.SAMPLES_SUFFIX}"
+    with evk4_samples.SamplesWriter(path, block_length=7) as samples:
+        for index in range(100):
+            samples.append((index * 0.1, math.nan, index, index, index * 1000, 0, evk4_samples.NO_OVERFLOWS, 0))
+    expected = np.array(evk4_samples.read_samples(path))
+    segment_compressor.compress_file(path, chunk_size=256, backpressure_pattern=str(tmp_path / "none_*"))
+    assert not path.exists()
+    assert (evk4_samples.read_samples(path)["events_cursor"] == expected["events_cursor"]).all()
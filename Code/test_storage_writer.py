@@ -0,0 +1,10 @@
+import argparse
+
+import storage_writer
+
+
+def test_command_line_defaults_match_the_options():
+    parser = argparse.ArgumentParser()
+    storage_writer.add_arguments(parser)
+    options = storage_writer.options_from_arguments(parser.parse_args([]))
+    assert options == storage_writer.StorageOptions()
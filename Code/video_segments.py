@@ -0,0 +1,118 @@
+"""Gapless segmented H.264 recording for the Pi cameras.
+
+SegmentedOutput is a Picamera2 encoder output that splits one continuous
+H.264 stream into segment files. The encoder is never stopped: a new segment
+starts at the first keyframe after the segment duration, so no frame is lost
+at a boundary and every segment starts with a keyframe (the H.264 encoder
+repeats its headers before each keyframe, so every segment decodes on its
+own).
+
+Every segment gets a timestamp sidecar, a record file (see record_file.py)
+with one record per frame:
+
+    cam_<N>_vid_<timestr>.h264
+    cam_<N>_vid_<timestr>_pts.bin
+
+Each record holds the frame's presentation time in microseconds since the
+encoder started, its SensorTimestamp (nanoseconds on the time.monotonic_ns()
+clock, the timebase of the IMU logs), the offset and size of the frame in
+the .h264 file and whether it is a keyframe. The sidecar metadata holds a
+pair of monotonic and wall-clock times read when the segment started. Both
+files are flushed at every keyframe.
+
+    timestamps = record_file.read_records("cam_0_vid_20240601-120000_pts.bin")
+"""
+
+import pathlib
+import time
+
+import numpy as np
+from picamera2.outputs import Output
+
+from record_file import RecordWriter
+
+PTS_SUFFIX = "_pts.bin"
+
+FRAME_DTYPE = np.dtype(
+    [
+        ("pts_us", "<i8"),
+        ("sensor_timestamp_ns", "<u8"),
+        ("offset", "<u8"),
+        ("size", "<u4"),
+        ("keyframe", "u1"),
+    ]
+)
+
+
+class SegmentedOutput(Output):
+    def __init__(self, data_path: pathlib.Path, camera_idx: int, duration: float, encoder, metadata: dict = None):
+        """
+        duration is the minimum segment duration in seconds. encoder is the
+        encoder writing to this output, its first timestamp converts
+        presentation times back to sensor timestamps.
+        """
+        super().__init__()
+        self.data_path = pathlib.Path(data_path)
+        self.camera_idx = camera_idx
+        self.duration = int(round(duration * 1e6))
+        self.encoder = encoder
+        self.metadata = {} if metadata is None else metadata
+        self.file = None
+        self.timestamps = None
+        self.segment_start = 0
+        self.offset = 0
+
+    def _open(self, pts: int):
+        self._close()
+        timestr = time.strftime("%Y%m%d-%H%M%S")
+        path = self.data_path / f"cam_{self.camera_idx}_vid_{timestr}.h264"
+        index = 1
+        while path.exists():
+            path = self.data_path / f"cam_{self.camera_idx}_vid_{timestr}_{index}.h264"
+            index += 1
+        self.file = open(path, "wb")
+        self.timestamps = RecordWriter(
+            path.with_name(f"{path.stem}{PTS_SUFFIX}"),
+            FRAME_DTYPE,
+            block_length=256,
+            metadata=dict(
+                self.metadata,
+                camera=self.camera_idx,
+                video=path.name,
+                start_pts_us=pts,
+                monotonic_ns=time.monotonic_ns(),
+                time_ns=time.time_ns(),
+            ),
+        )
+        self.segment_start = pts
+        self.offset = 0
+        print(f"Started video segment {path}", flush=True)
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.timestamps.close()
+            self.file = None
+            self.timestamps = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if not self.recording or audio or frame is None:
+            return
+        pts = 0 if timestamp is None else timestamp
+        if keyframe and (self.file is None or pts - self.segment_start >= self.duration):
+            self._open(pts)
+        elif self.file is None:
+            # a segment starts with a keyframe
+            return
+        self.file.write(frame)
+        first = self.encoder.firsttimestamp or 0
+        self.timestamps.append((pts, (first + pts) * 1000, self.offset, len(frame), keyframe))
+        self.offset += len(frame)
+        if keyframe:
+            # a power loss loses at most one group of pictures
+            self.file.flush()
+            self.timestamps.flush()
+
+    def stop(self):
+        super().stop()
+        self._close()